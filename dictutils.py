@@ -167,12 +167,11 @@ class Generator (object):
 	# 导出星际译王的词典源文件，用于 DictEditor 转换
 	def compile_stardict (self, dictionary, filename, title):
 		print('generating ...')
-		words = stardict.tools.dump_map(dictionary, False)
 		out = {}
-		pc = stardict.tools.progress(len(words))
-		for word in words:
+		pc = stardict.tools.progress(len(dictionary))
+		for data in dictionary.iter_records():
 			pc.next()
-			data = dictionary[word]
+			word = data['word']
 			phonetic = data['phonetic']
 			translation = data['translation']
 			if not translation:
@@ -205,7 +204,7 @@ class Generator (object):
 
 	# 导出 Mdx 源文件，然后可以用 MdxBuilder 转换成 .mdx词典
 	def compile_mdx (self, dictionary, filename, mode = None, style = False):
-		words = stardict.tools.dump_map(dictionary, False)
+		words = [ n['word'] for n in dictionary.iter_records(fields = ()) ]
 		fp = codecs.open(filename, 'w', 'utf-8')
 		text2html = self.text2html
 		pc = stardict.tools.progress(len(words))
@@ -213,11 +212,10 @@ class Generator (object):
 			mode = ('name', 'phonetic')
 		count = 0
 		stripword = stardict.stripword
-		words = [ k for k in words ]
 		words.sort(key = lambda x: stripword(x))
-		for word in words:
+		for data in self._iter_batch(dictionary, words):
 			pc.next()
-			data = dictionary[word]
+			word = data['word']
 			phonetic = data['phonetic']
 			translation = data['translation']
 			if not translation:
@@ -287,6 +285,13 @@ class Generator (object):
 		pc.done()
 		return pc.count
 
+	# 按给定顺序分批读取单词数据，每批一次 query_batch
+	def _iter_batch (self, dictionary, words, size = 1000):
+		for i in xrange(0, len(words), size):
+			for data in dictionary.query_batch(words[i:i + size]):
+				if data is not None:
+					yield data
+
 	def _split_pos (self, text):
 		pos = text.find('.')
 		if pos < 0:
@@ -430,9 +435,9 @@ class Generator (object):
 		if not css:
 			main = os.path.split(filename)[-1]
 			css = os.path.splitext(main)[0] + '.css'
-		for _, word in dictionary:
+		for data in dictionary.iter_records():
 			pc.next()
-			data = dictionary.query(word)
+			word = data['word']
 			translation = data['translation']
 			if not translation:
 				translation = data['definition']
@@ -980,9 +985,9 @@ class Treasure (object):
 		mdx1 = {}
 		mdx2 = {}
 		pc = stardict.tools.progress(len(db))
-		for _, word in db:
+		for data in db.iter_records():
 			pc.next()
-			data = db[word]
+			word = data['word']
 			mdx1[word] = self.generate_front(data)
 			mdx2[word] = self.generate_back(data)
 		pc.done()
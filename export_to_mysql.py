@@ -18,24 +18,8 @@ while True:
 
 DB_NAME = DB_NAME.strip()
 
-def british_to_american_phonetic(uk_phonetic):
-    """英式音标转美式音标"""
-    if not uk_phonetic:
-        return ""
-    
-    us_phonetic = uk_phonetic
-    us_phonetic = us_phonetic.replace('ɒ', 'ɑ')
-    us_phonetic = us_phonetic.replace('ɑː', 'ɑ')
-    us_phonetic = us_phonetic.replace('ɔː', 'ɔ')
-    us_phonetic = us_phonetic.replace('ɪə', 'ɪr')
-    us_phonetic = us_phonetic.replace('eə', 'ɛr')
-    us_phonetic = us_phonetic.replace('ʊə', 'ʊr')
-    us_phonetic = us_phonetic.replace('ɜː', 'ɝ')
-    us_phonetic = us_phonetic.replace('uː', 'u')
-    us_phonetic = us_phonetic.replace('iː', 'i')
-    us_phonetic = re.sub(r'ə$', 'ər', us_phonetic)
-    
-    return us_phonetic
+# 英式音标转美式音标（和 stardict 的韵脚索引共用）
+british_to_american_phonetic = stardict.british_to_american_phonetic
 
 def detect_phonetic_system(phonetic):
     """检测音标体系"""
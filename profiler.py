@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set ts=4 sw=4 tw=0 et :
+#======================================================================
+#
+# profiler.py - 文档词汇统计
+#
+# 分块读取大文本（或者标准输入），分词后用 LemmaDB 还原成原型，在
+# 进程池里统计词频，再用 query_batch 批量查询每个原型的 tag/collins/
+# oxford/frq/bnc，输出各个级别的覆盖率和词典里查不到的单词。
+#
+#   python profiler.py -d ecdict.db -l lemma.en.txt book1.txt book2.txt
+#   cat *.txt | python profiler.py -d ecdict.csv -j 8 -u unknown.txt
+#
+#======================================================================
+from __future__ import print_function
+import sys
+import os
+import io
+import re
+import collections
+import multiprocessing
+
+import stardict
+
+
+#----------------------------------------------------------------------
+# 常量
+#----------------------------------------------------------------------
+CHUNK_SIZE = 4 * 1024 * 1024        # 每块文本的字符数
+QUERY_SIZE = 1000                   # 每次 query_batch 的单词数
+
+# 各种考试的标签，和 dictutils.Generator 的顺序相同
+PROFILE_TAGS = ('zk', 'gk', 'ky', 'cet4', 'cet6', 'toefl', 'ielts', 'gre')
+
+# 词频排名的分段（累计）
+PROFILE_RANKS = (1000, 2000, 3000, 5000, 8000, 10000, 15000, 20000)
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*")
+
+
+#----------------------------------------------------------------------
+# 分词：只保留英文单词（连字符分开），转成小写，去掉所有格的 's
+#----------------------------------------------------------------------
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        token = token.lower()
+        if token.endswith("'s"):
+            token = token[:-2]
+        tokens.append(token)
+    return tokens
+
+
+#----------------------------------------------------------------------
+# 分块读取：每次读 size 个字符，在最后一个空白处切开，剩下的部分
+# 留给下一块，保证单词不会被切断，内存占用和文件大小无关
+#----------------------------------------------------------------------
+def read_chunks(fp, size = CHUNK_SIZE):
+    rest = ''
+    while True:
+        text = fp.read(size)
+        if not text:
+            break
+        text = rest + text
+        pos = max(text.rfind(' '), text.rfind('\n'))
+        if pos < 0:
+            rest = text
+            continue
+        rest = text[pos + 1:]
+        yield text[:pos + 1]
+    if rest:
+        yield rest
+
+
+# 打开文本文件，filename 为 None 或者 '-' 时读标准输入
+def open_text(filename, encoding = 'utf-8'):
+    if filename in (None, '-'):
+        if sys.version_info[0] >= 3:
+            return io.TextIOWrapper(sys.stdin.buffer, encoding = encoding,
+                    errors = 'replace')
+        return io.open(sys.stdin.fileno(), 'r', encoding = encoding,
+                errors = 'replace', closefd = False)
+    return io.open(filename, 'r', encoding = encoding, errors = 'replace')
+
+
+#----------------------------------------------------------------------
+# 词形还原：LemmaDB 是 freeze() 生成的文件时直接 mmap，否则读文本
+#----------------------------------------------------------------------
+def open_lemma(filename):
+    with open(filename, 'rb') as fp:
+        head = fp.read(len(stardict.LEMMA_MAGIC))
+    if head == stardict.LEMMA_MAGIC:
+        return stardict.LemmaDB.open_frozen(filename)
+    lemma = stardict.LemmaDB()
+    lemma.load(filename)
+    return lemma
+
+# 词典里的单词（小写，只保留纯字母的），词尾规则猜出的候选原型在
+# LemmaDB 里没有时，只要是词典的单词也接受
+def headwords(dictionary):
+    words = set()
+    for _, word in dictionary:
+        key = word.lower()
+        if key.isalpha():
+            words.add(key)
+    return frozenset(words)
+
+_lemma = None
+
+# 工作进程的初始化：每个进程打开一次 LemmaDB，查不到的单词再用
+# 词尾规则还原成 LemmaDB 里已有的词根或者 members 里的单词
+def _worker_init(filename, members = None):
+    global _lemma
+    if _lemma is None:
+        _lemma = open_lemma(filename)
+        _lemma.fallback(members)
+    return True
+
+# 统计一块文本：相同的单词只还原一次，返回 {原型: 次数}
+def count_chunk(text):
+    counts = collections.Counter(tokenize(text))
+    tokens = list(counts)
+    lemmas = _lemma.lemmatize_many(tokens)
+    result = collections.Counter()
+    for token, lemma in zip(tokens, lemmas):
+        result[lemma or token] += counts[token]
+    return result
+
+
+#----------------------------------------------------------------------
+# Profiler
+#----------------------------------------------------------------------
+class Profiler (object):
+
+    def __init__ (self, dictionary, lemma, jobs = None,
+            chunk = CHUNK_SIZE):
+        if isinstance(dictionary, str):
+            dictionary = stardict.open_dict(dictionary)
+        self.__dict = dictionary
+        self.__lemma = lemma
+        self.__jobs = jobs or multiprocessing.cpu_count()
+        self.__chunk = chunk
+        self.__members = None
+        self.counts = collections.Counter()
+        self.records = {}
+
+    # 统计若干个文件（None 或者 '-' 表示标准输入），同时在途的文本块
+    # 不超过进程数的两倍，所以内存只和词汇量有关
+    def feed (self, filenames, encoding = 'utf-8'):
+        if self.__members is None:
+            self.__members = headwords(self.__dict)
+        if self.__jobs <= 1:
+            _worker_init(self.__lemma, self.__members)
+            for text in self.__iter_text(filenames, encoding):
+                self.counts.update(count_chunk(text))
+            return self.counts
+        pool = multiprocessing.Pool(self.__jobs, _worker_init,
+                (self.__lemma, self.__members))
+        pending = collections.deque()
+        try:
+            for text in self.__iter_text(filenames, encoding):
+                pending.append(pool.apply_async(count_chunk, (text,)))
+                while len(pending) >= self.__jobs * 2:
+                    self.counts.update(pending.popleft().get())
+            while pending:
+                self.counts.update(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+        return self.counts
+
+    def __iter_text (self, filenames, encoding):
+        for filename in filenames:
+            fp = open_text(filename, encoding)
+            try:
+                for text in read_chunks(fp, self.__chunk):
+                    yield text
+            finally:
+                if filename not in (None, '-'):
+                    fp.close()
+
+    # 用 query_batch 批量查询全部原型的 tag/collins/oxford/frq/bnc
+    def lookup (self):
+        fields = ('tag', 'collins', 'oxford', 'frq', 'bnc')
+        words = [ n for n in self.counts if n not in self.records ]
+        for chunk in stardict.iter_chunks(words, QUERY_SIZE):
+            for word, record in zip(chunk,
+                    self.__dict.query_batch(chunk, fields)):
+                self.records[word] = record
+        return self.records
+
+    # 各个级别的覆盖率：[(级别, 原型数, 出现次数, 占全部单词的比例)]
+    def coverage (self):
+        total = sum(self.counts.values())
+        levels = collections.OrderedDict()
+        def add(name, count):
+            levels[name][0] += 1
+            levels[name][1] += count
+        for name in PROFILE_TAGS:
+            levels['tag:' + name] = [ 0, 0 ]
+        for n in range(5, 0, -1):
+            levels['collins:%d'%n] = [ 0, 0 ]
+        levels['oxford'] = [ 0, 0 ]
+        for rank in ('frq', 'bnc'):
+            for n in PROFILE_RANKS:
+                levels['%s<=%d'%(rank, n)] = [ 0, 0 ]
+        levels['known'] = [ 0, 0 ]
+        levels['unknown'] = [ 0, 0 ]
+        for word, count in self.counts.items():
+            record = self.records.get(word)
+            if record is None:
+                add('unknown', count)
+                continue
+            add('known', count)
+            tags = (record.get('tag') or '').split()
+            for name in PROFILE_TAGS:
+                if name in tags:
+                    add('tag:' + name, count)
+            collins = record.get('collins') or 0
+            if ('collins:%d'%collins) in levels:
+                add('collins:%d'%collins, count)
+            if record.get('oxford'):
+                add('oxford', count)
+            for rank in ('frq', 'bnc'):
+                value = record.get(rank) or 0
+                if value <= 0:
+                    continue
+                for n in PROFILE_RANKS:
+                    if value <= n:
+                        add('%s<=%d'%(rank, n), count)
+        result = []
+        for name, (words, count) in levels.items():
+            ratio = total and (count * 100.0 / total) or 0.0
+            result.append((name, words, count, ratio))
+        return result
+
+    # 词典里查不到的单词，按出现次数从多到少排序
+    def unknown (self):
+        words = [ (-c, w) for w, c in self.counts.items()
+                if self.records.get(w) is None ]
+        words.sort()
+        return [ (w, -c) for c, w in words ]
+
+    # 生成文本报告
+    def report (self):
+        total = sum(self.counts.values())
+        lines = []
+        lines.append('tokens: %d, lemmas: %d'%(total, len(self.counts)))
+        lines.append('')
+        lines.append('%-12s %10s %12s %8s'%('level', 'lemmas', 'tokens',
+            'coverage'))
+        for name, words, count, ratio in self.coverage():
+            lines.append('%-12s %10d %12d %7.2f%%'%(name, words, count,
+                ratio))
+        return '\n'.join(lines)
+
+
+#----------------------------------------------------------------------
+# 命令行
+#----------------------------------------------------------------------
+def main(argv = None):
+    import argparse
+    argv = argv or sys.argv[1:]
+    parser = argparse.ArgumentParser(prog = 'profiler.py',
+            description = 'vocabulary profile of english documents')
+    parser.add_argument('files', nargs = '*',
+            help = 'text files, read stdin when omitted')
+    parser.add_argument('-d', '--dict', default = 'ecdict.csv',
+            help = 'dictionary file (.db, .csv or mysql://...)')
+    parser.add_argument('-l', '--lemma', default = 'lemma.en.txt',
+            help = 'lemma.en.txt or a file written by LemmaDB.freeze()')
+    parser.add_argument('-j', '--jobs', type = int, default = 0,
+            help = 'number of worker processes (default: cpu count)')
+    parser.add_argument('-e', '--encoding', default = 'utf-8')
+    parser.add_argument('-u', '--unknown', default = None,
+            help = 'write unknown words with their counts to this file')
+    args = parser.parse_args(argv)
+    if args.dict[:8] != 'mysql://' and not os.path.exists(args.dict):
+        print('can not open dictionary: %s'%args.dict, file = sys.stderr)
+        return 1
+    dictionary = stardict.open_dict(args.dict)
+    profiler = Profiler(dictionary, args.lemma, args.jobs)
+    profiler.feed(args.files or [ None ], args.encoding)
+    profiler.lookup()
+    print(profiler.report())
+    unknown = profiler.unknown()
+    if args.unknown:
+        with io.open(args.unknown, 'w', encoding = 'utf-8') as fp:
+            for word, count in unknown:
+                fp.write(u'%s\t%d\n'%(word, count))
+    else:
+        print('')
+        print('unknown: %s'%(', '.join([ w for w, _ in unknown[:50] ])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
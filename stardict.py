@@ -14,9 +14,21 @@ import sys
 import time
 import os
 import io
+import re
 import csv
 import sqlite3
 import codecs
+import threading
+import contextlib
+import collections
+import weakref
+import unicodedata
+import heapq
+import bisect
+import struct
+import zlib
+import mmap
+import array
 
 try:
     import json
@@ -33,6 +45,22 @@ if sys.version_info[0] >= 3:
     unicode = str
     long = int
     xrange = range
+    unichr = chr
+
+
+#----------------------------------------------------------------------
+# batch query: keys per IN (...) chunk, and above which a join is used
+# (the SQLITE_MAX_VARIABLE_NUMBER is 999 in older versions)
+#----------------------------------------------------------------------
+BATCH_CHUNK_SIZE = 500
+BATCH_JOIN_SIZE = 2000
+
+
+#----------------------------------------------------------------------
+# readonly mode: mmap size in bytes, page cache size (negative means KiB)
+#----------------------------------------------------------------------
+READONLY_MMAP_SIZE = 1 << 30
+READONLY_CACHE_SIZE = -65536
 
 
 #----------------------------------------------------------------------
@@ -42,53 +70,889 @@ def stripword(word):
     return (''.join([ n for n in word if n.isalnum() ])).lower()
 
 
+#----------------------------------------------------------------------
+# SQLite 的 COLLATE NOCASE 只折叠 ASCII 字母的大小写
+#----------------------------------------------------------------------
+NOCASE_TABLE = dict([ (n, n + 32) for n in range(ord('A'), ord('Z') + 1) ])
+
+def nocase(word):
+    return word.translate(NOCASE_TABLE)
+
+# MySQL 的 utf8_general_ci 还会忽略重音符号和尾部空格
+def general_ci(word):
+    if not isinstance(word, unicode):
+        word = word.decode('utf-8')
+    text = unicodedata.normalize('NFD', word)
+    text = ''.join([ n for n in text if not unicodedata.combining(n) ])
+    return text.lower().rstrip(' ')
+
+
+#----------------------------------------------------------------------
+# 把一个序列切分成若干个不超过 size 的列表
+#----------------------------------------------------------------------
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+#----------------------------------------------------------------------
+# StarDict 表结构版本，保存在 PRAGMA user_version 里：
+#   1 - 最早的表结构（user_version 为 0），id/word 上有多个重复的索引
+#   2 - 去掉 stardict_1, stardict_2, sd_1 以及 id 上多余的 UNIQUE
+#   3 - 增加反转的 sw 列 rsw 及其索引，用于后缀查询
+#   4 - 增加读音编码列 sound（Metaphone）及其索引，用于同音词查询
+#   5 - 增加变位词键值列 anagram_key 及其索引，用于变位词查询
+# 老数据库打开后照常使用，用 StarDict.upgrade() 或者 migrate_dict() 升级
+#----------------------------------------------------------------------
+SCHEMA_VERSION = 5
+
+SCHEMA_TABLE = {
+    1: '''
+    CREATE TABLE IF NOT EXISTS "stardict" (
+        "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE,
+        "word" VARCHAR(64) COLLATE NOCASE NOT NULL UNIQUE,
+        "sw" VARCHAR(64) COLLATE NOCASE NOT NULL,
+        "phonetic" VARCHAR(64),
+        "definition" TEXT,
+        "translation" TEXT,
+        "pos" VARCHAR(16),
+        "collins" INTEGER DEFAULT(0),
+        "oxford" INTEGER DEFAULT(0),
+        "tag" VARCHAR(64),
+        "bnc" INTEGER DEFAULT(NULL),
+        "frq" INTEGER DEFAULT(NULL),
+        "exchange" TEXT,
+        "detail" TEXT,
+        "audio" TEXT
+    );
+    ''',
+    2: '''
+    CREATE TABLE IF NOT EXISTS "stardict" (
+        "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        "word" VARCHAR(64) COLLATE NOCASE NOT NULL UNIQUE,
+        "sw" VARCHAR(64) COLLATE NOCASE NOT NULL,
+        "phonetic" VARCHAR(64),
+        "definition" TEXT,
+        "translation" TEXT,
+        "pos" VARCHAR(16),
+        "collins" INTEGER DEFAULT(0),
+        "oxford" INTEGER DEFAULT(0),
+        "tag" VARCHAR(64),
+        "bnc" INTEGER DEFAULT(NULL),
+        "frq" INTEGER DEFAULT(NULL),
+        "exchange" TEXT,
+        "detail" TEXT,
+        "audio" TEXT
+    );
+    ''',
+}
+
+# 反转的 sw，后缀查询变成 rsw 上的前缀查询
+def reverse_word(word):
+    return stripword(word)[::-1]
+
+# 变位词的键值：sw 里的字符排好序，由相同字母组成的单词键值相同
+def anagram_key(word):
+    return ''.join(sorted(stripword(word)))
+
+# 子集变位词：letters 的每个子多重集（排好序）都可能是一个键值，按
+# 字母顺序深度优先枚举，依次决定每个字母用几次。seek(prefix) 返回
+# 索引里第一个不小于 prefix 的键值（没有时为 None），没有键值以当前
+# 前缀开头的分支直接剪掉，返回索引里存在的全部键值
+def anagram_subkeys(letters, seek):
+    counts = []
+    for ch in anagram_key(letters):
+        if counts and counts[-1][0] == ch:
+            counts[-1][1] += 1
+        else:
+            counts.append([ch, 1])
+    found = []
+    def search(start, prefix):
+        for i in xrange(start, len(counts)):
+            ch, count = counts[i]
+            for n in xrange(1, count + 1):
+                key = prefix + ch * n
+                head = seek(key)
+                if head is None or not head.startswith(key):
+                    break
+                if head == key:
+                    found.append(key)
+                search(i + 1, key)
+    search(0, '')
+    return found
+
+# 判断 key 是不是 letters 的子多重集（两者都是排好序的键值）
+def anagram_subset(key, letters):
+    pos = 0
+    for ch in key:
+        pos = letters.find(ch, pos)
+        if pos < 0:
+            return False
+        pos += 1
+    return True
+
+
+#----------------------------------------------------------------------
+# Metaphone 读音编码（Lawrence Philips, 1990），读音相近的单词编码相同，
+# 比如 phone 和 fone 都是 FN，只处理英文字母，0 代表 th
+#----------------------------------------------------------------------
+METAPHONE_VOWELS = 'AEIOU'
+
+def metaphone(word):
+    w = ''.join([ c for c in word.upper() if 'A' <= c <= 'Z' ])
+    if not w:
+        return ''
+    if w[:2] in ('AE', 'GN', 'KN', 'PN', 'WR'):
+        w = w[1:]
+    if w[:1] == 'X':
+        w = 'S' + w[1:]
+    elif w[:2] == 'WH':
+        w = 'W' + w[2:]
+    vowels = METAPHONE_VOWELS
+    size = len(w)
+    output = []
+    for i in xrange(size):
+        c = w[i]
+        prev = w[i - 1:i]
+        next1 = w[i + 1:i + 2]
+        next2 = w[i + 2:i + 3]
+        if c == prev and c != 'C':
+            continue
+        if c in vowels:
+            if i == 0:
+                output.append(c)
+        elif c == 'B':
+            if not (prev == 'M' and i == size - 1):
+                output.append('B')
+        elif c == 'C':
+            if next1 == 'H' or (next1 == 'I' and next2 == 'A'):
+                if prev == 'S' and next1 == 'H':
+                    output.append('K')
+                else:
+                    output.append('X')
+            elif next1 and next1 in 'IEY':
+                if prev != 'S':
+                    output.append('S')
+            else:
+                output.append('K')
+        elif c == 'D':
+            if next1 == 'G' and next2 and next2 in 'IEY':
+                output.append('J')
+            else:
+                output.append('T')
+        elif c == 'G':
+            if next1 == 'H' and next2 and next2 not in vowels:
+                pass
+            elif next1 == 'N' and (i + 2 == size or 
+                    (w[i + 2:] == 'ED')):
+                pass
+            elif prev == 'D' and next1 and next1 in 'IEY':
+                pass
+            elif next1 and next1 in 'IEY' and prev != 'G':
+                output.append('J')
+            else:
+                output.append('K')
+        elif c == 'H':
+            if prev and prev in 'CSPTG':
+                pass
+            elif prev and prev in vowels and not (next1 and next1 in vowels):
+                pass
+            else:
+                output.append('H')
+        elif c == 'K':
+            if prev != 'C':
+                output.append('K')
+        elif c == 'P':
+            output.append(next1 == 'H' and 'F' or 'P')
+        elif c == 'Q':
+            output.append('K')
+        elif c == 'S':
+            if next1 == 'H' or (next1 == 'I' and next2 in ('O', 'A')):
+                output.append('X')
+            else:
+                output.append('S')
+        elif c == 'T':
+            if next1 == 'I' and next2 in ('O', 'A'):
+                output.append('X')
+            elif next1 == 'H':
+                output.append('0')
+            elif not (next1 == 'C' and next2 == 'H'):
+                output.append('T')
+        elif c == 'V':
+            output.append('F')
+        elif c in 'WY':
+            if next1 and next1 in vowels:
+                output.append(c)
+        elif c == 'X':
+            output.append('KS')
+        elif c == 'Z':
+            output.append('S')
+        else:
+            output.append(c)
+    return ''.join(output)
+
+# 第 3 版开始新增的列：(名称, 类型, 根据单词计算列值的函数)，
+# 升级时用 ALTER TABLE 加在表格的最后
+SCHEMA_COLUMNS = {
+    3: (('rsw', 'VARCHAR(64) COLLATE NOCASE', reverse_word),),
+    4: (('sound', 'VARCHAR(64)', metaphone),),
+    5: (('anagram_key', 'VARCHAR(64)', anagram_key),),
+}
+
+# 某个版本在基础表结构之外新增的全部列
+def schema_columns(version):
+    columns = []
+    for v in sorted(SCHEMA_COLUMNS):
+        if v <= version:
+            columns.extend(SCHEMA_COLUMNS[v])
+    return tuple(columns)
+
+# 某个版本建表的 SQL
+def schema_table(version):
+    if version < 2:
+        return SCHEMA_TABLE[1]
+    sql = SCHEMA_TABLE[2]
+    pos = sql.rfind(')')
+    head = sql[:pos].rstrip()
+    for name, desc, _ in schema_columns(version):
+        head += ',\n        "%s" %s'%(name, desc)
+    return head + '\n    ' + sql[pos:]
+
+# 各版本的二级索引：(名称, 定义, 是否唯一)，word 上的查询和 match
+# 使用 UNIQUE 约束自带的索引（列本身是 NOCASE）
+SCHEMA_INDEXES = {
+    1: (
+        ('stardict_1', 'ON stardict (id)', True),
+        ('stardict_2', 'ON stardict (word)', True),
+        ('stardict_3', 'ON stardict (sw, word collate nocase)', False),
+        ('sd_1', 'ON stardict (word collate nocase)', False),
+    ),
+    2: (
+        ('stardict_3', 'ON stardict (sw, word collate nocase)', False),
+    ),
+    3: (
+        ('stardict_3', 'ON stardict (sw, word collate nocase)', False),
+        ('stardict_4', 'ON stardict (rsw)', False),
+    ),
+    4: (
+        ('stardict_3', 'ON stardict (sw, word collate nocase)', False),
+        ('stardict_4', 'ON stardict (rsw)', False),
+        ('stardict_5', 'ON stardict (sound)', False),
+    ),
+    5: (
+        ('stardict_3', 'ON stardict (sw, word collate nocase)', False),
+        ('stardict_4', 'ON stardict (rsw)', False),
+        ('stardict_5', 'ON stardict (sound)', False),
+        ('stardict_6', 'ON stardict (anagram_key)', False),
+    ),
+}
+
+# 生成创建二级索引的 SQL
+def index_sql(indexes):
+    sql = ''
+    for name, desc, unique in indexes:
+        head = unique and 'CREATE UNIQUE INDEX' or 'CREATE INDEX'
+        sql += '%s IF NOT EXISTS "%s" %s;\n'%(head, name, desc)
+    return sql
+
+
+#----------------------------------------------------------------------
+# 排序方式：frq/bnc 是词频排名（越小越常用，0 或 NULL 表示没有数据），
+# collins/oxford 越大越重要，返回 ORDER BY 后面的 SQL 片段
+#----------------------------------------------------------------------
+def rank_order(rank = 'frq', prefix = ''):
+    if rank in ('frq', 'bnc'):
+        name = prefix + rank
+        return '(%s IS NULL OR %s <= 0), %s'%(name, name, name)
+    elif rank in ('collins', 'oxford'):
+        name = prefix + rank
+        return '%s DESC, %s'%(name, rank_order('frq', prefix))
+    raise ValueError('unknown rank: %s'%rank)
+
+# rank_order 的 Python 版本，返回排序用的 key 函数，参数 get(name)
+# 返回对应字段的数值（可以是 None）
+def rank_key(rank = 'frq'):
+    if rank in ('frq', 'bnc'):
+        def key(get):
+            x = get(rank)
+            if x is None:
+                return (True, float('-inf'))
+            return (x <= 0, x)
+        return key
+    elif rank in ('collins', 'oxford'):
+        order = rank_key('frq')
+        def key(get):
+            x = get(rank)
+            return ((x is None) and float('inf') or -x, order(get))
+        return key
+    raise ValueError('unknown rank: %s'%rank)
+
+# 补全表（StarDict.complete_build）预先计算的排序方式
+COMPLETE_RANKS = ('frq', 'bnc')
+
+# 前缀范围的上界（不包含）：最后一个字符加一，key 需要先转成小写
+def prefix_upper(key):
+    return key[:-1] + unichr(ord(key[-1]) + 1)
+
+
+#----------------------------------------------------------------------
+# 通配符查询：? 匹配一个字符，* 匹配任意多个字符，不区分大小写
+#----------------------------------------------------------------------
+
+# 模式里第一个通配符之前的字面前缀和最后一个通配符之后的字面后缀
+def pattern_literals(pattern):
+    marks = [ n for n in (pattern.find('?'), pattern.find('*')) if n >= 0 ]
+    if not marks:
+        return pattern, pattern
+    tail = max(pattern.rfind('?'), pattern.rfind('*'))
+    return pattern[:min(marks)], pattern[tail + 1:]
+
+# 转成 SQLite 的 GLOB 模式（和 lower(word) 比较），[ 需要转义
+def pattern_glob(pattern):
+    return nocase(pattern).replace('[', '[[]')
+
+# 转成 MySQL 的 LIKE 模式
+def pattern_like(pattern):
+    output = []
+    for ch in pattern:
+        if ch == '*':
+            output.append('%')
+        elif ch == '?':
+            output.append('_')
+        elif ch in ('%', '_', '\\'):
+            output.append('\\' + ch)
+        else:
+            output.append(ch)
+    return ''.join(output)
+
+# 编译成正则表达式，用来匹配小写的单词
+def pattern_regex(pattern):
+    output = []
+    for ch in pattern.lower():
+        if ch == '*':
+            output.append('.*')
+        elif ch == '?':
+            output.append('.')
+        else:
+            output.append(re.escape(ch))
+    return re.compile(''.join(output) + r'\Z', re.S)
+
+
+#----------------------------------------------------------------------
+# 韵脚：从最后一个重读音节的元音开始到结尾的部分，英式音标和转换
+# 出来的美式音标各算一个
+#----------------------------------------------------------------------
+PHONETIC_REPLACE = (
+    (u'ә', u'ə'), (u'ǝ', u'ə'), (u':', u'ː'), (u'ɡ', u'g'),
+    (u"'", u'ˈ'), (u'ˊ', u'ˈ'), (u'`', u'ˈ'), (u'′', u'ˈ'), (u'’', u'ˈ'),
+    (u',', u'ˌ'), (u'ε', u'ɛ'),
+    (u'ei', u'eɪ'), (u'ai', u'aɪ'), (u'ɔi', u'ɔɪ'), 
+    (u'au', u'aʊ'), (u'əu', u'əʊ'),
+)
+
+# 老式写法里不带长音符号的 i 和 u 是短元音
+PHONETIC_SHORT = ((re.compile(u'i(?!ː)'), u'ɪ'), (re.compile(u'u(?!ː)'), u'ʊ'))
+
+PHONETIC_STRIP = re.compile(u'[\\[\\]/()\\-.ˑ]')
+
+RHYME_VOWELS = u'aeiouyæɑɒɔəɛɜɪʊʌɝɚɐɨʉøœ'
+
+def british_to_american_phonetic(uk_phonetic):
+    """英式音标转美式音标"""
+    if not uk_phonetic:
+        return ""
+    us_phonetic = uk_phonetic
+    us_phonetic = us_phonetic.replace(u'ɒ', u'ɑ')
+    us_phonetic = us_phonetic.replace(u'ɑː', u'ɑ')
+    us_phonetic = us_phonetic.replace(u'ɔː', u'ɔ')
+    us_phonetic = us_phonetic.replace(u'ɪə', u'ɪr')
+    us_phonetic = us_phonetic.replace(u'eə', u'ɛr')
+    us_phonetic = us_phonetic.replace(u'ʊə', u'ʊr')
+    us_phonetic = us_phonetic.replace(u'ɜː', u'ɝ')
+    us_phonetic = us_phonetic.replace(u'uː', u'u')
+    us_phonetic = us_phonetic.replace(u'iː', u'i')
+    us_phonetic = re.sub(u'ə$', u'ər', us_phonetic)
+    return us_phonetic
+
+# 统一音标的写法（各种重音符号、长音符号、俄文的 ә、老式的双元音
+# 等），词组只取最后一个词
+def phonetic_normalize(phonetic):
+    if not phonetic:
+        return ''
+    text = phonetic.strip().lower()
+    for src, dst in PHONETIC_REPLACE:
+        text = text.replace(src, dst)
+    text = PHONETIC_STRIP.sub('', text)
+    for pattern, dst in PHONETIC_SHORT:
+        text = pattern.sub(dst, text)
+    parts = text.split()
+    return parts and parts[-1] or ''
+
+# 一个音标的韵脚：最后一个主重音（没有的话次重音，都没有就是单音节）
+# 之后的第一个元音开始到结尾，去掉重音符号
+def rhyme_tail(phonetic):
+    if not phonetic:
+        return ''
+    pos = phonetic.rfind(u'ˈ')
+    if pos < 0:
+        pos = phonetic.rfind(u'ˌ')
+    for i in xrange(max(pos, 0), len(phonetic)):
+        if phonetic[i] in RHYME_VOWELS:
+            tail = phonetic[i:].replace(u'ˈ', '').replace(u'ˌ', '')
+            return tail[:64]
+    return ''
+
+# 一个单词的全部韵脚：英式和美式（相同时只有一个）
+def rhyme_keys(phonetic):
+    text = phonetic_normalize(phonetic)
+    keys = []
+    for form in (text, british_to_american_phonetic(text)):
+        tail = rhyme_tail(form)
+        if tail and tail not in keys:
+            keys.append(tail)
+    return keys
+
+
+#----------------------------------------------------------------------
+# 词形反查：exchange 里 p/d/i/3/r/t/s 是这个单词的各种变形，0 是它的
+# 原型（1 是它属于原型的哪一类变形），都展开成 (form, lemma, type)
+#----------------------------------------------------------------------
+LEMMA_TYPES = ('p', 'd', 'i', '3', 'r', 't', 's')
+
+def exchange_lemmas(word, exchange):
+    if not word or not exchange:
+        return []
+    obj = {}
+    for text in exchange.split('/'):
+        pos = text.find(':')
+        if pos < 0:
+            continue
+        obj[text[:pos].strip()] = text[pos + 1:].strip()
+    rows = []
+    forms = {}
+    # 相同的变形（比如过去式和过去分词）合并成一行，类别连在一起
+    for name in LEMMA_TYPES:
+        form = obj.get(name)
+        if not form or form.lower() == word.lower():
+            continue
+        if form.lower() in forms:
+            forms[form.lower()][2] += name
+        else:
+            forms[form.lower()] = [ form, word, name ]
+            rows.append(forms[form.lower()])
+    lemma = obj.get('0')
+    if lemma and lemma.lower() != word.lower():
+        rows.append([ word, lemma, obj.get('1', '') ])
+    return [ tuple(n) for n in rows ]
+
+
+#----------------------------------------------------------------------
+# 全文检索分词：连续的汉字切分成二元组（末尾再加一个单字），
+# 其他文字交给 FTS5 的 unicode61 分词器处理
+#----------------------------------------------------------------------
+CJK_PATTERN = re.compile(u'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+
+def cjk_bigrams(text):
+    if len(text) < 2:
+        return [ text ]
+    return [ text[i:i + 2] for i in xrange(len(text) - 1) ]
+
+def cjk_tokens(text):
+    if not text:
+        return text
+    def replace(m):
+        part = m.group(0)
+        if len(part) == 1:
+            return ' ' + part + ' '
+        return ' ' + ' '.join(cjk_bigrams(part) + [ part[-1] ]) + ' '
+    return CJK_PATTERN.sub(replace, text)
+
+# 把检索文本转换为 FTS5 的 MATCH 表达式，各部分之间是 AND 的关系
+def cjk_query(text):
+    terms = []
+    pattern = u'(%s)|(\\w+)'%CJK_PATTERN.pattern
+    for m in re.finditer(pattern, text, re.U):
+        han, word = m.groups()
+        if not han:
+            terms.append('"%s"'%word)
+        elif len(han) == 1:
+            terms.append('"%s" *'%han)
+        else:
+            terms.append('"%s"'%' '.join(cjk_bigrams(han)))
+    return ' '.join(terms)
+
+
+#----------------------------------------------------------------------
+# detail 字段的 json 解码
+#----------------------------------------------------------------------
+def detail_loads(text):
+    if not text:
+        return text
+    text = zlib_loads(text)
+    try:
+        obj = json.loads(text)
+    except:
+        obj = None
+    return obj
+
+
+#----------------------------------------------------------------------
+# 字段压缩：definition/translation/detail 用带预设字典的 zlib 压缩成
+# BLOB 保存，zlib 头部带有预设字典的 adler32（DICTID），解压时据此在
+# ZLIB_DICTS 中找到对应的预设字典，压缩后没有变小的值仍然保存为文本
+#----------------------------------------------------------------------
+ZLIB_FIELDS = ('definition', 'translation', 'detail')
+ZLIB_DICTS = {}
+ZLIB_TOKEN = re.compile(r'\S+\s*', re.U)
+
+# 登记预设字典，返回它的 DICTID
+def zlib_register(zdict):
+    dictid = zlib.adler32(zdict) & 0xffffffff
+    ZLIB_DICTS[dictid] = zdict
+    return dictid
+
+# 压缩文本，返回 bytes，没有变小则返回原文；python 2 的 zlib 不支持
+# 预设字典，这时也返回原文，按普通文本保存
+def zlib_dumps(text, zdict = None):
+    if not text:
+        return text
+    if zdict and sys.version_info[0] < 3:
+        return text
+    data = text.encode('utf-8')
+    if zdict:
+        obj = zlib.compressobj(9, zlib.DEFLATED, 15, 9, 
+                zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        obj = zlib.compressobj(9)
+    blob = obj.compress(data) + obj.flush()
+    if len(blob) >= len(data):
+        return text
+    return blob
+
+# 解压 zlib_dumps 的结果，不是 bytes 的值原样返回；python 2 的 zlib
+# 不支持预设字典，读到压缩字段（sqlite3 返回 buffer）时直接报错
+def zlib_loads(blob):
+    if sys.version_info[0] < 3:
+        if isinstance(blob, buffer):
+            raise ValueError('compressed field needs python 3')
+        return blob
+    if not isinstance(blob, bytes):
+        return blob
+    zdict = None
+    if len(blob) >= 6 and (bytearray(blob[1:2])[0] & 0x20):
+        dictid = struct.unpack('>I', blob[2:6])[0]
+        zdict = ZLIB_DICTS.get(dictid)
+        if zdict is None:
+            raise KeyError('unknown zlib dictionary: %08x'%dictid)
+    if zdict:
+        obj = zlib.decompressobj(15, zdict)
+    else:
+        obj = zlib.decompressobj()
+    return (obj.decompress(blob) + obj.flush()).decode('utf-8')
+
+# 根据样本训练预设字典：按 出现次数 x 长度 挑出收益最大的片段，
+# 最常用的放在最后（离被压缩的数据最近，匹配距离最短）
+def zlib_train(texts, size = 32768):
+    counter = collections.Counter()
+    for text in texts:
+        if text:
+            counter.update(ZLIB_TOKEN.findall(text))
+    tokens = []
+    for token, count in counter.items():
+        if count > 1:
+            data = token.encode('utf-8')
+            if len(data) >= 3:
+                tokens.append((count * len(data), data))
+    tokens.sort(key = lambda n: n[0], reverse = True)
+    chunks = []
+    total = 0
+    for _, data in tokens:
+        if total + len(data) > size:
+            continue
+        chunks.append(data)
+        total += len(data)
+    chunks.reverse()
+    return b''.join(chunks)
+
+
+#----------------------------------------------------------------------
+# LazyRecord: 查询返回的单词数据，detail 字段第一次访问时才解码
+#----------------------------------------------------------------------
+class LazyRecord (dict):
+
+    __slots__ = ('_pending',)
+
+    def __init__ (self, items, pending = False):
+        dict.__init__(self, items)
+        self._pending = pending
+
+    def __resolve (self):
+        if self._pending:
+            self._pending = False
+            text = dict.get(self, 'detail')
+            dict.__setitem__(self, 'detail', detail_loads(text))
+        return self
+
+    def __getitem__ (self, key):
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return dict.__getitem__(self, key)
+
+    def __setitem__ (self, key, value):
+        if key == 'detail':
+            self._pending = False
+        dict.__setitem__(self, key, value)
+
+    def get (self, key, default = None):
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return dict.get(self, key, default)
+
+    def pop (self, key, *args):
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return dict.pop(self, key, *args)
+
+    def setdefault (self, key, default = None):
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return dict.setdefault(self, key, default)
+
+    def __iter__ (self):
+        return dict.__iter__(self.__resolve())
+
+    def keys (self):
+        return dict.keys(self.__resolve())
+
+    def values (self):
+        return dict.values(self.__resolve())
+
+    def items (self):
+        return dict.items(self.__resolve())
+
+    def copy (self):
+        return dict(self.__resolve())
+
+    def __eq__ (self, other):
+        if isinstance(other, LazyRecord):
+            other.__resolve()
+        return dict.__eq__(self.__resolve(), other)
+
+    def __ne__ (self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__ (self):
+        return dict.__repr__(self.__resolve())
+
+    def __reduce__ (self):
+        return (dict, (dict(self.__resolve()),))
+
+
+#----------------------------------------------------------------------
+# WordRecord: 紧凑的单词数据，字段值直接保存在数据库返回的 tuple 里，
+# 字段名到下标的映射由同一次查询的所有记录共享，读取接口和字典一致
+#----------------------------------------------------------------------
+class WordRecord (object):
+
+    __slots__ = ('_index', '_values', '_pending')
+
+    def __init__ (self, index, values):
+        self._index = index
+        self._values = values
+        self._pending = False
+        pos = index.get('detail')
+        if pos is not None and values[pos]:
+            self._pending = True
+
+    def __resolve (self):
+        pos = self._index['detail']
+        values = self._values
+        value = detail_loads(values[pos])
+        self._values = values[:pos] + (value,) + values[pos + 1:]
+        self._pending = False
+
+    def __getitem__ (self, key):
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return self._values[self._index[key]]
+
+    def __setitem__ (self, key, value):
+        pos = self._index[key]
+        if key == 'detail':
+            self._pending = False
+        values = self._values
+        self._values = values[:pos] + (value,) + values[pos + 1:]
+
+    def get (self, key, default = None):
+        pos = self._index.get(key)
+        if pos is None:
+            return default
+        if self._pending and key == 'detail':
+            self.__resolve()
+        return self._values[pos]
+
+    def __contains__ (self, key):
+        return key in self._index
+
+    def __iter__ (self):
+        return iter(self._index)
+
+    def __len__ (self):
+        return len(self._index)
+
+    def keys (self):
+        return self._index.keys()
+
+    def values (self):
+        return [ self[k] for k in self._index ]
+
+    def items (self):
+        return [ (k, self[k]) for k in self._index ]
+
+    def copy (self):
+        return dict(self.items())
+
+    def __eq__ (self, other):
+        if isinstance(other, (dict, WordRecord)):
+            return dict(self.items()) == dict(other.items())
+        return False
+
+    def __ne__ (self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__ (self):
+        return 'WordRecord(%r)'%dict(self.items())
+
+    def __getstate__ (self):
+        return (self._index, self._values, self._pending)
+
+    def __setstate__ (self, state):
+        self._index, self._values, self._pending = state
+
+
+# 字段名序列转换为 WordRecord 使用的 名字->下标 映射
+def record_index(names):
+    return dict([ (n, i) for i, n in enumerate(names) ])
+
+
+#----------------------------------------------------------------------
+# 并发模式下线程的读连接：保存在线程的 threading.local 里，线程退出后
+# 对象被释放时关闭连接；StarDict 用弱引用记录它们，close() 时关闭剩下的
+#----------------------------------------------------------------------
+class ReaderConnection (object):
+
+    def __init__ (self, conn):
+        self.conn = conn
+
+    def close (self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __del__ (self):
+        self.close()
+
+
+#----------------------------------------------------------------------
+# 附属索引依赖的字段：update 只改了其他字段时不用刷新这个索引
+#----------------------------------------------------------------------
+DERIVED_FIELDS = {
+    'fts': ('translation', 'definition'),
+    'complete': ('frq', 'bnc'),
+    'rhyme': ('phonetic',),
+    'lemma': ('exchange',),
+    'spell': ('frq',),
+}
+
+
 #----------------------------------------------------------------------
 # StarDict 
 #----------------------------------------------------------------------
 class StarDict (object):
 
-    def __init__ (self, filename, verbose = False):
+    def __init__ (self, filename, verbose = False, concurrent = False, 
+            compact = False, readonly = False):
         self.__dbname = filename
+        self.__dbpath = filename
         if filename != ':memory:':
-            os.path.abspath(filename)
+            self.__dbpath = os.path.abspath(filename)
         self.__conn = None
         self.__verbose = verbose
+        # 并发模式：WAL 日志，每个线程一个只读连接，写入共用一个连接；
+        # commit = False 的写入不分线程，都在写连接的同一个事务里，
+        # 任何一个线程 commit() 都会把它们一起提交
+        self.__concurrent = concurrent and (filename != ':memory:')
+        # 只读模式：用于发布后不再修改的词典，不建表，不加写锁，使用 mmap
+        self.__readonly = readonly and (filename != ':memory:')
+        self.__local = threading.local()
+        self.__readers = weakref.WeakSet()
+        self.__lock = threading.RLock()
+        self.__owner = None
+        self.__json = None
+        # 紧凑模式：查询返回 WordRecord 而不是字典
+        self.__compact = compact
+        self.__recindex = {}
+        # 附属索引（全文检索等），写入单词时同步更新，批量导入时最后重建
+        self.__derived = []
+        # 老的全文索引自己保存一份 translation/definition（不是 content=''）
+        self.__fts_legacy = False
+        self.__bulk = False
+        # 字段压缩使用的预设字典，compress_build() 之后才有
+        self.__zdict = None
+        # stardict_meta 表里保存的设置
+        self.__meta = {}
+        # 拼写建议索引（SpellIndex），保存在数据库文件名加 .spell 的文件里
+        self.__spell = None
         self.__open()
 
     # 初始化并创建必要的表格和索引
     def __open (self):
-        sql = '''
-        CREATE TABLE IF NOT EXISTS "stardict" (
-            "id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE,
-            "word" VARCHAR(64) COLLATE NOCASE NOT NULL UNIQUE,
-            "sw" VARCHAR(64) COLLATE NOCASE NOT NULL,
-            "phonetic" VARCHAR(64),
-            "definition" TEXT,
-            "translation" TEXT,
-            "pos" VARCHAR(16),
-            "collins" INTEGER DEFAULT(0),
-            "oxford" INTEGER DEFAULT(0),
-            "tag" VARCHAR(64),
-            "bnc" INTEGER DEFAULT(NULL),
-            "frq" INTEGER DEFAULT(NULL),
-            "exchange" TEXT,
-            "detail" TEXT,
-            "audio" TEXT
-        );
-        CREATE UNIQUE INDEX IF NOT EXISTS "stardict_1" ON stardict (id);
-        CREATE UNIQUE INDEX IF NOT EXISTS "stardict_2" ON stardict (word);
-        CREATE INDEX IF NOT EXISTS "stardict_3" ON stardict (sw, word collate nocase);
-        CREATE INDEX IF NOT EXISTS "sd_1" ON stardict (word collate nocase);
-        '''
-
-        self.__conn = sqlite3.connect(self.__dbname, isolation_level = "IMMEDIATE")
-        self.__conn.isolation_level = "IMMEDIATE"
-
-        sql = '\n'.join([ n.strip('\t') for n in sql.split('\n') ])
-        sql = sql.strip('\n')
-
-        self.__conn.executescript(sql)
-        self.__conn.commit()
+        if self.__readonly:
+            self.__conn = self.__connect_readonly()
+        elif not self.__concurrent:
+            self.__conn = sqlite3.connect(self.__dbname, 
+                    isolation_level = "IMMEDIATE")
+        else:
+            self.__conn = sqlite3.connect(self.__dbname, 
+                    isolation_level = "IMMEDIATE", check_same_thread = False)
+            self.__conn.execute('PRAGMA journal_mode = WAL;')
+            self.__conn.execute('PRAGMA synchronous = NORMAL;')
+
+        sql = "select name from sqlite_master where name = 'stardict';"
+        exists = self.__conn.execute(sql).fetchone() is not None
+        version = self.__conn.execute('PRAGMA user_version;').fetchone()[0]
+        if not exists:
+            version = SCHEMA_VERSION
+        if version > SCHEMA_VERSION:
+            # 更新的程序写入的数据库，不知道新增的列，不能打开
+            self.__conn.close()
+            self.__conn = None
+            text = '%s: schema version %d is newer than supported (%d)'
+            raise ValueError(text%(self.__dbname, version, SCHEMA_VERSION))
+        self.__version = max(version, 1)
+        # 二级索引，批量导入（bulk_load）时会先删除，导入完成后重建
+        self.__indexes = SCHEMA_INDEXES[self.__version]
+
+        if not self.__readonly:
+            if not exists:
+                sql = schema_table(self.__version) + self.__index_sql()
+                sql += 'PRAGMA user_version = %d;'%self.__version
+            else:
+                sql = self.__index_sql()
+            sql = '\n'.join([ n.strip('\t') for n in sql.split('\n') ])
+            sql = sql.strip('\n')
+            self.__conn.executescript(sql)
+            self.__conn.commit()
 
         fields = ( 'id', 'word', 'sw', 'phonetic', 'definition', 
             'translation', 'pos', 'collins', 'oxford', 'tag', 'bnc', 'frq', 
@@ -98,29 +962,228 @@ class StarDict (object):
         for k, v in self.__fields:
             self.__names[k] = v
         self.__enable = self.__fields[3:]
+        self.__defaults = { 'collins': 0, 'oxford': 0 }
+        self.__prepare()
+        self.__projection = {}
+        sql = "select sql from sqlite_master where name = 'stardict_fts';"
+        record = self.__conn.execute(sql).fetchone()
+        if record:
+            self.__derived.append('fts')
+            self.__fts_legacy = ("content" not in record[0])
+        sql = "select name from sqlite_master where name = 'stardict_meta';"
+        if self.__conn.execute(sql).fetchone():
+            sql = 'select name, value from stardict_meta;'
+            for name, value in self.__conn.execute(sql):
+                self.__meta[name] = value
+        if self.__meta.get('zdict'):
+            self.__zdict = bytes(self.__meta['zdict'])
+            zlib_register(self.__zdict)
+            if sys.version_info[0] < 3 and not self.__readonly:
+                self.out('compressed fields need python 3, '
+                        'new values are stored as plain text')
+        sql = "select name from sqlite_master where name = 'stardict_complete';"
+        if self.__conn.execute(sql).fetchone():
+            self.__derived.append('complete')
+        sql = "select name from sqlite_master where name = 'stardict_rhyme';"
+        if self.__conn.execute(sql).fetchone():
+            self.__derived.append('rhyme')
+        sql = "select name from sqlite_master where name = 'stardict_lemma';"
+        if self.__conn.execute(sql).fetchone():
+            self.__derived.append('lemma')
+        if self.__dbpath != ':memory:':
+            if os.path.exists(self.__dbpath + '.spell'):
+                self.__spell = SpellIndex(self.__dbpath + '.spell', 
+                        readonly = self.__readonly)
+                self.__derived.append('spell')
+        return True
+
+    # 根据表结构版本生成插入语句：新增的列由单词计算，跟在最后
+    def __prepare (self):
+        self.__columns = schema_columns(self.__version)
+        names = [ n for n, _ in self.__fields[1:] ]
+        names += [ n for n, _, _ in self.__columns ]
+        self.__insert = 'INSERT INTO stardict(%s) VALUES(%s);'%(
+                ', '.join(names), ', '.join([ '?' ] * len(names)))
+        return True
+
+    # 写入 stardict_meta，调用时需持有 self.__lock
+    def __meta_set (self, conn, name, value):
+        sql = 'CREATE TABLE IF NOT EXISTS "stardict_meta" ('
+        sql += '"name" VARCHAR(64) PRIMARY KEY NOT NULL, "value" BLOB);'
+        conn.execute(sql)
+        sql = 'INSERT OR REPLACE INTO stardict_meta (name, value) VALUES (?, ?);'
+        conn.execute(sql, (name, value))
+        self.__meta[name] = value
         return True
 
-    # 数据库记录转化为字典
-    def __record2obj (self, record):
+    # 生成创建二级索引的 SQL
+    def __index_sql (self):
+        return index_sql(self.__indexes)
+
+    # 字段投影：返回 SELECT 的字段列表和字段名，id 和 word 总是包含在内
+    def __select (self, fields = None):
+        if fields is None:
+            fields = [ n for n, _ in self.__fields ]
+        fields = tuple(fields)
+        if fields in self.__projection:
+            return self.__projection[fields]
+        names = [ 'id', 'word' ]
+        for name in fields:
+            if name not in self.__names:
+                raise KeyError('unknown field: %s'%name)
+            if name not in names:
+                names.append(name)
+        names = tuple(names)
+        columns = ', '.join([ '"%s"'%n for n in names ])
+        self.__projection[fields] = (columns, names)
+        return columns, names
+
+    # 解压 definition/translation（detail 在访问时才解码），返回 tuple
+    def __decode (self, record, names):
+        if self.__zdict is None:
+            return tuple(record)
+        record = list(record)
+        for i, name in enumerate(names):
+            if name in ('definition', 'translation'):
+                record[i] = zlib_loads(record[i])
+        return tuple(record)
+
+    # 字段值转化为数据库里保存的形式：detail 序列化成 JSON，压缩模式下
+    # definition/translation/detail 压缩成 BLOB
+    def __encode (self, name, value):
+        if name == 'detail':
+            if value is not None:
+                value = json.dumps(value, ensure_ascii = False)
+        if self.__zdict is not None and name in ZLIB_FIELDS:
+            value = zlib_dumps(value, self.__zdict)
+        return value
+
+    # 数据库记录转化为字典，detail 在第一次访问时才解码
+    def __record2obj (self, record, names = None):
         if record is None:
             return None
-        word = {}
-        for k, v in self.__fields:
-            word[k] = record[v]
-        if word['detail']:
-            text = word['detail']
-            try:
-                obj = json.loads(text)
-            except:
-                obj = None
-            word['detail'] = obj
+        if names is None:
+            names = self.__select()[1]
+        if self.__compact:
+            index = self.__recindex.get(names)
+            if index is None:
+                index = record_index(names)
+                self.__recindex[names] = index
+            return WordRecord(index, self.__decode(record, names))
+        word = LazyRecord(zip(names, self.__decode(record, names)))
+        if word.get('detail'):
+            word._pending = True
         return word
 
+    # 取得当前线程用于读取的连接：非并发模式下就是写连接
+    def __reader (self):
+        if not self.__concurrent:
+            return self.__conn
+        # 本线程有尚未提交的写入时，继续用写连接读，保证能读到自己的修改
+        if self.__conn.in_transaction:
+            if self.__owner == threading.current_thread().ident:
+                return self.__conn
+        reader = getattr(self.__local, 'reader', None)
+        if reader is None:
+            reader = ReaderConnection(self.__connect_readonly())
+            with self.__lock:
+                self.__readers.add(reader)
+            self.__local.reader = reader
+        return reader.conn
+
+    # 检测 SQLite 是否支持 json_each（JSON1 扩展）
+    def __json_enabled (self):
+        if self.__json is None:
+            try:
+                self.__reader().execute("select json('[]');")
+                self.__json = True
+            except sqlite3.Error:
+                self.__json = False
+        return self.__json
+
+    # 打开只读连接（并发模式下各个线程的读连接也用它），总是设置
+    # query_only；只读模式下数据库视为不可变（immutable），不检查文件锁，
+    # 同时用 mmap 和较大的页缓存加速冷启动
+    def __connect_readonly (self):
+        try:
+            from urllib.request import pathname2url
+        except ImportError:
+            from urllib import pathname2url
+        uri = 'file:%s?mode=ro'%pathname2url(self.__dbpath)
+        if self.__readonly:
+            uri += '&immutable=1'
+        conn = sqlite3.connect(uri, uri = True, isolation_level = None,
+                check_same_thread = False)
+        conn.execute('PRAGMA query_only = 1;')
+        if self.__readonly:
+            conn.execute('PRAGMA mmap_size = %d;'%READONLY_MMAP_SIZE)
+            conn.execute('PRAGMA cache_size = %d;'%READONLY_CACHE_SIZE)
+        return conn
+
+    # 提交或者回滚写连接，拼写索引保存在单独的文件里，跟着一起提交或者
+    # 回滚，调用时需持有 self.__lock
+    def __commit (self, conn):
+        conn.commit()
+        if self.__spell is not None:
+            self.__spell.commit()
+        return True
+
+    def __rollback (self, conn):
+        conn.rollback()
+        if self.__spell is not None:
+            self.__spell.rollback()
+        return True
+
+    # 写入操作用保存点包起来，出错时只撤销这一次写入，同一个事务里之前
+    # commit = False 的写入（并发模式下包括其他线程的）不受影响；python 2
+    # 的 sqlite3 执行 SAVEPOINT 之前会自动提交，只能回滚整个事务
+    def __savepoint (self, conn):
+        if sys.version_info[0] < 3:
+            return False
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE;')
+        conn.execute('SAVEPOINT stardict_write;')
+        if self.__spell is not None:
+            self.__spell.savepoint()
+        return True
+
+    def __release (self, conn, savepoint):
+        if savepoint:
+            conn.execute('RELEASE stardict_write;')
+            if self.__spell is not None:
+                self.__spell.release()
+        return True
+
+    # 撤销保存点以后的写入，保存点已经释放（提交失败）时回滚整个事务
+    def __undo (self, conn, savepoint):
+        if not savepoint:
+            return self.__rollback(conn)
+        try:
+            conn.execute('ROLLBACK TO stardict_write;')
+            conn.execute('RELEASE stardict_write;')
+        except sqlite3.OperationalError:
+            return self.__rollback(conn)
+        if self.__spell is not None:
+            self.__spell.release(True)
+        return True
+
+    # 标记当前线程为写入者，调用时需持有 self.__lock
+    def __writer (self):
+        self.__owner = threading.current_thread().ident
+        return self.__conn
+
     # 关闭数据库
     def close (self):
-        if self.__conn:
-            self.__conn.close()
-        self.__conn = None
+        with self.__lock:
+            for reader in list(self.__readers):
+                reader.close()
+            self.__readers = weakref.WeakSet()
+            self.__local = threading.local()
+            if self.__conn:
+                self.__conn.close()
+            self.__conn = None
+            if self.__spell is not None:
+                self.__spell.close()
     
     def __del__ (self):
         self.close()
@@ -131,58 +1194,224 @@ class StarDict (object):
             print(text)
         return True
 
-    # 查询单词
-    def query (self, key):
-        c = self.__conn.cursor()
+    # 查询单词，fields 指定需要返回的字段
+    def query (self, key, fields = None, follow_lemma = False):
+        c = self.__reader().cursor()
+        columns, names = self.__select(fields)
         record = None
         if isinstance(key, int) or isinstance(key, long):
-            c.execute('select * from stardict where id = ?;', (key,))
+            sql = 'select %s from stardict where id = ?;'%columns
         elif isinstance(key, str) or isinstance(key, unicode):
-            c.execute('select * from stardict where word = ?', (key,))
+            sql = 'select %s from stardict where word = ?;'%columns
+            if follow_lemma and 'lemma' in self.__derived:
+                # 单词本身是词条时直接返回，否则返回它的原型（有多个时
+                # 取最常用的）
+                sql = 'select %s from stardict s where s.word = ? '%(
+                    ', '.join([ 's.' + n for n in columns.split(', ') ]))
+                sql += 'or s.word in (select lemma from stardict_lemma '
+                sql += 'where form = ?) order by s.word = ? desc, '
+                sql += '%s limit 1;'%rank_order('frq', 's.')
+                c.execute(sql, (key, key, key))
+                return self.__record2obj(c.fetchone(), names)
         else:
             return None
+        c.execute(sql, (key,))
         record = c.fetchone()
-        return self.__record2obj(record)
+        return self.__record2obj(record, names)
 
-    # 查询单词匹配
-    def match (self, word, limit = 10, strip = False):
-        c = self.__conn.cursor()
+    # 查询单词匹配，指定 fields 时返回对应字段的单词数据而不是 (id, word)
+    def match (self, word, limit = 10, strip = False, fields = None):
+        c = self.__reader().cursor()
+        if fields is None:
+            columns, names = 'id, word', None
+        else:
+            columns, names = self.__select(fields)
         if not strip:
-            sql = 'select id, word from stardict where word >= ? '
+            sql = 'select %s from stardict where word >= ? '%columns
             sql += 'order by word collate nocase limit ?;'
             c.execute(sql, (word, limit))
         else:
-            sql = 'select id, word from stardict where sw >= ? '
+            sql = 'select %s from stardict where sw >= ? '%columns
             sql += 'order by sw, word collate nocase limit ?;'
             c.execute(sql, (stripword(word), limit))
         records = c.fetchall()
         result = []
         for record in records:
-            result.append(tuple(record))
+            if names is None:
+                result.append(tuple(record))
+            else:
+                result.append(self.__record2obj(record, names))
         return result
 
-    # 批量查询
-    def query_batch (self, keys):
-        sql = 'select * from stardict where '
+    # 前缀补全：只扫描以 prefix 开头的单词（word 或者 strip 后的 sw 上的
+    # 索引范围），按 rank 排序取前 limit 个，返回 [(id, word), ...]
+    def complete (self, prefix, limit = 10, rank = 'frq', strip = False):
+        order = rank_order(rank)
+        if strip:
+            name, key = 'sw', stripword(prefix)
+        else:
+            name, key = 'word', nocase(prefix)
+        if not key:
+            return []
+        config = self.__complete_config()
+        if config and 'complete' in self.__derived and rank in COMPLETE_RANKS:
+            if len(key) <= config[0] and limit <= config[1]:
+                sql = 'select s.id, s.word from stardict_complete c '
+                sql += 'join stardict s on s.id = c.id where c.mode = ? '
+                sql += 'and c.rank = ? and c.prefix = ? order by c.pos '
+                sql += 'limit ?;'
+                c = self.__reader().cursor()
+                c.execute(sql, (name, rank, key, limit))
+                return [ tuple(n) for n in c.fetchall() ]
+        sql = 'select id, word from stardict where %s >= ? and %s < ? '%(
+                name, name)
+        sql += 'and substr(%s, 1, ?) = ? collate nocase '%name
+        sql += 'order by %s, word collate nocase limit ?;'%order
+        c = self.__reader().cursor()
+        c.execute(sql, (key, prefix_upper(key), len(key), key, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 后缀查询：反转以后变成 rsw 索引上的前缀范围查询，按 rank 排序，
+    # 返回 [(id, word), ...]
+    def suffix_match (self, suffix, limit = 10, rank = 'frq'):
+        order = rank_order(rank)
+        key = reverse_word(suffix)
+        if not key:
+            return []
+        c = self.__reader().cursor()
+        if self.__version >= 3:
+            sql = 'select id, word from stardict where rsw >= ? and rsw < ? '
+            sql += 'order by %s, word collate nocase limit ?;'%order
+            c.execute(sql, (key, prefix_upper(key), limit))
+        else:
+            # 老版本的数据库没有 rsw，只能扫描全表，upgrade() 以后就快了
+            sql = 'select id, word from stardict where substr(sw, ?) = ? '
+            sql += 'order by %s, word collate nocase limit ?;'%order
+            c.execute(sql, (-len(key), key[::-1], limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 同音词查询：按 Metaphone 编码在 sound 索引上查找，按 rank 排序，
+    # 返回 [(id, word), ...]
+    def sounds_like (self, word, limit = 10, rank = 'frq'):
+        order = rank_order(rank)
+        key = metaphone(word)
+        if not key:
+            return []
+        c = self.__reader().cursor()
+        if self.__version >= 4:
+            sql = 'select id, word from stardict where sound = ? '
+        else:
+            # 老版本的数据库没有 sound，只能扫描全表，upgrade() 以后就快了
+            c.connection.create_function('stardict_sound', 1, metaphone)
+            sql = 'select id, word from stardict '
+            sql += 'where stardict_sound(word) = ? '
+        sql += 'order by %s, word collate nocase limit ?;'%order
+        c.execute(sql, (key, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 变位词查询：由 letters 里的字母组成的单词，allow_subset 为真时
+    # 也返回只用到其中一部分字母的单词，长的在前，同样长度按 rank 排序，
+    # 返回 [(id, word), ...]
+    def anagrams (self, letters, allow_subset = False, limit = 100, 
+            rank = 'frq'):
+        order = 'length(sw) desc, %s, word collate nocase'%rank_order(rank)
+        key = anagram_key(letters)
+        if not key:
+            return []
+        c = self.__reader().cursor()
+        if self.__version < 5:
+            # 老版本的数据库没有 anagram_key，只能扫描全表
+            def func(word):
+                test = anagram_key(word)
+                if allow_subset:
+                    return (test != '') and anagram_subset(test, key)
+                return test == key
+            c.connection.create_function('stardict_anagram', 1, func)
+            sql = 'select id, word from stardict where stardict_anagram(word) '
+            sql += 'order by %s limit ?;'%order
+            c.execute(sql, (limit,))
+            return [ tuple(n) for n in c.fetchall() ]
+        if not allow_subset:
+            keys = [ key ]
+        else:
+            sql = 'select anagram_key from stardict where anagram_key >= ? '
+            sql += 'order by anagram_key limit 1;'
+            def seek(prefix):
+                row = c.execute(sql, (prefix,)).fetchone()
+                return row and row[0] or None
+            keys = anagram_subkeys(key, seek)
+            if not keys:
+                return []
+        if len(keys) > BATCH_CHUNK_SIZE and self.__json_enabled():
+            cond = 'select value from json_each(?)'
+            args = [ json.dumps(keys) ]
+        else:
+            cond = ','.join([ '?' ] * len(keys))
+            args = list(keys)
+        sql = 'select id, word from stardict where anagram_key in (%s) '%cond
+        sql += 'order by %s limit ?;'%order
+        c.execute(sql, tuple(args + [ limit ]))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 通配符查询（c?t*, *ph?n*）：有字面前缀时只扫描 word 索引上的前缀
+    # 范围，否则有字面后缀时扫描 rsw 上的范围，范围内的单词交给 SQLite
+    # 的 GLOB 匹配，按字母顺序返回 [(id, word), ...]
+    def pattern_match (self, pattern, limit = 10):
+        prefix, suffix = pattern_literals(nocase(pattern))
+        sql = 'select id, word from stardict where '
+        args = []
+        if prefix:
+            sql += 'word >= ? and word < ? and '
+            args.extend([ prefix, prefix_upper(prefix) ])
+        elif reverse_word(suffix) and self.__version >= 3:
+            key = reverse_word(suffix)
+            sql += 'rsw >= ? and rsw < ? and '
+            args.extend([ key, prefix_upper(key) ])
+        sql += 'lower(word) glob ? order by word collate nocase limit ?;'
+        args.extend([ pattern_glob(pattern), limit ])
+        c = self.__reader().cursor()
+        c.execute(sql, tuple(args))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 批量查询：少量键值分段用 IN 查询，大批量时 JOIN 到 json_each 上
+    def query_batch (self, keys, fields = None):
         if keys is None:
             return None
         if not keys:
             return []
-        querys = []
+        ids = {}
+        words = {}
         for key in keys:
             if isinstance(key, int) or isinstance(key, long):
-                querys.append('id = ?')
+                ids[key] = 1
             elif key is not None:
-                querys.append('word = ?')
-        sql = sql + ' or '.join(querys) + ';'
+                words[key] = 1
         query_word = {}
         query_id = {}
-        c = self.__conn.cursor()
-        c.execute(sql, tuple(keys))
-        for row in c:
-            obj = self.__record2obj(row)
-            query_word[obj['word'].lower()] = obj
-            query_id[obj['id']] = obj
+        columns, names = self.__select(fields)
+        c = self.__reader().cursor()
+        for name, group in (('id', list(ids)), ('word', list(words))):
+            if not group:
+                continue
+            if len(group) > BATCH_JOIN_SIZE and self.__json_enabled():
+                sql = 'select %s from stardict s join json_each(?) j '%(
+                        ', '.join([ 's.' + n for n in columns.split(', ') ]))
+                sql += 'on s.%s = j.value;'%name
+                c.execute(sql, (json.dumps(group),))
+                rows = c.fetchall()
+            else:
+                rows = []
+                for i in xrange(0, len(group), BATCH_CHUNK_SIZE):
+                    chunk = tuple(group[i:i + BATCH_CHUNK_SIZE])
+                    mark = ','.join([ '?' ] * len(chunk))
+                    sql = 'select %s from stardict where %s in (%s);'%(
+                            columns, name, mark)
+                    c.execute(sql, chunk)
+                    rows.extend(c.fetchall())
+            for row in rows:
+                obj = self.__record2obj(row, names)
+                query_word[obj['word'].lower()] = obj
+                query_id[obj['id']] = obj
         results = []
         for key in keys:
             if isinstance(key, int) or isinstance(key, long):
@@ -195,54 +1424,448 @@ class StarDict (object):
 
     # 取得单词总数
     def count (self):
-        c = self.__conn.cursor()
+        c = self.__reader().cursor()
         c.execute('select count(*) from stardict;')
         record = c.fetchone()
         return record[0]
 
-    # 注册新单词
-    def register (self, word, items, commit = True):
-        sql = 'INSERT INTO stardict(word, sw) VALUES(?, ?);'
-        try:
-            self.__conn.execute(sql, (word, stripword(word)))
-        except sqlite3.IntegrityError as e:
-            self.out(str(e))
+    # 读取完整的单词数据用于生成附属索引，name 为 'id' 或者 'word'
+    def __fetch (self, conn, name, keys):
+        columns, names = self.__select()
+        records = []
+        for chunk in iter_chunks(keys, BATCH_CHUNK_SIZE):
+            mark = ','.join([ '?' ] * len(chunk))
+            sql = 'select %s from stardict where %s in (%s);'%(
+                    columns, name, mark)
+            for row in conn.execute(sql, tuple(chunk)):
+                row = self.__decode(row, names)
+                records.append(LazyRecord(zip(names, row), True))
+        return records
+
+    # 单词对应的 id 列表，name 为 'id' 或者 'word'
+    def __ids (self, conn, name, keys):
+        ids = []
+        for chunk in iter_chunks(keys, BATCH_CHUNK_SIZE):
+            mark = ','.join([ '?' ] * len(chunk))
+            sql = 'select id from stardict where %s in (%s);'%(name, mark)
+            ids.extend([ n[0] for n in conn.execute(sql, tuple(chunk)) ])
+        return ids
+
+    # 修改了 names 这些字段以后需要刷新的附属索引
+    def __affected (self, names):
+        if self.__bulk:
+            return []
+        names = set(names)
+        return [ n for n in self.__derived 
+                if names.intersection(DERIVED_FIELDS[n]) ]
+
+    # update 之前需要删除的附属索引：单词不变，拼写索引不用删除，
+    # 写入时 SpellIndex.add 发现单词相同只会更新 frq
+    def __unlinked (self, derived):
+        return [ n for n in derived if n != 'spell' ]
+
+    # 单词写入以后写入附属索引，derived 为 None 时写入全部附属索引，
+    # 调用时需持有 self.__lock
+    def __derive (self, conn, name, keys, derived = None):
+        if derived is None:
+            derived = self.__derived
+        if (not derived) or self.__bulk:
+            return 0
+        records = self.__fetch(conn, name, keys)
+        self.__derive_insert(conn, records, derived)
+        return len(records)
+
+    # 单词修改或者删除之前从附属索引中删除，这时记录还是旧的数据
+    def __underive (self, conn, ids, derived = None):
+        if derived is None:
+            derived = self.__derived
+        if (not derived) or self.__bulk:
+            return 0
+        for chunk in iter_chunks(ids, BATCH_CHUNK_SIZE):
+            mark = ','.join([ '?' ] * len(chunk))
+            if 'fts' in derived:
+                self.__fts_remove(conn, chunk)
+            if 'complete' in derived:
+                self.__complete_remove(conn, chunk)
+            if 'rhyme' in derived:
+                sql = 'DELETE FROM stardict_rhyme WHERE id in (%s);'%mark
+                conn.execute(sql, tuple(chunk))
+            if 'lemma' in derived:
+                sql = 'DELETE FROM stardict_lemma WHERE id in (%s);'%mark
+                conn.execute(sql, tuple(chunk))
+            if 'spell' in derived:
+                self.__spell.remove(chunk, False)
+        return len(ids)
+
+    def __derive_insert (self, conn, records, derived = None):
+        if derived is None:
+            derived = self.__derived
+        if 'fts' in derived:
+            self.__fts_insert(conn, records)
+        if 'complete' in derived:
+            self.__complete_merge(conn, records)
+        if 'rhyme' in derived:
+            self.__rhyme_insert(conn, [ (r['id'], r['phonetic']) 
+                for r in records ])
+        if 'lemma' in derived:
+            self.__lemma_insert(conn, [ (r['id'], r['word'], r['exchange']) 
+                for r in records ])
+        if 'spell' in derived:
+            self.__spell.add([ (r['id'], r['word'], r['frq']) 
+                for r in records ], False)
+        return True
+
+    # 全文索引里保存的内容：汉字切分后的 (rowid, translation, definition)
+    def __fts_rows (self, rows):
+        result = []
+        for uid, translation, definition in rows:
+            translation = cjk_tokens(translation)
+            definition = cjk_tokens(definition)
+            if translation or definition:
+                result.append((uid, translation, definition))
+        return result
+
+    def __fts_insert (self, conn, records):
+        sql = 'INSERT INTO stardict_fts(rowid, translation, definition)'
+        sql += ' VALUES(?, ?, ?);'
+        rows = [ (r['id'], r['translation'], r['definition']) 
+                for r in records ]
+        conn.executemany(sql, self.__fts_rows(rows))
+        return True
+
+    # 全文索引不保存原文（content=''），删除时要用 'delete' 命令提供
+    # 当初写入的内容，所以必须在记录修改或者删除之前调用
+    def __fts_remove (self, conn, ids):
+        mark = ','.join([ '?' ] * len(ids))
+        if self.__fts_legacy:
+            sql = 'DELETE FROM stardict_fts WHERE rowid in (%s);'%mark
+            conn.execute(sql, tuple(ids))
+            return True
+        names = ('id', 'translation', 'definition')
+        sql = 'select id, translation, definition from stardict '
+        sql += 'where id in (%s);'%mark
+        rows = [ self.__decode(row, names) for row in 
+                conn.execute(sql, tuple(ids)) ]
+        sql = 'INSERT INTO stardict_fts(stardict_fts, rowid, translation, '
+        sql += "definition) VALUES('delete', ?, ?, ?);"
+        conn.executemany(sql, self.__fts_rows(rows))
+        return True
+
+    # 写入韵脚索引，records 为 (id, phonetic) 序列
+    def __rhyme_insert (self, conn, records):
+        sql = 'INSERT OR IGNORE INTO stardict_rhyme(tail, id) VALUES(?, ?);'
+        rows = []
+        for id, phonetic in records:
+            for tail in rhyme_keys(phonetic):
+                rows.append((tail, id))
+        conn.executemany(sql, rows)
+        return True
+
+    # 写入词形反查表，records 为 (id, word, exchange) 序列
+    def __lemma_insert (self, conn, records):
+        sql = 'INSERT OR IGNORE INTO stardict_lemma(form, lemma, type, id) '
+        sql += 'VALUES(?, ?, ?, ?);'
+        rows = []
+        for id, word, exchange in records:
+            for form, lemma, kind in exchange_lemmas(word, exchange):
+                rows.append((form, lemma, kind, id))
+        conn.executemany(sql, rows)
+        return True
+
+    # 清空附属索引
+    def __derive_clear (self, conn):
+        if 'fts' in self.__derived:
+            if self.__fts_legacy:
+                conn.execute('DELETE FROM stardict_fts;')
+            else:
+                sql = "INSERT INTO stardict_fts(stardict_fts) "
+                sql += "VALUES('delete-all');"
+                conn.execute(sql)
+        if 'complete' in self.__derived:
+            conn.execute('DELETE FROM stardict_complete;')
+        if 'rhyme' in self.__derived:
+            conn.execute('DELETE FROM stardict_rhyme;')
+        if 'lemma' in self.__derived:
+            conn.execute('DELETE FROM stardict_lemma;')
+        if 'spell' in self.__derived:
+            self.__spell.clear(False)
+        return True
+
+    # 根据全部单词重建附属索引
+    def __derive_rebuild (self, conn):
+        if not self.__derived:
             return False
-        except sqlite3.Error as e:
-            self.out(str(e))
+        self.out('rebuilding %s'%(', '.join(self.__derived)))
+        self.__derive_clear(conn)
+        if 'fts' in self.__derived:
+            names = ('id', 'translation', 'definition')
+            sql = 'INSERT INTO stardict_fts(rowid, translation, definition)'
+            sql += ' VALUES(?, ?, ?);'
+            c = conn.cursor()
+            c.execute('select id, translation, definition from stardict;')
+            while True:
+                rows = c.fetchmany(BATCH_CHUNK_SIZE)
+                if not rows:
+                    break
+                rows = [ self.__decode(row, names) for row in rows ]
+                conn.executemany(sql, self.__fts_rows(rows))
+        if 'complete' in self.__derived:
+            self.__complete_fill(conn)
+        if 'rhyme' in self.__derived:
+            c = conn.cursor()
+            c.execute('select id, phonetic from stardict '
+                    'where phonetic is not null;')
+            while True:
+                rows = c.fetchmany(BATCH_CHUNK_SIZE)
+                if not rows:
+                    break
+                self.__rhyme_insert(conn, rows)
+        if 'lemma' in self.__derived:
+            c = conn.cursor()
+            c.execute('select id, word, exchange from stardict '
+                    'where exchange is not null;')
+            while True:
+                rows = c.fetchmany(BATCH_CHUNK_SIZE)
+                if not rows:
+                    break
+                self.__lemma_insert(conn, rows)
+        if 'spell' in self.__derived:
+            self.__spell.build(self.__spell_items(conn), False)
+        return True
+
+    def __spell_items (self, conn):
+        c = conn.cursor()
+        c.execute('select id, word, frq from stardict;')
+        while True:
+            rows = c.fetchmany(BATCH_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    # 补全表的设置：(前缀最大长度, 每个前缀保存的单词数)
+    def __complete_config (self):
+        text = self.__meta.get('complete')
+        if not text:
+            return None
+        length, size = [ int(n) for n in text.split(',') ]
+        return length, size
+
+    # 一个单词在补全表里对应的 (mode, prefix) 列表
+    def __complete_keys (self, word, length):
+        keys = []
+        for mode, key in (('word', nocase(word)), ('sw', stripword(word))):
+            for i in xrange(1, min(len(key), length) + 1):
+                keys.append((mode, key[:i]))
+        return keys
+
+    # 按排名取前缀范围内的单词 id，ids 不为空时只在这些单词里排名，
+    # exclude 里的单词不参与排名（正在被删除）
+    def __complete_rank (self, conn, mode, prefix, rank, limit, 
+            ids = None, exclude = ()):
+        sql = 'select id from stardict where '
+        args = []
+        if ids is not None:
+            sql += 'id in (%s) '%(','.join([ '?' ] * len(ids)))
+            args.extend(ids)
+        else:
+            sql += '%s >= ? and %s < ? '%(mode, mode)
+            sql += 'and substr(%s, 1, ?) = ? collate nocase '%mode
+            args.extend([ prefix, prefix_upper(prefix), len(prefix), prefix ])
+        if exclude:
+            sql += 'and id not in (%s) '%(','.join([ '?' ] * len(exclude)))
+            args.extend(exclude)
+        sql += 'order by %s, word collate nocase limit ?;'%rank_order(rank)
+        args.append(limit)
+        return [ n[0] for n in conn.execute(sql, tuple(args)) ]
+
+    # 替换一个前缀的补全列表
+    def __complete_store (self, conn, mode, prefix, rank, ids):
+        sql = 'DELETE FROM stardict_complete WHERE mode = ? AND rank = ? '
+        sql += 'AND prefix = ?;'
+        conn.execute(sql, (mode, rank, prefix))
+        sql = 'INSERT INTO stardict_complete (mode, rank, prefix, pos, id) '
+        sql += 'VALUES (?, ?, ?, ?, ?);'
+        rows = [ (mode, rank, prefix, i, n) for i, n in enumerate(ids) ]
+        conn.executemany(sql, rows)
+        return True
+
+    # 新写入的单词和原来的补全列表合并后重新排名
+    def __complete_merge (self, conn, records):
+        config = self.__complete_config()
+        if config is None:
+            return False
+        length, size = config
+        groups = {}
+        for record in records:
+            for key in self.__complete_keys(record['word'], length):
+                if key not in groups:
+                    groups[key] = []
+                groups[key].append(record['id'])
+        sql = 'SELECT id FROM stardict_complete WHERE mode = ? AND rank = ? '
+        sql += 'AND prefix = ? ORDER BY pos;'
+        for (mode, prefix), ids in groups.items():
+            for rank in COMPLETE_RANKS:
+                current = [ n[0] for n in conn.execute(sql, 
+                    (mode, rank, prefix)) ]
+                if len(current) + len(ids) > BATCH_CHUNK_SIZE:
+                    result = self.__complete_rank(conn, mode, prefix, 
+                            rank, size)
+                else:
+                    candidates = list(set(current + ids))
+                    result = self.__complete_rank(conn, mode, prefix, 
+                            rank, size, candidates)
+                if result != current:
+                    self.__complete_store(conn, mode, prefix, rank, result)
+        return True
+
+    # 删除单词：包含这些单词的补全列表从前缀范围里重新排名
+    def __complete_remove (self, conn, ids):
+        config = self.__complete_config()
+        if config is None:
+            return False
+        length, size = config
+        mark = ','.join([ '?' ] * len(ids))
+        sql = 'SELECT DISTINCT mode, prefix, rank FROM stardict_complete '
+        sql += 'WHERE id in (%s);'%mark
+        keys = conn.execute(sql, tuple(ids)).fetchall()
+        for mode, prefix, rank in keys:
+            result = self.__complete_rank(conn, mode, prefix, rank, 
+                    size, None, ids)
+            self.__complete_store(conn, mode, prefix, rank, result)
+        return True
+
+    # 用窗口函数一次生成全部前缀的补全列表
+    def __complete_fill (self, conn):
+        config = self.__complete_config()
+        if config is None:
             return False
-        self.update(word, items, commit)
+        length, size = config
+        conn.execute('DELETE FROM stardict_complete;')
+        for mode in ('word', 'sw'):
+            for rank in COMPLETE_RANKS:
+                for i in xrange(1, length + 1):
+                    key = 'lower(substr(%s, 1, %d))'%(mode, i)
+                    order = '%s, word collate nocase'%rank_order(rank)
+                    sql = 'INSERT INTO stardict_complete '
+                    sql += '(mode, rank, prefix, pos, id) '
+                    sql += 'SELECT ?, ?, prefix, pos - 1, id FROM ('
+                    sql += 'SELECT id, %s AS prefix, '%key
+                    sql += 'row_number() OVER (PARTITION BY %s '%key
+                    sql += 'ORDER BY %s) AS pos '%order
+                    sql += 'FROM stardict WHERE length(%s) >= %d) '%(mode, i)
+                    sql += 'WHERE pos <= ?;'
+                    conn.execute(sql, (mode, rank, size))
+        return True
+
+    # 单词数据转化为数据库记录（word, sw 以及 self.__enable 里的字段）
+    def __obj2record (self, word, items):
+        record = [ word, stripword(word) ]
+        for name, _ in self.__enable:
+            if name in items:
+                value = self.__encode(name, items[name])
+            else:
+                value = self.__defaults.get(name, None)
+            record.append(value)
+        for _, _, func in self.__columns:
+            record.append(func(word))
+        return record
+
+    # 注册新单词
+    def register (self, word, items, commit = True):
+        with self.__lock:
+            conn = self.__writer()
+            savepoint = False
+            try:
+                savepoint = self.__savepoint(conn)
+                c = conn.execute(self.__insert, 
+                        self.__obj2record(word, items))
+                self.__derive(conn, 'id', [ c.lastrowid ])
+                self.__release(conn, savepoint)
+                if commit:
+                    self.__commit(conn)
+            except sqlite3.Error as e:
+                self.out(str(e))
+                self.__undo(conn, savepoint)
+                return False
         return True
 
+    # 批量注册新单词：items 为 (word, data) 序列，每段一次 executemany，
+    # 全部在一个保存点里完成，返回因为重复而跳过的单词列表，出错时撤销
+    # 这一批写入并返回 None
+    def register_many (self, items, commit = True):
+        skipped = []
+        with self.__lock:
+            conn = self.__writer()
+            savepoint = False
+            try:
+                savepoint = self.__savepoint(conn)
+                for chunk in iter_chunks(items, BATCH_CHUNK_SIZE):
+                    mark = ','.join([ '?' ] * len(chunk))
+                    sql = 'select word from stardict where word in (%s);'%mark
+                    c = conn.execute(sql, tuple([ w for w, _ in chunk ]))
+                    existence = set([ nocase(row[0]) for row in c ])
+                    records = []
+                    for word, data in chunk:
+                        key = nocase(word)
+                        if key in existence:
+                            skipped.append(word)
+                            continue
+                        existence.add(key)
+                        records.append(self.__obj2record(word, data))
+                    conn.executemany(self.__insert, records)
+                    self.__derive(conn, 'word', [ r[0] for r in records ])
+                self.__release(conn, savepoint)
+                if commit:
+                    self.__commit(conn)
+            except sqlite3.Error as e:
+                self.out(str(e))
+                self.__undo(conn, savepoint)
+                return None
+        return skipped
+
     # 删除单词
     def remove (self, key, commit = True):
         if isinstance(key, int) or isinstance(key, long):
             sql = 'DELETE FROM stardict WHERE id=?;'
         else:
             sql = 'DELETE FROM stardict WHERE word=?;'
-        try:
-            self.__conn.execute(sql, (key,))
-            if commit:
-                self.__conn.commit()
-        except sqlite3.IntegrityError:
-            return False
+        with self.__lock:
+            conn = self.__writer()
+            savepoint = False
+            try:
+                savepoint = self.__savepoint(conn)
+                if self.__derived:
+                    name = ('WHERE id=?' in sql) and 'id' or 'word'
+                    sql2 = 'SELECT id FROM stardict WHERE %s=?;'%name
+                    ids = [ n[0] for n in conn.execute(sql2, (key,)) ]
+                    self.__underive(conn, ids)
+                conn.execute(sql, (key,))
+                self.__release(conn, savepoint)
+                if commit:
+                    self.__commit(conn)
+            except sqlite3.IntegrityError:
+                self.__undo(conn, savepoint)
+                return False
         return True
 
     # 清空数据库
     def delete_all (self, reset_id = False):
         sql1 = 'DELETE FROM stardict;'
         sql2 = "UPDATE sqlite_sequence SET seq = 0 WHERE name = 'stardict';"
-        try:
-            self.__conn.execute(sql1)
-            if reset_id:
-                self.__conn.execute(sql2)
-            self.__conn.commit()
-        except sqlite3.IntegrityError as e:
-            self.out(str(e))
-            return False
-        except sqlite3.Error as e:
-            self.out(str(e))
-            return False
+        with self.__lock:
+            try:
+                self.__writer().execute(sql1)
+                self.__derive_clear(self.__conn)
+                if reset_id:
+                    self.__conn.execute(sql2)
+                self.__commit(self.__conn)
+            except sqlite3.IntegrityError as e:
+                self.out(str(e))
+                return False
+            except sqlite3.Error as e:
+                self.out(str(e))
+                return False
         return True
 
     # 更新单词数据
@@ -252,34 +1875,450 @@ class StarDict (object):
         for name, id in self.__enable:
             if name in items:
                 names.append(name)
-                value = items[name]
-                if name == 'detail':
-                    if value is not None:
-                        value = json.dumps(value, ensure_ascii = False)
-                values.append(value)
+                values.append(self.__encode(name, items[name]))
         if len(names) == 0:
             if commit:
-                try:
-                    self.__conn.commit()
-                except sqlite3.IntegrityError:
-                    return False
+                with self.__lock:
+                    try:
+                        self.__commit(self.__conn)
+                    except sqlite3.IntegrityError:
+                        return False
             return False
         sql = 'UPDATE stardict SET ' + ', '.join(['%s=?'%n for n in names])
         if isinstance(key, str) or isinstance(key, unicode):
             sql += ' WHERE word=?;'
         else:
             sql += ' WHERE id=?;'
-        try:
-            self.__conn.execute(sql, tuple(values + [key]))
-            if commit:
-                self.__conn.commit()
-        except sqlite3.IntegrityError:
+        if isinstance(key, str) or isinstance(key, unicode):
+            name = 'word'
+        else:
+            name = 'id'
+        derived = self.__affected(names)
+        with self.__lock:
+            conn = self.__writer()
+            savepoint = False
+            try:
+                savepoint = self.__savepoint(conn)
+                if derived:
+                    ids = self.__ids(conn, name, [ key ])
+                    self.__underive(conn, ids, self.__unlinked(derived))
+                conn.execute(sql, tuple(values + [key]))
+                if derived:
+                    self.__derive(conn, 'id', ids, derived)
+                self.__release(conn, savepoint)
+                if commit:
+                    self.__commit(conn)
+            except sqlite3.IntegrityError:
+                self.__undo(conn, savepoint)
+                return False
+        return True
+
+    # 批量更新：items 为 (key, data) 序列，相同字段的记录合并成一次
+    # executemany，返回实际更新的记录数，出错时撤销这一批写入并返回 -1
+    def update_many (self, items, commit = True):
+        count = 0
+        with self.__lock:
+            conn = self.__writer()
+            savepoint = False
+            try:
+                savepoint = self.__savepoint(conn)
+                for chunk in iter_chunks(items, BATCH_CHUNK_SIZE):
+                    groups = {}
+                    for key, data in chunk:
+                        names = []
+                        values = []
+                        for name, _ in self.__enable:
+                            if name in data:
+                                names.append(name)
+                                values.append(self.__encode(name, 
+                                    data[name]))
+                        if not names:
+                            continue
+                        if isinstance(key, str) or isinstance(key, unicode):
+                            where = 'word'
+                        else:
+                            where = 'id'
+                        group = (tuple(names), where)
+                        if group not in groups:
+                            groups[group] = []
+                        groups[group].append(tuple(values + [key]))
+                    for (names, where), rows in groups.items():
+                        sql = 'UPDATE stardict SET '
+                        sql += ', '.join([ '%s=?'%n for n in names ])
+                        sql += ' WHERE %s=?;'%where
+                        derived = self.__affected(names)
+                        if derived:
+                            ids = self.__ids(conn, where, 
+                                    [ r[-1] for r in rows ])
+                            self.__underive(conn, ids, 
+                                    self.__unlinked(derived))
+                        c = conn.executemany(sql, rows)
+                        count += c.rowcount
+                        if derived:
+                            self.__derive(conn, 'id', ids, derived)
+                self.__release(conn, savepoint)
+                if commit:
+                    self.__commit(conn)
+            except sqlite3.Error as e:
+                self.out(str(e))
+                self.__undo(conn, savepoint)
+                return -1
+        return count
+
+    # 批量导入模式：删除二级索引，关闭同步并使用内存日志，
+    # 退出时重建索引并 ANALYZE，用法：with db.bulk_load(): ...
+    @contextlib.contextmanager
+    def bulk_load (self):
+        with self.__lock:
+            conn = self.__writer()
+            self.__commit(conn)
+            for name, _, _ in self.__indexes:
+                conn.execute('DROP INDEX IF EXISTS "%s";'%name)
+            journal = conn.execute('PRAGMA journal_mode;').fetchone()[0]
+            synchronous = conn.execute('PRAGMA synchronous;').fetchone()[0]
+            conn.execute('PRAGMA synchronous = OFF;')
+            if not self.__concurrent:
+                conn.execute('PRAGMA journal_mode = MEMORY;')
+            self.__bulk = True
+            try:
+                yield self
+                self.__commit(conn)
+            except:
+                self.__rollback(conn)
+                raise
+            finally:
+                self.__bulk = False
+                self.out('rebuilding indexes')
+                conn.executescript(self.__index_sql())
+                self.__derive_rebuild(conn)
+                self.__commit(conn)
+                conn.executescript('ANALYZE;')
+                if not self.__concurrent:
+                    conn.execute('PRAGMA journal_mode = %s;'%journal)
+                conn.execute('PRAGMA synchronous = %d;'%synchronous)
+
+    # 表结构版本
+    def version (self):
+        return self.__version
+
+    # 把数据库升级到最新的表结构：v1 重建表格去掉多余的索引，之后的
+    # 版本用 ALTER TABLE 增加新的列并计算出列值，最后 VACUUM
+    def upgrade (self):
+        with self.__lock:
+            conn = self.__writer()
+            self.__commit(conn)
+            if self.__version >= SCHEMA_VERSION:
+                return False
+            if self.__version < 2:
+                self.out('upgrading schema to version 2')
+                names = ', '.join([ '"%s"'%n for n, _ in self.__fields ])
+                sql = 'select seq from sqlite_sequence '
+                sql += "where name = 'stardict';"
+                row = conn.execute(sql).fetchone()
+                seq = row and row[0] or 0
+                table = SCHEMA_TABLE[2].replace('"stardict"', '"stardict_v2"')
+                script = ['BEGIN IMMEDIATE;']
+                for name, _, _ in SCHEMA_INDEXES[1]:
+                    script.append('DROP INDEX IF EXISTS "%s";'%name)
+                script.append(table)
+                script.append('INSERT INTO "stardict_v2" (%s) '%names)
+                script.append('SELECT %s FROM "stardict";'%names)
+                script.append('DROP TABLE "stardict";')
+                script.append('ALTER TABLE "stardict_v2" RENAME TO "stardict";')
+                script.append(index_sql(SCHEMA_INDEXES[2]))
+                script.append("UPDATE sqlite_sequence SET seq = max(seq, %d) "%seq)
+                script.append("WHERE name = 'stardict';")
+                script.append('PRAGMA user_version = 2;')
+                script.append('COMMIT;')
+                conn.executescript('\n'.join(script))
+                self.__version = 2
+            while self.__version < SCHEMA_VERSION:
+                version = self.__version + 1
+                self.out('upgrading schema to version %d'%version)
+                script = ['BEGIN IMMEDIATE;']
+                for name, desc, func in SCHEMA_COLUMNS.get(version, ()):
+                    conn.create_function('stardict_' + name, 1, func)
+                    sql = 'ALTER TABLE stardict ADD COLUMN "%s" %s;'
+                    script.append(sql%(name, desc))
+                    sql = 'UPDATE stardict SET "%s" = stardict_%s(word);'
+                    script.append(sql%(name, name))
+                script.append(index_sql(SCHEMA_INDEXES[version]))
+                script.append('PRAGMA user_version = %d;'%version)
+                script.append('COMMIT;')
+                conn.executescript('\n'.join(script))
+                self.__version = version
+            self.__indexes = SCHEMA_INDEXES[self.__version]
+            self.__prepare()
+            self.out('vacuum')
+            conn.executescript('ANALYZE; VACUUM;')
+        return True
+
+    # 压缩 definition/translation/detail：从 samples 个单词中训练预设
+    # 字典（size 字节）保存在 stardict_meta 里，然后重写全部记录并 VACUUM，
+    # 之后写入的数据自动压缩，查询时自动解压
+    def compress_build (self, samples = 5000, size = 32768):
+        if sys.version_info[0] < 3:
+            self.out('zlib preset dictionary needs python 3')
             return False
+        names = ', '.join(ZLIB_FIELDS)
+        sql3 = 'select id, %s from stardict where id > ? '%names
+        sql3 += 'order by id limit ?;'
+        sql4 = 'UPDATE stardict SET %s WHERE id = ?;'%(
+                ', '.join([ '%s = ?'%n for n in ZLIB_FIELDS ]))
+        with self.__lock:
+            conn = self.__writer()
+            previous = self.__zdict
+            try:
+                self.__commit(conn)
+                self.out('training zlib dictionary')
+                sql = 'select %s from stardict '%names
+                sql += 'order by random() limit ?;'
+                texts = []
+                for row in conn.execute(sql, (samples,)):
+                    texts.extend([ zlib_loads(n) for n in row ])
+                zdict = zlib_train(texts, size)
+                self.__meta_set(conn, 'zdict', zdict)
+                self.__zdict = zdict
+                zlib_register(zdict)
+                self.out('compressing records')
+                last = 0
+                while True:
+                    rows = conn.execute(sql3, (last, BATCH_CHUNK_SIZE))
+                    rows = rows.fetchall()
+                    if not rows:
+                        break
+                    records = []
+                    for row in rows:
+                        values = [ zlib_loads(n) for n in row[1:] ]
+                        values = [ zlib_dumps(n, zdict) for n in values ]
+                        records.append(tuple(values) + (row[0],))
+                    conn.executemany(sql4, records)
+                    last = rows[-1][0]
+                self.__commit(conn)
+                self.out('vacuum')
+                conn.executescript('VACUUM;')
+            except sqlite3.Error as e:
+                self.__rollback(conn)
+                self.__zdict = previous
+                self.__meta['zdict'] = previous
+                self.out(str(e))
+                return False
+        return True
+
+    # 预先计算长度不超过 length 的前缀的前 size 个补全结果（按 frq 和
+    # bnc，word 和 sw 各一份），短前缀的 complete() 直接查这张表，
+    # 之后 register/update/remove 时自动维护
+    def complete_build (self, length = 3, size = 10):
+        sql1 = 'CREATE TABLE IF NOT EXISTS "stardict_complete" ('
+        sql1 += '"mode" VARCHAR(8) NOT NULL, "rank" VARCHAR(16) NOT NULL, '
+        sql1 += '"prefix" VARCHAR(64) NOT NULL, "pos" INTEGER NOT NULL, '
+        sql1 += '"id" INTEGER NOT NULL, '
+        sql1 += 'PRIMARY KEY (mode, rank, prefix, pos)) WITHOUT ROWID;'
+        sql2 = 'CREATE INDEX IF NOT EXISTS "stardict_complete_1" '
+        sql2 += 'ON stardict_complete (id);'
+        with self.__lock:
+            conn = self.__writer()
+            try:
+                conn.execute(sql1)
+                conn.execute(sql2)
+                self.__meta_set(conn, 'complete', '%d,%d'%(length, size))
+                if 'complete' not in self.__derived:
+                    self.__derived.append('complete')
+                self.out('building completion table')
+                self.__complete_fill(conn)
+                self.__commit(conn)
+            except sqlite3.Error as e:
+                self.__rollback(conn)
+                self.out(str(e))
+                return False
+        return True
+
+    # 建立韵脚索引：从 phonetic 提取英式和美式的韵脚，之后自动维护
+    def rhyme_build (self):
+        sql1 = 'CREATE TABLE IF NOT EXISTS "stardict_rhyme" ('
+        sql1 += '"tail" VARCHAR(64) NOT NULL, "id" INTEGER NOT NULL, '
+        sql1 += 'PRIMARY KEY (tail, id)) WITHOUT ROWID;'
+        sql2 = 'CREATE INDEX IF NOT EXISTS "stardict_rhyme_1" '
+        sql2 += 'ON stardict_rhyme (id);'
+        with self.__lock:
+            conn = self.__writer()
+            try:
+                conn.execute(sql1)
+                conn.execute(sql2)
+                if 'rhyme' not in self.__derived:
+                    self.__derived.append('rhyme')
+                self.__derive_rebuild(conn)
+                self.__commit(conn)
+            except sqlite3.Error as e:
+                self.__rollback(conn)
+                self.out(str(e))
+                return False
+        return True
+
+    # 建立词形反查表：从 exchange 展开 (form, lemma, type)，之后自动维护，
+    # query(..., follow_lemma = True) 用它把变形映射到原型
+    def lemma_build (self):
+        sql1 = 'CREATE TABLE IF NOT EXISTS "stardict_lemma" ('
+        sql1 += '"form" VARCHAR(64) COLLATE NOCASE NOT NULL, '
+        sql1 += '"lemma" VARCHAR(64) COLLATE NOCASE NOT NULL, '
+        sql1 += '"type" VARCHAR(16), "id" INTEGER NOT NULL, '
+        sql1 += 'PRIMARY KEY (form, lemma, id)) WITHOUT ROWID;'
+        sql2 = 'CREATE INDEX IF NOT EXISTS "stardict_lemma_1" '
+        sql2 += 'ON stardict_lemma (id);'
+        with self.__lock:
+            conn = self.__writer()
+            try:
+                conn.execute(sql1)
+                conn.execute(sql2)
+                if 'lemma' not in self.__derived:
+                    self.__derived.append('lemma')
+                self.__derive_rebuild(conn)
+                self.__commit(conn)
+            except sqlite3.Error as e:
+                self.__rollback(conn)
+                self.out(str(e))
+                return False
+        return True
+
+    # 押韵的单词：和 word 有相同韵脚（英式或美式）的单词，按 rank 排序，
+    # 返回 [(id, word), ...]
+    def rhymes (self, word, limit = 10, rank = 'frq'):
+        if 'rhyme' not in self.__derived:
+            self.out('rhyme index is not built, call rhyme_build()')
+            return None
+        sql = 'select s.id, s.word from stardict s where s.id in ('
+        sql += 'select r.id from stardict_rhyme r where r.tail in ('
+        sql += 'select t.tail from stardict_rhyme t join stardict w '
+        sql += 'on w.id = t.id where w.word = ?)) and s.word <> ? '
+        sql += 'order by %s, s.word collate nocase '%rank_order(rank, 's.')
+        sql += 'limit ?;'
+        c = self.__reader().cursor()
+        c.execute(sql, (word, word, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 生成拼写建议索引（编辑距离最大为 distance），保存在数据库文件名
+    # 加 .spell 的文件里，之后写入单词时自动维护；先生成到临时文件，
+    # 成功以后才替换原来的索引
+    def spell_build (self, distance = 2):
+        filename = ':memory:'
+        tmpname = ':memory:'
+        if self.__dbpath != ':memory:':
+            filename = self.__dbpath + '.spell'
+            tmpname = filename + '.tmp'
+        with self.__lock:
+            conn = self.__writer()
+            if tmpname != ':memory:' and os.path.exists(tmpname):
+                os.remove(tmpname)
+            spell = SpellIndex(tmpname, distance)
+            try:
+                self.out('building spell index')
+                spell.build(self.__spell_items(conn))
+            except sqlite3.Error as e:
+                spell.close()
+                if tmpname != ':memory:' and os.path.exists(tmpname):
+                    os.remove(tmpname)
+                self.out(str(e))
+                return False
+            if self.__spell is not None:
+                self.__spell.close()
+            if tmpname != ':memory:':
+                spell.close()
+                if os.path.exists(filename):
+                    os.remove(filename)
+                os.rename(tmpname, filename)
+                spell = SpellIndex(filename, distance)
+            self.__spell = spell
+            if 'spell' not in self.__derived:
+                self.__derived.append('spell')
+            # 索引包含了还没提交的写入，一起提交
+            try:
+                self.__commit(conn)
+            except sqlite3.Error as e:
+                self.out(str(e))
+                return False
+        return True
+
+    # 建立中文（和英文释义）反查用的 FTS5 全文索引，之后自动维护
+    def search_build (self):
+        sql = 'CREATE VIRTUAL TABLE stardict_fts USING fts5('
+        sql += "translation, definition, content = '', "
+        sql += 'tokenize = "unicode61");'
+        with self.__lock:
+            conn = self.__writer()
+            derived = list(self.__derived)
+            legacy = self.__fts_legacy
+            try:
+                # 先开始事务，出错时 DROP TABLE 也能回滚
+                if sys.version_info[0] >= 3 and not conn.in_transaction:
+                    conn.execute('BEGIN IMMEDIATE;')
+                conn.execute('DROP TABLE IF EXISTS stardict_fts;')
+                conn.execute(sql)
+                self.__fts_legacy = False
+                if 'fts' not in self.__derived:
+                    self.__derived.append('fts')
+                self.__derive_rebuild(conn)
+                self.__commit(conn)
+            except sqlite3.Error as e:
+                self.__rollback(conn)
+                self.__derived = derived
+                self.__fts_legacy = legacy
+                self.out(str(e))
+                return False
         return True
 
+    # 在 translation/definition 里反查单词，返回 [(id, word), ...]，
+    # rank_by 可以是 frq, bnc, collins, oxford 或者 rank（相关度）
+    def search (self, text, limit = 10, rank_by = 'frq'):
+        if 'fts' not in self.__derived:
+            self.out('full text index is not built, call search_build()')
+            return None
+        query = cjk_query(text)
+        if not query:
+            return []
+        if rank_by == 'rank':
+            order = 'f.rank'
+        else:
+            order = rank_order(rank_by, 's.')
+        sql = 'select s.id, s.word from stardict_fts f join stardict s '
+        sql += 'on s.id = f.rowid where stardict_fts match ? '
+        sql += 'order by %s limit ?;'%order
+        c = self.__reader().cursor()
+        c.execute(sql, (query, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 拼写建议：返回 [(word, distance), ...]，先按编辑距离再按 frq 排序
+    def suggest (self, word, max_distance = 2, limit = 10):
+        if self.__spell is None:
+            self.out('spell index is not built, call spell_build()')
+            return None
+        return self.__spell.suggest(word, max_distance, limit)
+
+    # 按单词顺序流式读取记录：每页用 word > ? 定位（keyset 分页），
+    # 内存占用固定，遍历整个词典只需要 N / batch_size 次查询
+    def iter_records (self, batch_size = 1000, fields = None, 
+            start_after = None):
+        columns, names = self.__select(fields)
+        last = start_after
+        while True:
+            c = self.__reader().cursor()
+            if last is None:
+                sql = 'select %s from stardict '%columns
+                sql += 'order by word limit ?;'
+                c.execute(sql, (batch_size,))
+            else:
+                sql = 'select %s from stardict where word > ? '%columns
+                sql += 'order by word limit ?;'
+                c.execute(sql, (last, batch_size))
+            rows = c.fetchmany(batch_size)
+            for row in rows:
+                yield self.__record2obj(row, names)
+            if len(rows) < batch_size:
+                break
+            last = rows[-1][1]
+
     # 浏览词典
     def __iter__ (self):
-        c = self.__conn.cursor()
+        c = self.__reader().cursor()
         sql = 'select "id", "word" from "stardict"'
         sql += ' order by "word" collate nocase;'
         c.execute(sql)
@@ -289,9 +2328,17 @@ class StarDict (object):
     def __len__ (self):
         return self.count()
 
-    # 检测存在
+    # 检测存在：只查索引，不读取记录内容
     def __contains__ (self, key):
-        return self.query(key) is not None
+        if isinstance(key, int) or isinstance(key, long):
+            sql = 'select 1 from stardict where id = ?;'
+        elif isinstance(key, str) or isinstance(key, unicode):
+            sql = 'select 1 from stardict where word = ?;'
+        else:
+            return False
+        c = self.__reader().cursor()
+        c.execute(sql, (key,))
+        return c.fetchone() is not None
 
     # 查询单词
     def __getitem__ (self, key):
@@ -299,11 +2346,12 @@ class StarDict (object):
 
     # 提交变更
     def commit (self):
-        try:
-            self.__conn.commit()
-        except sqlite3.IntegrityError:
-            self.__conn.rollback()
-            return False
+        with self.__lock:
+            try:
+                self.__commit(self.__conn)
+            except sqlite3.IntegrityError:
+                self.__rollback(self.__conn)
+                return False
         return True
 
     # 取得所有单词
@@ -332,7 +2380,8 @@ def mysql_startup():
 #----------------------------------------------------------------------
 class DictMySQL (object):
 
-    def __init__ (self, desc, init = False, timeout = 10, verbose = False):
+    def __init__ (self, desc, init = False, timeout = 10, verbose = False,
+            compact = False):
         self.__argv = {}
         self.__uri = {}
         if isinstance(desc, dict):
@@ -347,6 +2396,8 @@ class DictMySQL (object):
         self.__conn = None
         self.__verbose = verbose
         self.__init = init
+        self.__compact = compact
+        self.__recindex = {}
         if 'db' not in argv:
             raise KeyError('not find db name')
         self.__open()
@@ -363,6 +2414,8 @@ class DictMySQL (object):
         for k, v in self.__fields:
             self.__names[k] = v
         self.__enable = self.__fields[3:]
+        self.__defaults = { 'collins': 0, 'oxford': 0 }
+        self.__projection = {}
         self.__db = self.__argv.get('db', 'stardict')
         if not self.__init:
             uri = {}
@@ -372,7 +2425,23 @@ class DictMySQL (object):
             self.__conn = MySQLdb.connect(**uri)
         else:
             self.__conn = MySQLdb.connect(**self.__uri)
-            return self.init()
+            self.init()
+        return self.__prepare()
+
+    # 检测表格里有哪些新增的列（rsw 等），生成插入语句
+    def __prepare (self):
+        c = self.__conn.cursor()
+        c.execute('SHOW COLUMNS FROM stardict;')
+        exists = set([ row[0] for row in c.fetchall() ])
+        columns = schema_columns(SCHEMA_VERSION)
+        self.__columns = tuple([ n for n in columns if n[0] in exists ])
+        self.__extra = set([ n for n, _, _ in self.__columns ])
+        names = [ n for n, _ in self.__fields[1:] ]
+        names += [ n for n, _, _ in self.__columns ]
+        self.__insert = 'INSERT INTO stardict(%s) VALUES(%s);'%(
+                ', '.join(names), ', '.join([ '%s' ] * len(names)))
+        c.execute("SHOW TABLES LIKE 'stardict_lemma';")
+        self.__lemma = c.fetchone() is not None
         return True
 
     # 输出日志
@@ -406,7 +2475,13 @@ class DictMySQL (object):
             `exchange` TEXT,
             `detail` TEXT,
             `audio` TEXT,
+            `rsw` VARCHAR(64),
+            `sound` VARCHAR(64),
+            `anagram_key` VARCHAR(64),
             KEY(`sw`, `word`),
+            KEY(`rsw`),
+            KEY(`sound`),
+            KEY(`anagram_key`),
             KEY(`collins`),
             KEY(`oxford`),
             KEY(`tag`)
@@ -416,6 +2491,22 @@ class DictMySQL (object):
         sql = sql.strip('\n')
         sql += ' ENGINE=MyISAM DEFAULT CHARSET=utf8;'
         self.__conn.query(sql)
+        # 老的表格补上新增的列并计算出列值
+        c = self.__conn.cursor()
+        c.execute('SHOW COLUMNS FROM stardict;')
+        exists = set([ row[0] for row in c.fetchall() ])
+        for name, _, func in schema_columns(SCHEMA_VERSION):
+            if name in exists:
+                continue
+            self.out('add column: %s'%name)
+            sql = 'ALTER TABLE stardict ADD COLUMN `%s` VARCHAR(64), '
+            sql += 'ADD KEY(`%s`);'
+            c.execute(sql%(name, name))
+            c.execute('SELECT id, word FROM stardict;')
+            rows = [ (func(word), uid) for uid, word in c.fetchall() ]
+            sql = 'UPDATE stardict SET `%s` = %%s WHERE id = %%s;'%name
+            for chunk in iter_chunks(rows, BATCH_CHUNK_SIZE):
+                c.executemany(sql, chunk)
         self.__conn.commit()
         return True
 
@@ -450,20 +2541,39 @@ class DictMySQL (object):
             obj['db'] = part[1]
         return obj
 
-    # 数据库记录转化为字典
-    def __record2obj (self, record):
+    # 字段投影：返回 SELECT 的字段列表和字段名，id 和 word 总是包含在内
+    def __select (self, fields = None):
+        if fields is None:
+            fields = [ n for n, _ in self.__fields ]
+        fields = tuple(fields)
+        if fields in self.__projection:
+            return self.__projection[fields]
+        names = [ 'id', 'word' ]
+        for name in fields:
+            if name not in self.__names:
+                raise KeyError('unknown field: %s'%name)
+            if name not in names:
+                names.append(name)
+        names = tuple(names)
+        columns = ', '.join([ '`%s`'%n for n in names ])
+        self.__projection[fields] = (columns, names)
+        return columns, names
+
+    # 数据库记录转化为字典，detail 在第一次访问时才解码
+    def __record2obj (self, record, names = None):
         if record is None:
             return None
-        word = {}
-        for k, v in self.__fields:
-            word[k] = record[v]
-        if word['detail']:
-            text = word['detail']
-            try:
-                obj = json.loads(text)
-            except:
-                obj = None
-            word['detail'] = obj
+        if names is None:
+            names = self.__select()[1]
+        if self.__compact:
+            index = self.__recindex.get(names)
+            if index is None:
+                index = record_index(names)
+                self.__recindex[names] = index
+            return WordRecord(index, tuple(record))
+        word = LazyRecord(zip(names, record))
+        if word.get('detail'):
+            word._pending = True
         return word
 
     # 关闭数据库
@@ -475,59 +2585,175 @@ class DictMySQL (object):
     def __del__ (self):
         self.close()
 
-    # 查询单词
-    def query (self, key):
+    # 查询单词，fields 指定需要返回的字段
+    def query (self, key, fields = None, follow_lemma = False):
+        columns, names = self.__select(fields)
         record = None
+        args = (key,)
         if isinstance(key, int) or isinstance(key, long):
-            sql = 'select * from stardict where id = %s;'
+            sql = 'select %s from stardict where id = %%s;'%columns
         elif isinstance(key, str) or isinstance(key, unicode):
-            sql = 'select * from stardict where word = %s;'
+            sql = 'select %s from stardict where word = %%s;'%columns
+            if follow_lemma and self.__lemma:
+                sql = 'select %s from stardict s where s.word = %%s '%(
+                    ', '.join([ 's.' + n for n in columns.split(', ') ]))
+                sql += 'or s.word in (select lemma from stardict_lemma '
+                sql += 'where form = %s) order by s.word = %s desc, '
+                sql += '%s limit 1;'%rank_order('frq', 's.')
+                args = (key, key, key)
         else:
             return None
         with self.__conn as c:
-            c.execute(sql, (key,))
+            c.execute(sql, args)
             record = c.fetchone()
-        return self.__record2obj(record)
+        return self.__record2obj(record, names)
 
-    # 查询单词匹配
-    def match (self, word, limit = 10, strip = False):
+    # 查询单词匹配，指定 fields 时返回对应字段的单词数据而不是 (id, word)
+    def match (self, word, limit = 10, strip = False, fields = None):
         c = self.__conn.cursor()
+        if fields is None:
+            columns, names = 'id, word', None
+        else:
+            columns, names = self.__select(fields)
         if not strip:
-            sql = 'select id, word from stardict where word >= %s '
+            sql = 'select %s from stardict where word >= %%s '%columns
             sql += 'order by word limit %s;'
             c.execute(sql, (word, limit))
         else:
-            sql = 'select id, word from stardict where sw >= %s '
+            sql = 'select %s from stardict where sw >= %%s '%columns
             sql += 'order by sw, word limit %s;'
             c.execute(sql, (stripword(word), limit))
         records = c.fetchall()
         result = []
         for record in records:
-            result.append(tuple(record))
+            if names is None:
+                result.append(tuple(record))
+            else:
+                result.append(self.__record2obj(record, names))
         return result
 
-    # 批量查询
-    def query_batch (self, keys):
-        sql = 'select * from stardict where '
+    # 前缀补全：LIKE 'prefix%' 走 word/sw 上的索引范围，按 rank 取前 limit 个
+    def complete (self, prefix, limit = 10, rank = 'frq', strip = False):
+        order = rank_order(rank)
+        if strip:
+            name, key = 'sw', stripword(prefix)
+        else:
+            name, key = 'word', prefix
+        if not key:
+            return []
+        key = key.replace('\\', '\\\\').replace('%', '\\%')
+        key = key.replace('_', '\\_') + '%'
+        sql = 'select id, word from stardict where %s like %%s '%name
+        sql += 'order by %s, word limit %%s;'%order
+        c = self.__conn.cursor()
+        c.execute(sql, (key, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 后缀查询：rsw 上的 LIKE 'xxx%' 走索引，没有 rsw 的老表格只能扫描
+    def suffix_match (self, suffix, limit = 10, rank = 'frq'):
+        order = rank_order(rank)
+        key = reverse_word(suffix)
+        if not key:
+            return []
+        c = self.__conn.cursor()
+        if 'rsw' in self.__extra:
+            sql = 'select id, word from stardict where rsw like %s '
+            c.execute(sql + 'order by %s, word limit %%s;'%order, 
+                    (key + '%', limit))
+        else:
+            sql = 'select id, word from stardict where sw like %s '
+            c.execute(sql + 'order by %s, word limit %%s;'%order, 
+                    ('%' + key[::-1], limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 同音词查询：sound 列由 init() 补上，没有的时候返回 None
+    def sounds_like (self, word, limit = 10, rank = 'frq'):
+        order = rank_order(rank)
+        if 'sound' not in self.__extra:
+            self.out('column sound is missing, call init()')
+            return None
+        key = metaphone(word)
+        if not key:
+            return []
+        sql = 'select id, word from stardict where sound = %s '
+        sql += 'order by %s, word limit %%s;'%order
+        c = self.__conn.cursor()
+        c.execute(sql, (key, limit))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 变位词查询：子集变位词在 anagram_key 索引上逐个前缀剪枝枚举
+    def anagrams (self, letters, allow_subset = False, limit = 100, 
+            rank = 'frq'):
+        order = 'length(sw) desc, %s, word'%rank_order(rank)
+        if 'anagram_key' not in self.__extra:
+            self.out('column anagram_key is missing, call init()')
+            return None
+        key = anagram_key(letters)
+        if not key:
+            return []
+        c = self.__conn.cursor()
+        if not allow_subset:
+            keys = [ key ]
+        else:
+            sql = 'select anagram_key from stardict where anagram_key >= %s '
+            sql += 'order by anagram_key limit 1;'
+            def seek(prefix):
+                c.execute(sql, (prefix,))
+                row = c.fetchone()
+                return row and row[0] or None
+            keys = anagram_subkeys(key, seek)
+            if not keys:
+                return []
+        mark = ','.join([ '%s' ] * len(keys))
+        sql = 'select id, word from stardict where anagram_key in (%s) '%mark
+        sql += 'order by %s limit %%s;'%order
+        c.execute(sql, tuple(keys + [ limit ]))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 通配符查询：LIKE 会用 word 索引上的字面前缀，模式以通配符开头
+    # 时如果有 rsw 就用字面后缀在 rsw 上查范围
+    def pattern_match (self, pattern, limit = 10):
+        prefix, suffix = pattern_literals(pattern)
+        sql = 'select id, word from stardict where word like %s '
+        args = [ pattern_like(pattern) ]
+        if not prefix and reverse_word(suffix):
+            if 'rsw' in self.__extra:
+                sql += 'and rsw like %s '
+                args.append(reverse_word(suffix) + '%')
+        sql += 'order by word limit %s;'
+        args.append(limit)
+        c = self.__conn.cursor()
+        c.execute(sql, tuple(args))
+        return [ tuple(n) for n in c.fetchall() ]
+
+    # 批量查询：按 id 和 word 分别分段用 IN 查询
+    def query_batch (self, keys, fields = None):
         if keys is None:
             return None
         if not keys:
             return []
-        querys = []
+        ids = {}
+        words = {}
         for key in keys:
             if isinstance(key, int) or isinstance(key, long):
-                querys.append('id = %s')
+                ids[key] = 1
             elif key is not None:
-                querys.append('word = %s')
-        sql = sql + ' or '.join(querys) + ';'
+                words[key] = 1
         query_word = {}
         query_id = {}
+        columns, names = self.__select(fields)
         with self.__conn as c:
-            c.execute(sql, tuple(keys))
-            for row in c:
-                obj = self.__record2obj(row)
-                query_word[obj['word'].lower()] = obj
-                query_id[obj['id']] = obj
+            for name, group in (('id', list(ids)), ('word', list(words))):
+                for i in xrange(0, len(group), BATCH_CHUNK_SIZE):
+                    chunk = tuple(group[i:i + BATCH_CHUNK_SIZE])
+                    mark = ','.join([ '%s' ] * len(chunk))
+                    sql = 'select %s from stardict where %s in (%s);'%(
+                            columns, name, mark)
+                    c.execute(sql, chunk)
+                    for row in c.fetchall():
+                        obj = self.__record2obj(row, names)
+                        query_word[obj['word'].lower()] = obj
+                        query_id[obj['id']] = obj
         results = []
         for key in keys:
             if isinstance(key, int) or isinstance(key, long):
@@ -538,18 +2764,131 @@ class DictMySQL (object):
                 results.append(None)
         return tuple(results)
 
+    # 单词数据转化为数据库记录（word, sw 以及 self.__enable 里的字段）
+    def __obj2record (self, word, items):
+        record = [ word, stripword(word) ]
+        for name, _ in self.__enable:
+            if name in items:
+                value = items[name]
+                if name == 'detail':
+                    if value is not None:
+                        value = json.dumps(value, ensure_ascii = False)
+            else:
+                value = self.__defaults.get(name, None)
+            record.append(value)
+        for _, _, func in self.__columns:
+            record.append(func(word))
+        return record
+
+    # 根据 exchange 刷新词形反查表，name 为 'id' 或者 'word'
+    def __lemma_sync (self, c, name, keys):
+        if not self.__lemma:
+            return 0
+        rows = []
+        for chunk in iter_chunks(keys, BATCH_CHUNK_SIZE):
+            mark = ','.join([ '%s' ] * len(chunk))
+            sql = 'select id, word, exchange from stardict '
+            sql += 'where %s in (%s);'%(name, mark)
+            c.execute(sql, tuple(chunk))
+            rows.extend(c.fetchall())
+        self.__lemma_remove(c, [ row[0] for row in rows ])
+        records = []
+        for uid, word, exchange in rows:
+            for form, lemma, kind in exchange_lemmas(word, exchange):
+                records.append((form, lemma, kind, uid))
+        sql = 'INSERT INTO stardict_lemma(form, lemma, type, id) '
+        sql += 'VALUES(%s, %s, %s, %s);'
+        for chunk in iter_chunks(records, BATCH_CHUNK_SIZE):
+            c.executemany(sql, chunk)
+        return len(rows)
+
+    def __lemma_remove (self, c, ids):
+        if not self.__lemma:
+            return 0
+        for chunk in iter_chunks(ids, BATCH_CHUNK_SIZE):
+            mark = ','.join([ '%s' ] * len(chunk))
+            sql = 'DELETE FROM stardict_lemma WHERE id in (%s);'%mark
+            c.execute(sql, tuple(chunk))
+        return len(ids)
+
+    # 建立词形反查表：从 exchange 展开 (form, lemma, type)，之后
+    # register/update/remove 时自动维护
+    def lemma_build (self):
+        sql = '''
+            CREATE TABLE IF NOT EXISTS `stardict_lemma` (
+            `form` VARCHAR(64) NOT NULL,
+            `lemma` VARCHAR(64) NOT NULL,
+            `type` VARCHAR(16),
+            `id` INT NOT NULL,
+            KEY(`form`),
+            KEY(`id`)
+            )
+            '''
+        sql = '\n'.join([ n.strip('\t') for n in sql.split('\n') ])
+        sql = sql.strip('\n')
+        sql += ' ENGINE=MyISAM DEFAULT CHARSET=utf8;'
+        try:
+            with self.__conn as c:
+                c.execute(sql)
+                c.execute('DELETE FROM stardict_lemma;')
+                self.__lemma = True
+                c.execute('SELECT id FROM stardict;')
+                ids = [ row[0] for row in c.fetchall() ]
+                self.__lemma_sync(c, 'id', ids)
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            return False
+        return True
+
+    # 批量写入失败时撤销已经执行的部分（MyISAM 表不支持事务）
+    def __rollback (self):
+        try:
+            self.__conn.rollback()
+        except MySQLdb.Error:
+            pass
+        return True
+
     # 注册新单词
     def register (self, word, items, commit = True):
-        sql = 'INSERT INTO stardict(word, sw) VALUES(%s, %s);'
         try:
             with self.__conn as c:
-                c.execute(sql, (word, stripword(word)))
+                c.execute(self.__insert, self.__obj2record(word, items))
+                self.__lemma_sync(c, 'word', [ word ])
         except MySQLdb.Error as e:
             self.out(str(e))
             return False
-        self.update(word, items, commit)
         return True
 
+    # 批量注册新单词：items 为 (word, data) 序列，每段一次 executemany，
+    # 返回因为重复而跳过的单词列表
+    def register_many (self, items, commit = True):
+        skipped = []
+        try:
+            with self.__conn as c:
+                for chunk in iter_chunks(items, BATCH_CHUNK_SIZE):
+                    mark = ','.join([ '%s' ] * len(chunk))
+                    sql = 'select word from stardict where word in (%s);'%mark
+                    c.execute(sql, tuple([ w for w, _ in chunk ]))
+                    existence = set([ general_ci(row[0]) for row in 
+                        c.fetchall() ])
+                    records = []
+                    for word, data in chunk:
+                        key = general_ci(word)
+                        if key in existence:
+                            skipped.append(word)
+                            continue
+                        existence.add(key)
+                        records.append(self.__obj2record(word, data))
+                    if records:
+                        c.executemany(self.__insert, records)
+                        self.__lemma_sync(c, 'word', 
+                                [ record[0] for record in records ])
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            self.__rollback()
+            return None
+        return skipped
+
     # 删除单词
     def remove (self, key, commit = True):
         if isinstance(key, int) or isinstance(key, long):
@@ -558,6 +2897,11 @@ class DictMySQL (object):
             sql = 'DELETE FROM stardict WHERE word=%s;'
         try:
             with self.__conn as c:
+                if self.__lemma:
+                    name = ('WHERE id=' in sql) and 'id' or 'word'
+                    sql2 = 'SELECT id FROM stardict WHERE %s=%%s;'%name
+                    c.execute(sql2, (key,))
+                    self.__lemma_remove(c, [ n[0] for n in c.fetchall() ])
                 c.execute(sql, (key,))
         except MySQLdb.Error as e:
             self.out(str(e))
@@ -570,6 +2914,8 @@ class DictMySQL (object):
         try:
             with self.__conn as c:
                 c.execute(sql1)
+                if self.__lemma:
+                    c.execute('DELETE FROM stardict_lemma;')
         except MySQLdb.Error as e:
             self.out(str(e))
             return False
@@ -603,11 +2949,81 @@ class DictMySQL (object):
         try:
             with self.__conn as c:
                 c.execute(sql, tuple(values + [key]))
+                if 'exchange' in items:
+                    where = ('WHERE id=' in sql) and 'id' or 'word'
+                    self.__lemma_sync(c, where, [ key ])
         except MySQLdb.Error as e:
             self.out(str(e))
             return False
         return True
 
+    # 批量更新：items 为 (key, data) 序列，相同字段的记录合并成一次
+    # executemany，返回实际更新的记录数
+    def update_many (self, items, commit = True):
+        count = 0
+        try:
+            with self.__conn as c:
+                for chunk in iter_chunks(items, BATCH_CHUNK_SIZE):
+                    groups = {}
+                    for key, data in chunk:
+                        names = []
+                        values = []
+                        for name, _ in self.__enable:
+                            if name in data:
+                                names.append(name)
+                                value = data[name]
+                                if name == 'detail' and value is not None:
+                                    value = json.dumps(value, 
+                                            ensure_ascii = False)
+                                values.append(value)
+                        if not names:
+                            continue
+                        if isinstance(key, str) or isinstance(key, unicode):
+                            where = 'word'
+                        else:
+                            where = 'id'
+                        group = (tuple(names), where)
+                        if group not in groups:
+                            groups[group] = []
+                        groups[group].append(tuple(values + [key]))
+                    for (names, where), rows in groups.items():
+                        sql = 'UPDATE stardict SET '
+                        sql += ', '.join([ '%s=%%s'%n for n in names ])
+                        sql += ' WHERE %s=%%s;'%where
+                        c.executemany(sql, rows)
+                        count += c.rowcount
+                        if 'exchange' in names:
+                            self.__lemma_sync(c, where, 
+                                    [ r[-1] for r in rows ])
+        except MySQLdb.Error as e:
+            self.out(str(e))
+            self.__rollback()
+            return -1
+        return count
+
+    # 按单词顺序流式读取记录：每页用 word > %s 定位（keyset 分页），
+    # 内存占用固定，遍历整个词典只需要 N / batch_size 次查询
+    def iter_records (self, batch_size = 1000, fields = None, 
+            start_after = None):
+        columns, names = self.__select(fields)
+        last = start_after
+        while True:
+            with self.__conn as c:
+                if last is None:
+                    sql = 'select %s from stardict '%columns
+                    sql += 'order by word limit %s;'
+                    c.execute(sql, (batch_size,))
+                else:
+                    sql = 'select %s from stardict where word > %%s '%columns
+                    sql += 'order by word limit %s;'
+                    c.execute(sql, (last, batch_size))
+                rows = c.fetchmany(batch_size)
+            for row in rows:
+                yield self.__record2obj(row, names)
+            if len(rows) < batch_size:
+                break
+            last = rows[-1][1]
+
     # 取得数据量
     def count (self):
         sql = 'SELECT count(*) FROM stardict;'
@@ -634,9 +3050,17 @@ class DictMySQL (object):
     def __len__ (self):
         return self.count()
 
-    # 检测存在
+    # 检测存在：只查索引，不读取记录内容
     def __contains__ (self, key):
-        return self.query(key) is not None
+        if isinstance(key, int) or isinstance(key, long):
+            sql = 'select 1 from stardict where id = %s;'
+        elif isinstance(key, str) or isinstance(key, unicode):
+            sql = 'select 1 from stardict where word = %s;'
+        else:
+            return False
+        with self.__conn as c:
+            c.execute(sql, (key,))
+            return c.fetchone() is not None
 
     # 查询单词
     def __getitem__ (self, key):
@@ -662,7 +3086,7 @@ COLUMN_SW = COLUMN_SIZE + 2
 #----------------------------------------------------------------------
 class DictCsv (object):
 
-    def __init__ (self, filename, codec = 'utf-8'):
+    def __init__ (self, filename, codec = 'utf-8', compact = False):
         self.__csvname = None
         if filename is not None:
             self.__csvname = os.path.abspath(filename)
@@ -680,10 +3104,22 @@ class DictCsv (object):
             numbers.append(self.__names[name])
         self.__numbers = tuple(numbers)
         self.__enable = self.__fields[1:]
+        self.__all = ('id', 'sw') + heads
+        self.__compact = compact
+        self.__recindex = {}
         self.__dirty = False
         self.__words = {}
         self.__rows = []
         self.__index = []
+        self.__rindex = None
+        self.__sounds = None
+        self.__rhymes = None
+        self.__anagrams = None
+        self.__lemmas = None
+        # 拼写建议索引，保存在 csv 文件名加 .spell 的文件里
+        self.__spell = None
+        if self.__csvname and os.path.exists(self.__csvname + '.spell'):
+            self.__spell = SpellIndex(self.__csvname + '.spell')
         self.__read()
 
     def reset (self):
@@ -691,6 +3127,11 @@ class DictCsv (object):
         self.__words = {}
         self.__rows = []
         self.__index = []
+        self.__rindex = None
+        self.__sounds = None
+        self.__rhymes = None
+        self.__anagrams = None
+        self.__lemmas = None
         return True
 
     def encode (self, text):
@@ -821,31 +3262,78 @@ class DictCsv (object):
         fp.close()
         return True
 
-    # 对象解码
-    def __obj_decode (self, row):
+    # 字段投影：返回需要解码的字段名，id 和 word 总是包含在内
+    def __select (self, fields = None):
+        if fields is None:
+            return self.__all
+        names = [ 'id', 'word' ]
+        for name in fields:
+            if name not in self.__names and name not in ('id', 'sw'):
+                raise KeyError('unknown field: %s'%name)
+            if name not in names:
+                names.append(name)
+        return tuple(names)
+
+    # 对象解码，detail 在第一次访问时才解码
+    def __obj_decode (self, row, names = None):
         if row is None:
             return None
-        obj = {}
-        obj['id'] = row[COLUMN_ID]
-        obj['sw'] = row[COLUMN_SW]
+        if names is None:
+            names = self.__all
+        if self.__compact:
+            return self.__obj_compact(row, names)
+        obj = LazyRecord(())
+        pending = False
         skip = self.__numbers
-        for key, index in self.__fields:
-            value = row[index]
-            if index in skip:
-                if value is not None:
-                    value = self.readint(value)
-            elif key != 'detail':
-                value = self.decode(value)
-            obj[key] = value
-        detail = obj.get('detail', None)
-        if detail is not None:
-            if detail != '':
-                detail = json.loads(detail)
+        for key in names:
+            if key == 'id':
+                value = row[COLUMN_ID]
+            elif key == 'sw':
+                value = row[COLUMN_SW]
             else:
-                detail = None
-        obj['detail'] = detail
+                index = self.__names[key]
+                value = row[index]
+                if index in skip:
+                    if value is not None:
+                        value = self.readint(value)
+                elif key == 'detail':
+                    if value == '':
+                        value = None
+                    elif value is not None:
+                        pending = True
+                else:
+                    value = self.decode(value)
+            obj[key] = value
+        obj._pending = pending
         return obj
 
+    # 对象解码为 WordRecord
+    def __obj_compact (self, row, names):
+        index = self.__recindex.get(names)
+        if index is None:
+            index = record_index(names)
+            self.__recindex[names] = index
+        values = []
+        skip = self.__numbers
+        for key in names:
+            if key == 'id':
+                value = row[COLUMN_ID]
+            elif key == 'sw':
+                value = row[COLUMN_SW]
+            else:
+                pos = self.__names[key]
+                value = row[pos]
+                if pos in skip:
+                    if value is not None:
+                        value = self.readint(value)
+                elif key == 'detail':
+                    if value == '':
+                        value = None
+                else:
+                    value = self.decode(value)
+            values.append(value)
+        return WordRecord(index, tuple(values))
+
     # 对象编码
     def __obj_encode (self, obj):
         row = [ None for i in xrange(len(self.__fields) + 3) ]
@@ -874,8 +3362,8 @@ class DictCsv (object):
             row[COLUMN_SD] = index
         self.__dirty = False
 
-    # 查询单词
-    def query (self, key):
+    # 查询单词，follow_lemma 时查不到的变形返回它的原型
+    def query (self, key, fields = None, follow_lemma = False):
         if key is None:
             return None
         if self.__dirty:
@@ -883,12 +3371,33 @@ class DictCsv (object):
         if isinstance(key, int) or isinstance(key, long):
             if key < 0 or key >= len(self.__rows):
                 return None
-            return self.__obj_decode(self.__rows[key])
+            return self.__obj_decode(self.__rows[key], self.__select(fields))
         row = self.__words.get(key.lower(), None)
-        return self.__obj_decode(row)
+        if row is None and follow_lemma:
+            row = self.__lemma_row(key)
+        return self.__obj_decode(row, self.__select(fields))
+
+    # 变形索引：变形 -> 原型列表，由 exchange 字段展开，第一次查询时生成
+    def __lemma_index (self):
+        if self.__lemmas is None:
+            lemmas = {}
+            column = self.__names['exchange']
+            for row in self.__rows:
+                for form, lemma, _ in exchange_lemmas(row[0], row[column]):
+                    lemmas.setdefault(form.lower(), []).append(lemma.lower())
+            self.__lemmas = lemmas
+        return self.__lemmas
+
+    # 变形的原型里词典中存在的、最常用的一个
+    def __lemma_row (self, key):
+        names = self.__lemma_index().get(key.lower(), [])
+        rows = [ self.__words[n] for n in names if n in self.__words ]
+        if not rows:
+            return None
+        return min(rows, key = self.__rank_key('frq'))
 
-    # 查询单词匹配
-    def match (self, word, count = 10, strip = False):
+    # 查询单词匹配，指定 fields 时返回对应字段的单词数据而不是 (id, word)
+    def match (self, word, count = 10, strip = False, fields = None):
         if len(self.__rows) == 0:
             return []
         if self.__dirty:
@@ -921,12 +3430,241 @@ class DictCsv (object):
             if middle >= len(index):
                 break
         cc = COLUMN_ID
+        if fields is not None:
+            names = self.__select(fields)
+            rows = index[middle:middle + count]
+            return [ self.__obj_decode(tx, names) for tx in rows ]
         likely = [ (tx[cc], tx[0]) for tx in index[middle:middle + count] ]
         return likely
 
+    # 二分查找第一个 index[i][pos].lower() >= key 的位置
+    def __lower_bound (self, index, pos, key):
+        top = 0
+        bottom = len(index)
+        while top < bottom:
+            middle = (top + bottom) >> 1
+            if index[middle][pos].lower() < key:
+                top = middle + 1
+            else:
+                bottom = middle
+        return top
+
+    # 行的排序 key：rank_key 的顺序，相同时按单词的字母顺序
+    def __rank_key (self, rank):
+        order = rank_key(rank)
+        names = self.__names
+        readint = self.readint
+        def key(row):
+            get = lambda name: readint(row[names[name]])
+            return (order(get), row[0].lower())
+        return key
+
+    # 前缀补全：二分查找前缀范围，在范围内按 rank 取前 limit 个
+    def complete (self, prefix, limit = 10, rank = 'frq', strip = False):
+        sortkey = self.__rank_key(rank)
+        if self.__dirty:
+            self.__resort()
+        if not strip:
+            index = self.__rows
+            pos = 0
+            key = prefix.lower()
+        else:
+            index = self.__index
+            pos = COLUMN_SW
+            key = stripword(prefix)
+        if not key:
+            return []
+        top = self.__lower_bound(index, pos, key)
+        rows = []
+        for i in xrange(top, len(index)):
+            if not index[i][pos].lower().startswith(key):
+                break
+            rows.append(index[i])
+        rows = heapq.nsmallest(limit, rows, key = sortkey)
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 后缀查询用的反转索引：(按反转的 sw 排好序的键值, 对应的行)，
+    # 第一次后缀查询时生成，增删单词以后重新生成
+    def __reverse_index (self):
+        if self.__rindex is None:
+            index = [ (row[COLUMN_SW][::-1], row) for row in self.__rows ]
+            index.sort(key = lambda n: (n[0], n[1][0].lower()))
+            keys = [ n[0] for n in index ]
+            self.__rindex = (keys, [ n[1] for n in index ])
+        return self.__rindex
+
+    # 后缀查询：在反转索引上二分查找前缀范围，按 rank 取前 limit 个
+    def suffix_match (self, suffix, limit = 10, rank = 'frq'):
+        sortkey = self.__rank_key(rank)
+        key = reverse_word(suffix)
+        if not key:
+            return []
+        if self.__dirty:
+            self.__resort()
+        keys, index = self.__reverse_index()
+        top = bisect.bisect_left(keys, key)
+        bottom = bisect.bisect_left(keys, prefix_upper(key))
+        rows = heapq.nsmallest(limit, index[top:bottom], key = sortkey)
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 同音词索引：Metaphone 编码 -> 行，第一次查询时生成
+    def __sound_index (self):
+        if self.__sounds is None:
+            sounds = {}
+            for row in self.__rows:
+                key = metaphone(row[0])
+                if key:
+                    sounds.setdefault(key, []).append(row)
+            self.__sounds = sounds
+        return self.__sounds
+
+    # 同音词查询：按 rank 取前 limit 个
+    def sounds_like (self, word, limit = 10, rank = 'frq'):
+        sortkey = self.__rank_key(rank)
+        key = metaphone(word)
+        if not key:
+            return []
+        if self.__dirty:
+            self.__resort()
+        rows = self.__sound_index().get(key, [])
+        rows = heapq.nsmallest(limit, rows, key = sortkey)
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 变位词索引：(排好序的键值列表, 键值 -> 行)，第一次查询时生成
+    def __anagram_index (self):
+        if self.__anagrams is None:
+            groups = {}
+            for row in self.__rows:
+                key = ''.join(sorted(row[COLUMN_SW]))
+                if key:
+                    groups.setdefault(key, []).append(row)
+            self.__anagrams = (sorted(groups), groups)
+        return self.__anagrams
+
+    # 变位词查询：子集变位词在排好序的键值上二分查找，逐个前缀剪枝
+    def anagrams (self, letters, allow_subset = False, limit = 100, 
+            rank = 'frq'):
+        sortkey = self.__rank_key(rank)
+        key = anagram_key(letters)
+        if not key:
+            return []
+        if self.__dirty:
+            self.__resort()
+        keys, groups = self.__anagram_index()
+        if not allow_subset:
+            found = [ key ]
+        else:
+            def seek(prefix):
+                pos = bisect.bisect_left(keys, prefix)
+                return (pos < len(keys)) and keys[pos] or None
+            found = anagram_subkeys(key, seek)
+        rows = []
+        for n in found:
+            rows.extend(groups.get(n, []))
+        rows = heapq.nsmallest(limit, rows, 
+                key = lambda row: (-len(row[COLUMN_SW]), sortkey(row)))
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 韵脚索引：韵脚 -> 行，第一次查询时生成
+    def __rhyme_index (self):
+        if self.__rhymes is None:
+            rhymes = {}
+            column = self.__names['phonetic']
+            for row in self.__rows:
+                for tail in rhyme_keys(row[column]):
+                    rhymes.setdefault(tail, []).append(row)
+            self.__rhymes = rhymes
+        return self.__rhymes
+
+    # 押韵的单词：和 word 有相同韵脚的单词，按 rank 取前 limit 个
+    def rhymes (self, word, limit = 10, rank = 'frq'):
+        sortkey = self.__rank_key(rank)
+        if self.__dirty:
+            self.__resort()
+        row = self.__words.get(word.lower(), None)
+        if row is None:
+            return []
+        index = self.__rhyme_index()
+        rows = {}
+        for tail in rhyme_keys(row[self.__names['phonetic']]):
+            for n in index.get(tail, []):
+                if n is not row:
+                    rows[n[COLUMN_ID]] = n
+        rows = heapq.nsmallest(limit, rows.values(), key = sortkey)
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 通配符查询：有字面前缀时只检查前缀范围内的行，否则用字面后缀在
+    # 反转索引上查范围，剩下的部分用正则表达式匹配，按字母顺序返回
+    def pattern_match (self, pattern, limit = 10):
+        if self.__dirty:
+            self.__resort()
+        prefix, suffix = pattern_literals(pattern.lower())
+        regex = pattern_regex(pattern)
+        if prefix:
+            top = self.__lower_bound(self.__rows, 0, prefix)
+            rows = []
+            for i in xrange(top, len(self.__rows)):
+                word = self.__rows[i][0].lower()
+                if not word.startswith(prefix):
+                    break
+                if regex.match(word):
+                    rows.append(self.__rows[i])
+                    if len(rows) >= limit:
+                        break
+        else:
+            if reverse_word(suffix):
+                key = reverse_word(suffix)
+                keys, index = self.__reverse_index()
+                top = bisect.bisect_left(keys, key)
+                bottom = bisect.bisect_left(keys, prefix_upper(key))
+                candidates = index[top:bottom]
+            else:
+                candidates = self.__rows
+            rows = [ n for n in candidates if regex.match(n[0].lower()) ]
+            rows.sort(key = lambda row: row[0].lower())
+            rows = rows[:limit]
+        return [ (row[COLUMN_ID], row[0]) for row in rows ]
+
+    # 生成拼写建议索引，保存在 csv 文件名加 .spell 的文件里
+    def spell_build (self, distance = 2):
+        filename = ':memory:'
+        tmpname = ':memory:'
+        if self.__csvname:
+            filename = self.__csvname + '.spell'
+            tmpname = filename + '.tmp'
+        if tmpname != ':memory:' and os.path.exists(tmpname):
+            os.remove(tmpname)
+        spell = SpellIndex(tmpname, distance)
+        frq = self.__names['frq']
+        items = [ (None, row[0], self.readint(row[frq])) 
+                for row in self.__rows ]
+        try:
+            spell.build(items)
+        except sqlite3.Error:
+            spell.close()
+            if tmpname != ':memory:' and os.path.exists(tmpname):
+                os.remove(tmpname)
+            return False
+        if self.__spell is not None:
+            self.__spell.close()
+        if tmpname != ':memory:':
+            spell.close()
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+            spell = SpellIndex(filename, distance)
+        self.__spell = spell
+        return True
+
+    # 拼写建议：返回 [(word, distance), ...]，先按编辑距离再按 frq 排序
+    def suggest (self, word, max_distance = 2, limit = 10):
+        if self.__spell is None:
+            return None
+        return self.__spell.suggest(word, max_distance, limit)
+
     # 批量查询
-    def query_batch (self, keys):
-        return [ self.query(key) for key in keys ]
+    def query_batch (self, keys, fields = None):
+        return [ self.query(key, fields) for key in keys ]
 
     # 单词总量
     def count (self):
@@ -944,6 +3682,26 @@ class DictCsv (object):
     def __contains__ (self, key):
         return self.__words.__contains__(key.lower())
 
+    # 按单词顺序流式读取记录，start_after 指定从哪个单词之后开始
+    def iter_records (self, batch_size = 1000, fields = None, 
+            start_after = None):
+        if self.__dirty:
+            self.__resort()
+        names = self.__select(fields)
+        rows = self.__rows
+        top = 0
+        if start_after is not None:
+            key = start_after.lower()
+            bottom = len(rows)
+            while top < bottom:
+                middle = (top + bottom) >> 1
+                if rows[middle][0].lower() <= key:
+                    top = middle + 1
+                else:
+                    bottom = middle
+        for index in xrange(top, len(rows)):
+            yield self.__obj_decode(rows[index], names)
+
     # 迭代器
     def __iter__ (self):
         record = []
@@ -963,9 +3721,25 @@ class DictCsv (object):
         self.__rows.append(row)
         self.__index.append(row)
         self.__words[word.lower()] = row
+        self.__rindex = None
+        self.__sounds = None
+        self.__rhymes = None
+        self.__anagrams = None
+        self.__lemmas = None
         self.__dirty = True
+        if self.__spell is not None:
+            frq = self.readint(row[self.__names['frq']])
+            self.__spell.add([ (None, word, frq) ], False)
         return True
 
+    # 批量注册新单词，返回因为重复而跳过的单词列表
+    def register_many (self, items, commit = True):
+        skipped = []
+        for word, data in items:
+            if not self.register(word, data, False):
+                skipped.append(word)
+        return skipped
+
     # 删除单词
     def remove (self, key, commit = True):
         if isinstance(key, int) or isinstance(key, long):
@@ -987,12 +3761,21 @@ class DictCsv (object):
         self.__index[index] = self.__index[len(self.__rows) - 1]
         self.__index.pop()
         del self.__words[key]
+        self.__rindex = None
+        self.__sounds = None
+        self.__rhymes = None
+        self.__anagrams = None
+        self.__lemmas = None
         self.__dirty = True
+        if self.__spell is not None:
+            self.__spell.remove([ key ], False)
         return True
 
     # 清空所有
     def delete_all (self, reset_id = False):
         self.reset()
+        if self.__spell is not None:
+            self.__spell.clear(False)
         return True
 
     # 更改单词
@@ -1013,12 +3796,29 @@ class DictCsv (object):
                 continue
             if name in items:
                 row[idx] = newrow[idx]
+        if 'phonetic' in items:
+            self.__rhymes = None
+        if 'exchange' in items:
+            self.__lemmas = None
+        if self.__spell is not None and 'frq' in items:
+            frq = self.readint(row[self.__names['frq']])
+            self.__spell.add([ (None, row[0], frq) ], False)
         return True
 
-    # 提交变更
+    # 批量更新，返回实际更新的记录数
+    def update_many (self, items, commit = True):
+        count = 0
+        for key, data in items:
+            if self.update(key, data, False):
+                count += 1
+        return count
+
+    # 提交变更，拼写索引和 csv 文件一起提交
     def commit (self):
         if self.__csvname:
             self.save(self.__csvname, self.__codec)
+        if self.__spell is not None:
+            self.__spell.commit()
         return True
 
     # 取得所有单词
@@ -1026,6 +3826,802 @@ class DictCsv (object):
         return [ n for _, n in self.__iter__() ]
 
 
+#----------------------------------------------------------------------
+# LRUCache: 有上限的 LRU 缓存，记录淘汰次数
+#----------------------------------------------------------------------
+class LRUCache (object):
+
+    def __init__ (self, size = 4096):
+        self.size = size
+        self.evictions = 0
+        self.__data = collections.OrderedDict()
+
+    def get (self, key, default = None):
+        if key not in self.__data:
+            return default
+        value = self.__data.pop(key)
+        self.__data[key] = value
+        return value
+
+    # 写入缓存，返回被淘汰的 (key, value) 列表
+    def set (self, key, value):
+        evicted = []
+        self.__data.pop(key, None)
+        self.__data[key] = value
+        while len(self.__data) > self.size:
+            evicted.append(self.__data.popitem(last = False))
+            self.evictions += 1
+        return evicted
+
+    def discard (self, key):
+        return self.__data.pop(key, None)
+
+    def clear (self):
+        self.__data.clear()
+
+    def __len__ (self):
+        return len(self.__data)
+
+    def __contains__ (self, key):
+        return key in self.__data
+
+
+#----------------------------------------------------------------------
+# CachedDict: 放在任意词典（StarDict/DictMySQL/DictCsv）前面的查询缓存，
+# 缓存 query/query_batch/match 的结果以及查不到的单词，
+# 通过它调用 register/update/remove/delete_all 时精确地清除相关条目
+#----------------------------------------------------------------------
+class CachedDict (object):
+
+    def __init__ (self, dictionary, size = 4096, negative = 4096):
+        self.__source = dictionary
+        self.__lock = threading.RLock()
+        self.__cache = LRUCache(size)         # id -> 单词数据
+        self.__alias = {}                     # nocase(word) -> id
+        self.__miss = LRUCache(negative)      # 查不到的单词
+        self.__matches = LRUCache(max(size // 8, 16))
+        self.__completes = LRUCache(max(size // 8, 16))
+        # DictCsv 的 id 是行号，增删单词后会变化
+        self.__stable = not isinstance(dictionary, DictCsv)
+        # 每次写入后加一，查询期间有写入时结果不放进缓存
+        self.__version = 0
+        # commit = False 写入的键值，commit() 之后再清除一次
+        self.__pending = set()
+        # 后面的词典返回 WordRecord 时缓存命中也返回 WordRecord
+        self.__compact = False
+        self.hits = 0
+        self.misses = 0
+
+    # 未缓存的接口直接转发给后面的词典
+    def __getattr__ (self, name):
+        if name.startswith('_CachedDict__'):
+            raise AttributeError(name)
+        return getattr(self.__source, name)
+
+    # 缓存里保存原始记录，detail 保持 JSON 文本
+    def __entry (self, obj):
+        if isinstance(obj, WordRecord):
+            self.__compact = True
+            if obj._pending:
+                return dict([ (k, obj._values[i]) for k, i in obj._index.items() ])
+        elif isinstance(obj, LazyRecord) and obj._pending:
+            return dict(dict.items(obj))
+        obj = dict(obj.items())
+        if obj.get('detail') is not None:
+            obj['detail'] = json.dumps(obj['detail'], ensure_ascii = False)
+        return obj
+
+    # 返回给调用者的是新的 LazyRecord（后面是 compact 词典时为 WordRecord），
+    # detail 访问时才解码出自己的一份，调用者改不到缓存里的数据，
+    # 指定 names 时只复制这些字段
+    def __copy (self, obj, names = None):
+        if obj is None:
+            return None
+        if names is None:
+            names = list(obj.keys())
+        if self.__compact:
+            values = tuple([ obj[n] for n in names ])
+            return WordRecord(record_index(names), values)
+        obj = dict([ (n, obj[n]) for n in names ])
+        return LazyRecord(obj, bool(obj.get('detail')))
+
+    def __lookup (self, key):
+        if isinstance(key, int) or isinstance(key, long):
+            return self.__cache.get(key)
+        uid = self.__alias.get(nocase(key))
+        if uid is None:
+            return None
+        return self.__cache.get(uid)
+
+    def __store (self, obj):
+        evicted = self.__cache.set(obj['id'], obj)
+        self.__alias[nocase(obj['word'])] = obj['id']
+        for _, old in evicted:
+            self.__alias.pop(nocase(old['word']), None)
+        return obj
+
+    def __invalidate (self, key):
+        if isinstance(key, int) or isinstance(key, long):
+            obj = self.__cache.discard(key)
+            if obj is not None:
+                self.__alias.pop(nocase(obj['word']), None)
+        else:
+            self.__miss.discard(nocase(key))
+            uid = self.__alias.pop(nocase(key), None)
+            if uid is not None:
+                self.__cache.discard(uid)
+        return True
+
+    # 查询单词：只缓存完整记录，指定 fields 时从缓存的完整记录里取字段，
+    # follow_lemma 时 key 本身查不到才查询底层词典的原型，结果不缓存
+    def query (self, key, fields = None, follow_lemma = False):
+        if key is None:
+            return None
+        if follow_lemma:
+            obj = self.query(key, fields)
+            if obj is None and not isinstance(key, (int, long)):
+                obj = self.__source.query(key, fields, True)
+            return obj
+        with self.__lock:
+            obj = self.__lookup(key)
+            if obj is not None:
+                self.hits += 1
+                if fields is not None:
+                    names = [ 'id', 'word' ] + list(fields)
+                    return self.__copy(obj, names)
+                return self.__copy(obj)
+            if not isinstance(key, (int, long)):
+                if self.__miss.get(nocase(key)) is not None:
+                    self.hits += 1
+                    return None
+            self.misses += 1
+            version = self.__version
+        if fields is not None:
+            return self.__source.query(key, fields)
+        obj = self.__source.query(key)
+        if obj is None:
+            with self.__lock:
+                if version == self.__version and \
+                        not isinstance(key, (int, long)):
+                    self.__miss.set(nocase(key), True)
+            return None
+        obj = self.__entry(obj)
+        with self.__lock:
+            if version == self.__version:
+                self.__store(obj)
+        return self.__copy(obj)
+
+    # 批量查询：缓存里没有的键值合并成一次 query_batch
+    def query_batch (self, keys, fields = None):
+        if keys is None:
+            return None
+        if not keys:
+            return []
+        if fields is not None:
+            return self.__source.query_batch(keys, fields)
+        results = []
+        missing = []
+        with self.__lock:
+            for key in keys:
+                obj = None
+                if key is not None:
+                    obj = self.__lookup(key)
+                    if obj is not None:
+                        self.hits += 1
+                    elif isinstance(key, (int, long)):
+                        missing.append(key)
+                    elif self.__miss.get(nocase(key)) is not None:
+                        self.hits += 1
+                    else:
+                        missing.append(key)
+                results.append(obj)
+            self.misses += len(missing)
+            version = self.__version
+        if missing:
+            found = {}
+            for key, obj in zip(missing, self.__source.query_batch(missing)):
+                if obj is not None:
+                    obj = self.__entry(obj)
+                if isinstance(key, (int, long)):
+                    found[key] = obj
+                else:
+                    found[nocase(key)] = obj
+            with self.__lock:
+                for index, key in enumerate(keys):
+                    if key is None or results[index] is not None:
+                        continue
+                    cache = (version == self.__version)
+                    if isinstance(key, (int, long)):
+                        obj = found.get(key)
+                    else:
+                        obj = found.get(nocase(key))
+                        if nocase(key) in found and obj is None and cache:
+                            self.__miss.set(nocase(key), True)
+                    if obj is not None and cache:
+                        self.__store(obj)
+                    results[index] = obj
+        return tuple([ self.__copy(obj) for obj in results ])
+
+    # 查询单词匹配
+    def match (self, word, limit = 10, strip = False, fields = None):
+        if fields is not None:
+            return self.__source.match(word, limit, strip, fields)
+        key = (word, limit, strip)
+        with self.__lock:
+            result = self.__matches.get(key)
+            if result is not None:
+                self.hits += 1
+                return list(result)
+            self.misses += 1
+            version = self.__version
+        result = self.__source.match(word, limit, strip)
+        with self.__lock:
+            if version == self.__version:
+                self.__matches.set(key, tuple(result))
+        return result
+
+    # 前缀补全：排名和词频有关，update 时也要清除
+    def complete (self, prefix, limit = 10, rank = 'frq', strip = False):
+        key = (prefix, limit, rank, strip)
+        with self.__lock:
+            result = self.__completes.get(key)
+            if result is not None:
+                self.hits += 1
+                return list(result)
+            self.misses += 1
+            version = self.__version
+        result = self.__source.complete(prefix, limit, rank, strip)
+        with self.__lock:
+            if version == self.__version:
+                self.__completes.set(key, tuple(result))
+        return result
+
+    # 写入返回以后再清除相关条目并增加版本号，写入期间开始的查询结果
+    # 不会放进缓存；added 为真时单词有增删，匹配结果也要清除
+    def __expire (self, keys, commit, added):
+        with self.__lock:
+            self.__version += 1
+            if added and not self.__stable:
+                self.clear()
+            for key in keys:
+                self.__invalidate(key)
+            if added:
+                self.__matches.clear()
+            self.__completes.clear()
+            if not commit:
+                self.__pending.update(keys)
+        return True
+
+    # 注册新单词：新单词只会影响查不到的缓存和匹配结果
+    def register (self, word, items, commit = True):
+        hr = self.__source.register(word, items, commit)
+        self.__expire([ word ], commit, True)
+        return hr
+
+    def register_many (self, items, commit = True):
+        items = list(items)
+        hr = self.__source.register_many(items, commit)
+        self.__expire([ word for word, _ in items ], commit, True)
+        return hr
+
+    def update (self, key, items, commit = True):
+        hr = self.__source.update(key, items, commit)
+        self.__expire([ key ], commit, False)
+        return hr
+
+    def update_many (self, items, commit = True):
+        items = list(items)
+        hr = self.__source.update_many(items, commit)
+        self.__expire([ key for key, _ in items ], commit, False)
+        return hr
+
+    def remove (self, key, commit = True):
+        hr = self.__source.remove(key, commit)
+        self.__expire([ key ], commit, True)
+        return hr
+
+    def delete_all (self, reset_id = False):
+        hr = self.__source.delete_all(reset_id)
+        self.clear()
+        return hr
+
+    # 提交以后再清除一次未提交写入涉及的条目：提交之前其他线程（比如
+    # 并发模式的读连接）可能读到旧数据并放进了缓存
+    def commit (self):
+        hr = self.__source.commit()
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = set()
+            if pending:
+                self.__expire(pending, True, True)
+        return hr
+
+    # 清空缓存
+    def clear (self):
+        with self.__lock:
+            self.__version += 1
+            self.__cache.clear()
+            self.__alias = {}
+            self.__miss.clear()
+            self.__matches.clear()
+            self.__completes.clear()
+        return True
+
+    # 缓存统计：命中，未命中，淘汰次数以及当前大小
+    def stats (self):
+        with self.__lock:
+            evictions = self.__cache.evictions + self.__miss.evictions
+            evictions += self.__matches.evictions
+            evictions += self.__completes.evictions
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': evictions,
+                'size': len(self.__cache),
+                'negative': len(self.__miss),
+                'matches': len(self.__matches),
+                'completes': len(self.__completes),
+            }
+
+    def __len__ (self):
+        return len(self.__source)
+
+    def __contains__ (self, key):
+        return self.query(key) is not None
+
+    def __getitem__ (self, key):
+        return self.query(key)
+
+    def __iter__ (self):
+        return self.__source.__iter__()
+
+
+
+#----------------------------------------------------------------------
+# 编辑距离（相邻字符交换算一次），超过 limit 时提前返回 limit + 1
+#----------------------------------------------------------------------
+def edit_distance(a, b, limit = None):
+    if a == b:
+        return 0
+    # 相同的前缀和后缀不影响距离，先去掉
+    size = min(len(a), len(b))
+    start = 0
+    while start < size and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < size - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if not a or not b:
+        return max(len(a), len(b))
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in xrange(1, len(a) + 1):
+        current = [ i ] + [ 0 ] * len(b)
+        best = i
+        x = a[i - 1]
+        for j in xrange(1, len(b) + 1):
+            y = b[j - 1]
+            value = prev[j - 1] + (x != y)
+            if prev[j] + 1 < value:
+                value = prev[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and x == b[j - 2] and a[i - 2] == y:
+                if prev2[j - 2] + 1 < value:
+                    value = prev2[j - 2] + 1
+            current[j] = value
+            if value < best:
+                best = value
+        if limit is not None and best > limit:
+            return limit + 1
+        prev2, prev = prev, current
+    return prev[len(b)]
+
+
+#----------------------------------------------------------------------
+# SpellIndex: SymSpell 拼写建议索引，保存每个单词（的前 prefix 个字符）
+# 删除 1..distance 个字符得到的所有字符串，查询时对输入做同样的删除，
+# 命中的单词再计算真正的编辑距离，不需要和整个词典逐一比较。
+# 索引保存在单独的 SQLite 文件里（词典文件名加 .spell），用到时才打开
+#----------------------------------------------------------------------
+class SpellIndex (object):
+
+    def __init__ (self, filename, distance = 2, prefix = 7, 
+            readonly = False):
+        self.__filename = filename
+        self.__distance = distance
+        self.__prefix = prefix
+        self.__readonly = readonly
+        self.__conn = None
+        self.__lock = threading.RLock()
+
+    # 第一次用到时才打开，设置以文件里保存的为准
+    def __open (self):
+        if self.__conn is not None:
+            return self.__conn
+        if self.__readonly:
+            try:
+                from urllib.request import pathname2url
+            except ImportError:
+                from urllib import pathname2url
+            uri = 'file:%s?mode=ro'%pathname2url(self.__filename)
+            conn = sqlite3.connect(uri, uri = True, check_same_thread = False)
+        else:
+            conn = sqlite3.connect(self.__filename, check_same_thread = False)
+            sql = '''
+            CREATE TABLE IF NOT EXISTS "spell_meta" (
+                "name" VARCHAR(64) PRIMARY KEY NOT NULL, "value" BLOB);
+            CREATE TABLE IF NOT EXISTS "spell_word" (
+                "id" INTEGER PRIMARY KEY NOT NULL,
+                "word" VARCHAR(64) COLLATE NOCASE NOT NULL UNIQUE,
+                "frq" INTEGER DEFAULT(NULL));
+            CREATE TABLE IF NOT EXISTS "spell_delete" (
+                "key" VARCHAR(64) NOT NULL, "id" INTEGER NOT NULL,
+                "level" INTEGER NOT NULL,
+                PRIMARY KEY (key, id)) WITHOUT ROWID;
+            '''
+            conn.executescript(sql)
+            sql = 'INSERT OR IGNORE INTO spell_meta VALUES (?, ?);'
+            conn.execute(sql, ('distance', self.__distance))
+            conn.execute(sql, ('prefix', self.__prefix))
+            conn.commit()
+        for name, value in conn.execute('select name, value from spell_meta;'):
+            if name == 'distance':
+                self.__distance = int(value)
+            elif name == 'prefix':
+                self.__prefix = int(value)
+        self.__conn = conn
+        return conn
+
+    def close (self):
+        with self.__lock:
+            if self.__conn is not None:
+                self.__conn.close()
+            self.__conn = None
+
+    # 删除 0..distance 个字符得到的字符串，返回 {字符串: 删除的字符数}
+    def __deletes (self, word, distance):
+        word = nocase(word)[:self.__prefix]
+        result = { word: 0 }
+        edge = [ word ]
+        for level in xrange(1, distance + 1):
+            step = []
+            for text in edge:
+                if len(text) > 1:
+                    for i in xrange(len(text)):
+                        key = text[:i] + text[i + 1:]
+                        if key not in result:
+                            result[key] = level
+                            step.append(key)
+            edge = step
+        return result
+
+    def __insert (self, conn, items):
+        sql1 = 'select id from spell_word where word = ?;'
+        sql2 = 'INSERT OR REPLACE INTO spell_word (id, word, frq) '
+        sql2 += 'VALUES (?, ?, ?);'
+        sql3 = 'INSERT OR IGNORE INTO spell_delete (key, id, level) '
+        sql3 += 'VALUES (?, ?, ?);'
+        for chunk in iter_chunks(items, BATCH_CHUNK_SIZE):
+            rows = []
+            for uid, word, frq in chunk:
+                if uid is None:
+                    row = conn.execute(sql1, (word,)).fetchone()
+                    uid = row and row[0] or None
+                c = conn.execute(sql2, (uid, word, frq))
+                uid = c.lastrowid
+                for key, level in self.__deletes(word, 
+                        self.__distance).items():
+                    rows.append((key, uid, level))
+            conn.executemany(sql3, rows)
+        return True
+
+    # 重新生成索引，items 为 (id, word, frq) 序列，id 可以为 None；
+    # commit 为 False 时由词典在自己提交或者回滚时调用 commit/rollback
+    def build (self, items, commit = True):
+        with self.__lock:
+            conn = self.__open()
+            conn.execute('DELETE FROM spell_word;')
+            conn.execute('DELETE FROM spell_delete;')
+            self.__insert(conn, items)
+            if commit:
+                conn.commit()
+        return True
+
+    # 增加或者更新单词，items 同 build，id 对应的单词没有变化时只更新 frq
+    def add (self, items, commit = True):
+        sql1 = 'select word from spell_word where id = ?;'
+        sql2 = 'UPDATE spell_word SET frq = ? WHERE id = ?;'
+        with self.__lock:
+            conn = self.__open()
+            changed = []
+            for uid, word, frq in items:
+                if uid is not None:
+                    row = conn.execute(sql1, (uid,)).fetchone()
+                    if row is not None and row[0] == word:
+                        conn.execute(sql2, (frq, uid))
+                        continue
+                changed.append((uid, word, frq))
+            self.remove([ word for _, word, _ in changed ], False)
+            self.__insert(conn, changed)
+            if commit:
+                conn.commit()
+        return True
+
+    # 删除单词，keys 可以是 id 或者单词
+    def remove (self, keys, commit = True):
+        sql1 = 'select id, word from spell_word where id = ?;'
+        sql2 = 'select id, word from spell_word where word = ?;'
+        sql3 = 'DELETE FROM spell_delete WHERE key = ? AND id = ?;'
+        with self.__lock:
+            conn = self.__open()
+            for key in keys:
+                if isinstance(key, int) or isinstance(key, long):
+                    row = conn.execute(sql1, (key,)).fetchone()
+                else:
+                    row = conn.execute(sql2, (key,)).fetchone()
+                if row is None:
+                    continue
+                uid, word = row
+                rows = [ (n, uid) for n in self.__deletes(word, 
+                    self.__distance) ]
+                conn.executemany(sql3, rows)
+                conn.execute('DELETE FROM spell_word WHERE id = ?;', (uid,))
+            if commit:
+                conn.commit()
+        return True
+
+    def clear (self, commit = True):
+        return self.build([], commit)
+
+    def commit (self):
+        with self.__lock:
+            if self.__conn is not None:
+                self.__conn.commit()
+        return True
+
+    def rollback (self):
+        with self.__lock:
+            if self.__conn is not None:
+                self.__conn.rollback()
+        return True
+
+    # 保存点：词典的一次写入出错时只撤销这一次写入对应的修改
+    def savepoint (self):
+        with self.__lock:
+            conn = self.__open()
+            if not conn.in_transaction:
+                conn.execute('BEGIN;')
+            conn.execute('SAVEPOINT spell_write;')
+        return True
+
+    def release (self, rollback = False):
+        with self.__lock:
+            if self.__conn is not None:
+                if rollback:
+                    self.__conn.execute('ROLLBACK TO spell_write;')
+                self.__conn.execute('RELEASE spell_write;')
+        return True
+
+    # 拼写建议：返回 [(word, distance), ...]，先按编辑距离再按 frq 排序。
+    # 距离不超过 d 的单词两边都只需要删除 d 个字符就能碰上，所以从小到大
+    # 逐级查找，当前这一级的结果已经够 limit 个时就不用再往下找了
+    def suggest (self, word, distance = 2, limit = 10):
+        order = rank_key('frq')
+        key = nocase(word)
+        result = []
+        checked = set()
+        with self.__lock:
+            conn = self.__open()
+            distance = min(distance, self.__distance)
+            deletes = self.__deletes(key, distance)
+            for level in xrange(distance + 1):
+                keys = [ k for k, v in deletes.items() if v <= level ]
+                for chunk in iter_chunks(keys, BATCH_CHUNK_SIZE):
+                    mark = ','.join([ '?' ] * len(chunk))
+                    sql = 'select distinct w.id, w.word, w.frq '
+                    sql += 'from spell_delete d join spell_word w '
+                    sql += 'on w.id = d.id where d.key in (%s) '%mark
+                    sql += 'and d.level <= ?;'
+                    for uid, text, frq in conn.execute(sql, 
+                            tuple(chunk) + (level,)):
+                        if uid in checked:
+                            continue
+                        d = edit_distance(key, nocase(text), distance)
+                        if d <= level:
+                            checked.add(uid)
+                            rank = order(lambda name: frq)
+                            result.append((d, rank, nocase(text), text))
+                if len(result) >= limit:
+                    break
+        result.sort()
+        return [ (n[3], n[0]) for n in result[:limit] ]
+
+    def __len__ (self):
+        with self.__lock:
+            conn = self.__open()
+            return conn.execute('select count(*) from spell_word;').fetchone()[0]
+
+
+#----------------------------------------------------------------------
+# 规则还原：LemmaDB 查不到的单词按词尾规则猜原型，(词尾, 替换列表)，
+# 替换列表为 None 的词尾（-ing/-ed/-er/-est）还要处理双写的辅音和
+# 去掉的 e，候选词按顺序检查，第一个在词典里的就是结果
+#----------------------------------------------------------------------
+LEMMA_SUFFIXES = (
+    ('iest', ('y',)), ('ies', ('y',)), ('ied', ('y',)), ('ier', ('y',)),
+    ('ves', ('ve', 'f', 'fe')), ('men', ('man',)),
+    ('sses', ('ss',)), ('xes', ('x',)), ('zes', ('z',)),
+    ('ches', ('ch',)), ('shes', ('sh',)), ('es', ('e', '')), ('s', ('',)),
+    ('ing', None), ('ed', None), ('est', None), ('er', None),
+)
+
+LEMMA_VOWELS = 'aeiou'
+
+LEMMA_SYLLABLE = re.compile('[aeiouy]+')
+
+# 单音节并且以“辅音 + 元音 + 辅音”结尾（hop, mak）时，原型更可能带 e
+# （hope, make），多音节的（visit, docket）一般不带
+def lemma_cvc(base):
+    if len(base) < 3:
+        return False
+    c1, v, c2 = base[-3:]
+    if c1 in LEMMA_VOWELS or v not in LEMMA_VOWELS:
+        return False
+    if c2 in LEMMA_VOWELS or c2 in 'wxy':
+        return False
+    return len(LEMMA_SYLLABLE.findall(base)) == 1
+
+# 按规则生成候选的原型，越靠前越可能
+def lemma_candidates(word):
+    candidates = []
+    for suffix, replaces in LEMMA_SUFFIXES:
+        if not word.endswith(suffix):
+            continue
+        base = word[:-len(suffix)]
+        if len(base) < 2:
+            continue
+        if replaces is not None:
+            if suffix == 's' and word[-2:] == 'ss':
+                continue
+            candidates.extend([ base + n for n in replaces ])
+        elif len(base) >= 3 and base[-1] == base[-2]:
+            # running -> run，但 calling -> call
+            if base[-1] in 'lsfz':
+                candidates.extend([ base, base[:-1] ])
+            else:
+                candidates.extend([ base[:-1], base ])
+        elif lemma_cvc(base):
+            candidates.extend([ base + 'e', base ])
+        else:
+            candidates.extend([ base, base + 'e' ])
+    result = []
+    for n in candidates:
+        if len(n) >= 2 and n not in result:
+            result.append(n)
+    return result
+
+
+#----------------------------------------------------------------------
+# LemmaDB 的冻结格式：一次写成排好序的二进制文件，打开时 mmap 进来，
+# 不用解析文本也不用建字典，多个进程共享同一份页缓存。文件结构：
+#   头部：magic, 字符串数 n, 词根数, 衍生词数, 以及各段的偏移
+#   字符串表：按 UTF-8 字节排序的全部词根和衍生词，offsets[n + 1] + 数据
+#   frqs[n]：作为词根时的词频（没有为 0）
+#   词根 -> 衍生词，衍生词 -> 词根：各一组 starts[n + 1] + 字符串下标
+# 所有整数都是小端序的 uint32，查找时在字符串表上二分
+#----------------------------------------------------------------------
+LEMMA_MAGIC = b'LEMMAFZ1'
+LEMMA_HEADER = struct.Struct('<8sIII7I')
+LEMMA_FENCE = 32
+
+class FrozenLemma (object):
+
+    def __init__ (self, filename):
+        self.__fp = open(filename, 'rb')
+        self.__mm = mmap.mmap(self.__fp.fileno(), 0, access = mmap.ACCESS_READ)
+        head = LEMMA_HEADER.unpack_from(self.__mm, 0)
+        if head[0] != LEMMA_MAGIC:
+            self.close()
+            raise ValueError('bad frozen lemma file: %s'%filename)
+        self.count, self.stem_count, self.word_count = head[1:4]
+        n = self.count
+        sections = head[4:]
+        self.__data = sections[1]
+        self.__offsets = self.__array(sections[0], n + 1)
+        self.__frqs = self.__array(sections[2], n)
+        starts = self.__array(sections[3], n + 1)
+        self.__stems = (starts, self.__array(sections[4], starts[n]))
+        starts = self.__array(sections[5], n + 1)
+        self.__words = (starts, self.__array(sections[6], starts[n]))
+        self.__fence = None
+
+    # 映射区间上的 uint32 数组，python 2（没有 memoryview.cast）或者
+    # 大端机器上只能复制一份，再按需要转换字节序
+    def __array (self, offset, size):
+        if hasattr(memoryview, 'cast') and sys.byteorder == 'little':
+            view = memoryview(self.__mm)[offset:offset + size * 4]
+            return view.cast('I')
+        data = array.array('I')
+        if hasattr(data, 'frombytes'):
+            data.frombytes(self.__mm[offset:offset + size * 4])
+        else:
+            data.fromstring(self.__mm[offset:offset + size * 4])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data
+
+    def close (self):
+        if self.__mm is not None:
+            self.__offsets = self.__frqs = self.__stems = self.__words = None
+            try:
+                self.__mm.close()
+            except BufferError:
+                pass
+            self.__mm = None
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
+
+    # 第 index 个字符串的 UTF-8 字节
+    def __bytes (self, index):
+        start = self.__data + self.__offsets[index]
+        end = self.__data + self.__offsets[index + 1]
+        return self.__mm[start:end]
+
+    def string (self, index):
+        return self.__bytes(index).decode('utf-8')
+
+    # 二分查找字符串的下标，找不到返回 -1：先在每隔 LEMMA_FENCE 个取
+    # 一个的索引上用 bisect 定位到块（第一次查找时生成），块内再二分
+    def find (self, text):
+        key = text.encode('utf-8')
+        if self.__fence is None:
+            self.__fence = [ self.__bytes(i) for i in 
+                    xrange(0, self.count, LEMMA_FENCE) ]
+        block = bisect.bisect_right(self.__fence, key) - 1
+        if block < 0:
+            return -1
+        top = block * LEMMA_FENCE
+        bottom = min(top + LEMMA_FENCE, self.count)
+        while top < bottom:
+            middle = (top + bottom) >> 1
+            if self.__bytes(middle) < key:
+                top = middle + 1
+            else:
+                bottom = middle
+        if top < self.count and self.__bytes(top) == key:
+            return top
+        return -1
+
+    def frq (self, index):
+        return self.__frqs[index]
+
+    # 下标 index 的衍生词（reverse 为假）或者词根（reverse 为真）的下标
+    def links (self, index, reverse = False):
+        starts, items = reverse and self.__words or self.__stems
+        return items[starts[index]:starts[index + 1]]
+
+    def is_stem (self, index):
+        starts = self.__stems[0]
+        return starts[index] < starts[index + 1]
+
+    def is_word (self, index):
+        starts = self.__words[0]
+        return starts[index] < starts[index + 1]
+
+    # 按顺序遍历词根（reverse 为假）或者衍生词的下标
+    def iter_index (self, reverse = False):
+        starts = reverse and self.__words[0] or self.__stems[0]
+        for i in xrange(self.count):
+            if starts[i] < starts[i + 1]:
+                yield i
+
+
 #----------------------------------------------------------------------
 # 词形衍生：查找动词的各种时态，名词的复数等，或反向查找
 # 格式为每行一条数据：根词汇 -> 衍生1,衍生2,衍生3
@@ -1038,6 +4634,98 @@ class LemmaDB (object):
         self._stems = {}
         self._words = {}
         self._frqs = {}
+        # open_frozen() 打开的 FrozenLemma，修改数据时再展开成字典
+        self._frozen = None
+        # get() 的结果：(词根 -> 衍生词, 衍生词 -> 词根)，排好序的 tuple，
+        # 第一次查到时生成，add/remove 时清除相关的条目
+        self._orders = ({}, {})
+        # 规则还原（fallback() 之后启用）：检查候选词用的单词集合，
+        # 以及有大小限制的结果缓存
+        self._members = None
+        self._guesses = None
+
+    # 打开 freeze() 生成的文件，查询直接在 mmap 上二分，没有解析过程
+    @classmethod
+    def open_frozen (cls, filename):
+        db = cls()
+        db._frozen = FrozenLemma(filename)
+        return db
+
+    # 保存成冻结格式（见 FrozenLemma）
+    def freeze (self, filename):
+        stems = list(self)
+        words = list(self.dump('word'))
+        strings = [ n.encode('utf-8') for n in set(stems + words) ]
+        strings.sort()
+        index = dict([ (n.decode('utf-8'), i) for i, n in enumerate(strings) ])
+        offsets = array.array('I', [ 0 ])
+        for text in strings:
+            offsets.append(offsets[-1] + len(text))
+        data = b''.join(strings)
+        data += b'\0' * ((4 - len(data) % 4) % 4)
+        frqs = array.array('I', [ 0 ] * len(strings))
+        for stem in stems:
+            frqs[index[stem]] = self.__frq(stem)
+        links = []
+        for keys, reverse in ((stems, False), (words, True)):
+            children = [ None ] * len(strings)
+            for key in keys:
+                children[index[key]] = [ index[n] for n in 
+                        self.get(key, reverse) ]
+            starts = array.array('I', [ 0 ])
+            items = array.array('I')
+            for child in children:
+                if child:
+                    items.extend(child)
+                starts.append(len(items))
+            links.extend([ starts, items ])
+        sections = []
+        for section in [ offsets, data, frqs ] + links:
+            if isinstance(section, array.array):
+                if sys.byteorder != 'little':
+                    section.byteswap()
+                if hasattr(section, 'tobytes'):
+                    section = section.tobytes()
+                else:
+                    section = section.tostring()
+            sections.append(section)
+        heads = []
+        position = LEMMA_HEADER.size
+        for section in sections:
+            heads.append(position)
+            position += len(section)
+        head = LEMMA_HEADER.pack(LEMMA_MAGIC, len(strings), len(stems), 
+                len(words), *heads)
+        with open(filename, 'wb') as fp:
+            fp.write(head)
+            for section in sections:
+                fp.write(section)
+        return True
+
+    # 把冻结的数据展开成字典，之后才能修改
+    def _thaw (self):
+        frozen = self._frozen
+        if frozen is None:
+            return False
+        self._frozen = None
+        for i in frozen.iter_index():
+            stem = frozen.string(i)
+            if frozen.frq(i) > 0:
+                self._frqs[stem] = frozen.frq(i)
+            for n in frozen.links(i):
+                self.add(stem, frozen.string(n))
+        for i in frozen.iter_index(True):
+            word = frozen.string(i)
+            self._words[word] = dict([ (frozen.string(n), k) for k, n in
+                enumerate(frozen.links(i, True)) ])
+        frozen.close()
+        return True
+
+    def __frq (self, stem):
+        if self._frozen is not None:
+            index = self._frozen.find(stem)
+            return (index >= 0) and self._frozen.frq(index) or 0
+        return self._frqs.get(stem, 0)
 
     # 读取数据
     def load (self, filename, encoding = None):
@@ -1087,7 +4775,7 @@ class LemmaDB (object):
 
     # 保存数据文件
     def save (self, filename, encoding = 'utf-8'):
-        stems = list(self._stems.keys())
+        stems = list(self)
         stems.sort(key = lambda x: x.lower())
         import codecs
         fp = codecs.open(filename, 'w', encoding)
@@ -1096,7 +4784,7 @@ class LemmaDB (object):
             words = self.get(stem)
             if not words:
                 continue
-            frq = self._frqs.get(stem, 0)
+            frq = self.__frq(stem)
             if frq > 0:
                 stem = '%s/%d'%(stem, frq)
             output.append((-frq, u'%s -> %s'%(stem, ','.join(words))))
@@ -1108,6 +4796,8 @@ class LemmaDB (object):
 
     # 添加一个词根的一个衍生词
     def add (self, stem, word):
+        if self._frozen is not None:
+            self._thaw()
         if stem not in self._stems:
             self._stems[stem] = {}
         if word not in self._stems[stem]:
@@ -1116,10 +4806,23 @@ class LemmaDB (object):
             self._words[word] = {}
         if stem not in self._words[word]:
             self._words[word][stem] = len(self._words[word])
+        if self._orders[0] or self._orders[1]:
+            self.__invalidate(stem, word)
+        return True
+
+    # 清除 stem 和 word 两个方向上缓存的结果
+    def __invalidate (self, stem, word):
+        for cache in self._orders:
+            cache.pop(stem, None)
+            cache.pop(word, None)
+        if self._guesses:
+            self._guesses.clear()
         return True
 
     # 删除一个词根的一个衍生词
     def remove (self, stem, word):
+        if self._frozen is not None:
+            self._thaw()
         count = 0
         if stem in self._stems:
             if word in self._stems[stem]:
@@ -1133,16 +4836,87 @@ class LemmaDB (object):
                 count += 1
             if not self._words[word]:
                 del self._words[word]
+        self.__invalidate(stem, word)
         return (count > 0) and True or False
 
     # 清空数据库
     def reset (self):
         self._stems = {}
         self._words = {}
+        self._orders = ({}, {})
+        if self._guesses:
+            self._guesses.clear()
+        if self._frozen is not None:
+            self._frozen.close()
+            self._frozen = None
         return True
 
     # 根据词根找衍生，或者根据衍生反向找词根
     def get (self, word, reverse = False):
+        words = self.__ordered(word, reverse)
+        if words is None:
+            return None
+        return list(words)
+
+    # 排好序的查询结果（tuple），查到的结果会缓存下来
+    def __ordered (self, word, reverse):
+        cache = self._orders[reverse and 1 or 0]
+        words = cache.get(word)
+        if words is not None:
+            return words
+        if self._frozen is not None:
+            words = self.__frozen_get(word, reverse)
+        else:
+            words = self.__sorted_get(word, reverse)
+        if words is not None:
+            words = tuple(words)
+            cache[word] = words
+        elif reverse and self._guesses is not None:
+            stem = self.guess(word)
+            if stem is not None:
+                words = (stem,)
+        return words
+
+    # 启用规则还原：word_stem/lemmatize_many 查不到时按词尾规则猜原型，
+    # 候选词必须是 LemmaDB 里的词根或者在 members 里（集合、字典或者
+    # StarDict 等支持 in 的对象），结果缓存在大小为 size 的 LRU 里
+    def fallback (self, members = None, size = 65536):
+        self._members = members
+        self._guesses = LRUCache(size)
+        return True
+
+    # 按规则猜单词的原型，本身就在词典里或者猜不出来时返回 None
+    def guess (self, word):
+        if self._guesses is None:
+            self.fallback()
+        stem = self._guesses.get(word, False)
+        if stem is not False:
+            return stem
+        stem = None
+        key = word.lower()
+        if key != word:
+            stems = self.__ordered(key, True)
+            stem = stems and stems[0] or None
+        elif not self.__known(key):
+            for candidate in lemma_candidates(key):
+                if self.__known(candidate):
+                    stem = candidate
+                    break
+        self._guesses.set(word, stem)
+        return stem
+
+    def __known (self, word):
+        if self._frozen is not None:
+            index = self._frozen.find(word)
+            if index >= 0 and self._frozen.is_stem(index):
+                return True
+        elif word in self._stems:
+            return True
+        if self._members is not None:
+            return word in self._members
+        return False
+
+    def __sorted_get (self, word, reverse):
         if not reverse:
             if word not in self._stems:
                 if word in self._words:
@@ -1158,21 +4932,69 @@ class LemmaDB (object):
         words.sort()
         return [ k for (v, k) in words ]
 
+    def __frozen_get (self, word, reverse):
+        frozen = self._frozen
+        index = frozen.find(word)
+        if index < 0:
+            return None
+        links = frozen.links(index, reverse)
+        if not links:
+            if frozen.is_word(index) or frozen.is_stem(index):
+                return [word]
+            return None
+        return [ frozen.string(n) for n in links ]
+
     # 知道一个单词求它的词根
     def word_stem (self, word):
         return self.get(word, reverse = True)
 
+    # 批量求词根：相同的单词只查一次，返回和 tokens 对齐的列表，每项
+    # 是第一个词根（查不到为 None）。indices 为真时返回 (stems, array)，
+    # array 里是词根在 stems 里的下标，查不到为 -1
+    def lemmatize_many (self, tokens, indices = False):
+        tokens = list(tokens)
+        distinct = dict.fromkeys(tokens)
+        for token in distinct:
+            stems = self.__ordered(token, True)
+            distinct[token] = stems and stems[0] or None
+        if not indices:
+            return [ distinct[token] for token in tokens ]
+        position = {}
+        stems = []
+        for token, stem in distinct.items():
+            if stem is None:
+                distinct[token] = -1
+                continue
+            if stem not in position:
+                position[stem] = len(stems)
+                stems.append(stem)
+            distinct[token] = position[stem]
+        return stems, array.array('l', [ distinct[n] for n in tokens ])
+
     # 总共多少条词根数据
     def stem_size (self):
+        if self._frozen is not None:
+            return self._frozen.stem_count
         return len(self._stems)
 
     # 总共多少条衍生数据
     def word_size (self):
+        if self._frozen is not None:
+            return self._frozen.word_count
         return len(self._words)
 
     def dump (self, what = 'ALL'):
         words = {}
         what = what.lower()
+        if self._frozen is not None:
+            frozen = self._frozen
+            if what in ('all', 'stem'):
+                for i in frozen.iter_index():
+                    words[frozen.string(i)] = 1
+            if what in ('all', 'word'):
+                for i in frozen.iter_index(True):
+                    words[frozen.string(i)] = 1
+            return words
         if what in ('all', 'stem'):
             for word in self._stems:
                 words[word] = 1
@@ -1182,15 +5004,21 @@ class LemmaDB (object):
         return words
 
     def __len__ (self):
-        return len(self._stems)
+        return self.stem_size()
 
     def __getitem__ (self, stem):
         return self.get(stem)
 
     def __contains__ (self, stem):
+        if self._frozen is not None:
+            index = self._frozen.find(stem)
+            return (index >= 0) and self._frozen.is_stem(index)
         return (stem in self._stems)
 
     def __iter__ (self):
+        if self._frozen is not None:
+            frozen = self._frozen
+            return iter([ frozen.string(i) for i in frozen.iter_index() ])
         return self._stems.__iter__()
 
 
@@ -1273,7 +5101,7 @@ class DictHelper (object):
         else:
             db = StarDict(outname)
         db.delete_all()
-        count = 0
+        pending = []
         for word in words:
             if word.lower() in existence:
                 continue
@@ -1298,9 +5126,10 @@ class DictHelper (object):
                 word.encode('ascii')
             except:
                 continue
-            db.register(word, {'tag':'PENDING'}, False)
-            count += 1
+            pending.append((word, {'tag':'PENDING'}))
+        db.register_many(pending, False)
         db.commit()
+        count = len(pending)
         print('exported %d entries'%count)
         return count
 
@@ -1312,6 +5141,8 @@ class DictHelper (object):
         else:
             db = StarDict(filename)
         count = 0
+        updates = []
+        registers = []
         for word in self.dump_map(db, False):
             data = db[word]
             if data is None:
@@ -1332,10 +5163,12 @@ class DictHelper (object):
                 continue
             if word.lower() in existence:
                 if 'n' not in opts:
-                    dictionary.update(word, update, False)
+                    updates.append((word, update))
             else:
-                dictionary.register(word, update, False)
+                registers.append((word, update))
             count += 1
+        dictionary.update_many(updates, False)
+        dictionary.register_many(registers, False)
         dictionary.commit()
         print('imported %d entries'%count)
         return count
@@ -1669,14 +5502,15 @@ class DictHelper (object):
         if not words:
             return False
         pc = self.progress(len(words))
-        for word in words:
-            data = dictionary.query(word)
-            if not data:
-                dictionary.register(word, {'translation':words[word]}, False)
-            else:
-                dictionary.update(word, {'translation':words[word]}, False)
-            pc.inc(0)
-            pc.next()
+        def generate():
+            for word in words:
+                pc.inc(0)
+                pc.next()
+                yield (word, {'translation':words[word]})
+        skipped = dictionary.register_many(generate(), False)
+        if skipped:
+            items = [ (w, {'translation':words[w]}) for w in skipped ]
+            dictionary.update_many(items, False)
         dictionary.commit()
         pc.done()
         return True
@@ -1754,15 +5588,19 @@ class DictHelper (object):
 #----------------------------------------------------------------------
 tools = DictHelper()
 
-# 根据文件名自动判断数据库类型并打开
-def open_dict(filename):
+# 根据文件名自动判断数据库类型并打开，cache 大于零时套上一层查询缓存
+def open_dict(filename, cache = 0):
     if isinstance(filename, dict):
-        return DictMySQL(filename)
-    if filename[:8] == 'mysql://':
-        return DictMySQL(filename)
-    if os.path.splitext(filename)[-1].lower() in ('.csv', '.txt'):
-        return DictCsv(filename)
-    return StarDict(filename)
+        dictionary = DictMySQL(filename)
+    elif filename[:8] == 'mysql://':
+        dictionary = DictMySQL(filename)
+    elif os.path.splitext(filename)[-1].lower() in ('.csv', '.txt'):
+        dictionary = DictCsv(filename)
+    else:
+        dictionary = StarDict(filename)
+    if cache > 0:
+        dictionary = CachedDict(dictionary, cache)
+    return dictionary
 
 
 # 字典转化，csv sqlite之间互转
@@ -1771,29 +5609,89 @@ def convert_dict(dstname, srcname):
     src = open_dict(srcname)
     dst.delete_all()
     pc = tools.progress(len(src))
-    for word in src.dumps():
-        pc.next()
-        data = src[word]
-        x = data['oxford']
-        if isinstance(x, int) or isinstance(x, long):
-            if x <= 0:
-                data['oxford'] = None
-        elif isinstance(x, str) or isinstance(x, unicode):
-            if x == '' or x == '0':
-                data['oxford'] = None
-        x = data['collins']
-        if isinstance(x, int) or isinstance(x, long):
-            if x <= 0:
-                data['collins'] = None
-        elif isinstance(x, str) or isinstance(x, unicode):
-            if x in ('', '0'):
-                data['collins'] = None
-        dst.register(word, data, False)
+    def generate():
+        for data in src.iter_records():
+            pc.next()
+            word = data['word']
+            x = data['oxford']
+            if isinstance(x, int) or isinstance(x, long):
+                if x <= 0:
+                    data['oxford'] = None
+            elif isinstance(x, str) or isinstance(x, unicode):
+                if x == '' or x == '0':
+                    data['oxford'] = None
+            x = data['collins']
+            if isinstance(x, int) or isinstance(x, long):
+                if x <= 0:
+                    data['collins'] = None
+            elif isinstance(x, str) or isinstance(x, unicode):
+                if x in ('', '0'):
+                    data['collins'] = None
+            yield (word, data)
+    if isinstance(dst, StarDict):
+        # delete_all 之后目标库是空的，用批量导入模式，最后再建索引
+        with dst.bulk_load():
+            dst.register_many(generate(), False)
+    else:
+        dst.register_many(generate(), False)
     dst.commit()
     pc.done()
     return True
 
 
+# 测试某个版本表结构的插入速度（内存数据库），返回每秒插入的行数
+def schema_benchmark(version, keys, rows):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(schema_table(version) + index_sql(SCHEMA_INDEXES[version]))
+    columns = schema_columns(version)
+    names = [ '"%s"'%n for n in keys ] + [ n for n, _, _ in columns ]
+    sql = 'INSERT INTO stardict (%s) VALUES (%s);'%(
+            ', '.join(names), ', '.join([ '?' ] * len(names)))
+    if columns:
+        pos = keys.index('word')
+        rows = [ tuple(row) + tuple([ f(row[pos]) for _, _, f in columns ])
+                for row in rows ]
+    t = time.time()
+    for chunk in iter_chunks(rows, BATCH_CHUNK_SIZE):
+        conn.executemany(sql, chunk)
+    conn.commit()
+    t = max(time.time() - t, 0.000001)
+    conn.close()
+    return len(rows) / t
+
+
+# 把 StarDict 数据库升级到最新的表结构，打印升级前后的文件大小和插入速度
+def migrate_dict(filename, samples = 20000):
+    sd = StarDict(filename)
+    version = sd.version()
+    size = os.path.getsize(filename)
+    # 采样一部分原始数据，用来比较新旧表结构的插入速度
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(SCHEMA_TABLE[1])
+    cursor = conn.execute('PRAGMA table_info(stardict);')
+    keys = tuple([ row[1] for row in cursor if row[1] != 'id' ])
+    conn.close()
+    conn = sqlite3.connect(filename)
+    sql = 'SELECT %s FROM stardict LIMIT ?;'%(', '.join(keys))
+    rows = conn.execute(sql, (samples,)).fetchall()
+    conn.close()
+    print('%s: schema version %d -> %d'%(filename, version, SCHEMA_VERSION))
+    if not sd.upgrade():
+        print('already up to date')
+        sd.close()
+        return False
+    sd.close()
+    after = os.path.getsize(filename)
+    print('size: %d -> %d bytes (%.1f%%)'%(size, after, 
+        after * 100.0 / max(size, 1)))
+    if rows:
+        speed1 = schema_benchmark(1, keys, rows)
+        speed2 = schema_benchmark(SCHEMA_VERSION, keys, rows)
+        print('insert: %d -> %d rows/sec (%d samples)'%(speed1, speed2, 
+            len(rows)))
+    return True
+
+
 # 从 ~/.local/share/stardict 下面打开词典
 def open_local(filename):
     base = os.path.expanduser('~/.local')
@@ -1883,6 +5781,10 @@ if __name__ == '__main__':
         return 0
     def test5():
         print(tools.validate_word('Hello World', False))
+    if len(sys.argv) >= 3 and sys.argv[1] == 'migrate':
+        for name in sys.argv[2:]:
+            migrate_dict(name)
+        sys.exit(0)
     test3()
 
 
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import random
+import shutil
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import stardict
+
+
+#----------------------------------------------------------------------
+# 随机数据
+#----------------------------------------------------------------------
+HAN = u'计算机电脑网络数据结构语言学习英文中国人民大学生活工作时间'
+PHONETICS = [ u'neiʃən', u'steiʃən', u'kæt', u'bæt', u'rʌn', u'sʌn' ]
+
+def random_item(rand, word):
+    text = ''.join([ rand.choice(HAN) for _ in range(rand.randint(0, 6)) ])
+    exchange = rand.choice([ None, 'p:%sed/d:%sed', 's:%ss' ])
+    return {
+        'translation': text or None,
+        'definition': rand.choice([ 'a machine', 'the network', None ]),
+        'phonetic': rand.choice(PHONETICS + [ None ]),
+        'exchange': exchange and exchange.replace('%s', word) or None,
+        'frq': rand.randint(0, 5000),
+        'bnc': rand.randint(0, 5000),
+    }
+
+def random_words(rand, count):
+    words = set()
+    while len(words) < count:
+        size = rand.randint(2, 6)
+        words.add(''.join([ rand.choice('abcdefg') for _ in range(size) ]))
+    return sorted(words)
+
+def build_all(db):
+    assert db.search_build()
+    assert db.complete_build()
+    assert db.rhyme_build()
+    assert db.lemma_build()
+    assert db.spell_build()
+
+
+#----------------------------------------------------------------------
+# 附属索引：增删改以后和重新生成的结果一致
+#----------------------------------------------------------------------
+def test_derived_indexes_match_rebuild(tmp_path):
+    rand = random.Random(7)
+    words = random_words(rand, 600)
+    filename = str(tmp_path / 'live.db')
+    db = stardict.StarDict(filename)
+    db.register_many([ (w, random_item(rand, w)) for w in words[:400] ])
+    build_all(db)
+    for _ in range(200):
+        word = rand.choice(words)
+        op = rand.random()
+        if op < 0.25:
+            db.register(word, random_item(rand, word))
+        elif op < 0.45:
+            db.remove(word)
+        elif op < 0.7:
+            item = random_item(rand, word)
+            names = rand.sample(sorted(item), rand.randint(1, 3))
+            db.update(word, dict([ (n, item[n]) for n in names ]))
+        elif op < 0.85:
+            names = rand.sample(sorted(random_item(rand, word)), 2)
+            items = []
+            for key in rand.sample(words, 10):
+                item = random_item(rand, key)
+                items.append((key, dict([ (n, item[n]) for n in names ])))
+            db.update_many(items)
+        else:
+            keys = rand.sample(words, 5)
+            db.register_many([ (n, random_item(rand, n)) for n in keys ])
+    db.commit()
+    db.close()
+    rebuilt = str(tmp_path / 'rebuilt.db')
+    shutil.copy(filename, rebuilt)
+    db = stardict.StarDict(rebuilt)
+    build_all(db)
+    db.close()
+    a = stardict.StarDict(filename)
+    b = stardict.StarDict(rebuilt)
+    assert len(a) == len(b)
+    for text in list(HAN) + [ u'网络', 'machine', 'network' ]:
+        for rank in ('frq', 'rank'):
+            assert a.search(text, 50, rank) == b.search(text, 50, rank)
+    tables = (('stardict_complete', 'mode, rank, prefix, pos, id'),
+            ('stardict_rhyme', 'tail, id'),
+            ('stardict_lemma', 'form, lemma, type, id'))
+    ca = sqlite3.connect(filename)
+    cb = sqlite3.connect(rebuilt)
+    for table, columns in tables:
+        sql = 'select %s from %s order by %s;'%(columns, table, columns)
+        assert ca.execute(sql).fetchall() == cb.execute(sql).fetchall()
+    ca.close()
+    cb.close()
+    for word in words[::20]:
+        assert a.rhymes(word, 20) == b.rhymes(word, 20)
+        assert a.complete(word[:2], 10) == b.complete(word[:2], 10)
+        assert a.suggest(word) == b.suggest(word)
+    a.close()
+    b.close()
+
+
+#----------------------------------------------------------------------
+# 写入出错时只撤销这一次写入，之前 commit = False 的写入还在
+#----------------------------------------------------------------------
+def test_failed_write_keeps_pending_writes(tmp_path):
+    filename = str(tmp_path / 'savepoint.db')
+    db = stardict.StarDict(filename)
+    db.lemma_build()
+    db.spell_build()
+    conn = sqlite3.connect(filename)
+    sql = 'CREATE TRIGGER fail BEFORE INSERT ON stardict_lemma '
+    sql += "WHEN new.lemma = 'bad' BEGIN SELECT RAISE(ABORT, 'fail'); END;"
+    conn.execute(sql)
+    conn.commit()
+    conn.close()
+    db.register('keep', { 'translation': 'k' }, False)
+    assert db.register('bad', { 'exchange': 's:bads' }, False) is False
+    assert db.query('bad') is None
+    items = [ ('good', {}), ('bad', { 'exchange': 's:bads' }) ]
+    assert db.register_many(items, False) is None
+    assert db.query('good') is None
+    db.commit()
+    db.close()
+    db = stardict.StarDict(filename)
+    assert db.dumps() == [ 'keep' ]
+    assert db.suggest('kep') == [ ('keep', 1) ]
+    assert db.suggest('god') == []
+    db.close()
+
+
+#----------------------------------------------------------------------
+# 第 1 版的数据库：照常使用，upgrade() 以后结果不变
+#----------------------------------------------------------------------
+def test_upgrade_from_version_1(tmp_path):
+    filename = str(tmp_path / 'v1.db')
+    conn = sqlite3.connect(filename)
+    conn.executescript(stardict.SCHEMA_TABLE[1])
+    conn.executescript(stardict.index_sql(stardict.SCHEMA_INDEXES[1]))
+    words = [ 'listen', 'silent', 'enlist', 'tinsel', 'night', 'knight',
+            'station', 'nation', 'list' ]
+    sql = 'INSERT INTO stardict (word, sw, translation, frq) '
+    sql += 'VALUES (?, ?, ?, ?);'
+    for i, word in enumerate(words):
+        conn.execute(sql, (word, stardict.stripword(word), word, i + 1))
+    conn.commit()
+    conn.close()
+    def lookups(db):
+        return (db.suffix_match('ation'), db.sounds_like('nite'),
+                db.anagrams('listen'), db.anagrams('listen', True),
+                db.match('li', 5), db.query('knight')['translation'])
+    db = stardict.StarDict(filename)
+    assert db.version() == 1
+    assert db.register('inlets', { 'frq': 20 })
+    before = lookups(db)
+    assert db.upgrade()
+    assert db.version() == stardict.SCHEMA_VERSION
+    assert lookups(db) == before
+    db.close()
+    db = stardict.StarDict(filename)
+    assert db.version() == stardict.SCHEMA_VERSION
+    assert lookups(db) == before
+    assert db.register('islet', { 'frq': 21 })
+    assert db.anagrams('islet') == [ (11, 'islet') ]
+    db.close()
+    conn = sqlite3.connect(filename)
+    sql = 'select count(*) from stardict where rsw is null '
+    sql += 'or sound is null or anagram_key is null;'
+    assert conn.execute(sql).fetchone()[0] == 0
+    conn.close()
+
+
+def test_newer_schema_version_is_refused(tmp_path):
+    filename = str(tmp_path / 'newer.db')
+    stardict.StarDict(filename).close()
+    conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA user_version = %d;'%(stardict.SCHEMA_VERSION + 1))
+    conn.close()
+    with pytest.raises(ValueError):
+        stardict.StarDict(filename)
+
+
+#----------------------------------------------------------------------
+# 冻结格式的 LemmaDB 和读文本的结果一致，没有 memoryview.cast 时
+# （python 2）复制出来的数组也一样
+#----------------------------------------------------------------------
+LEMMA_FILE = os.path.join(os.path.dirname(__file__), '..', 'lemma.en.txt')
+
+class NoCast (object):
+    pass
+
+@pytest.fixture(scope = 'module')
+def lemma():
+    db = stardict.LemmaDB()
+    db.load(LEMMA_FILE)
+    return db
+
+@pytest.mark.parametrize('cast', [ True, False ])
+def test_frozen_lemma_matches_loaded(lemma, tmp_path, monkeypatch, cast):
+    if not cast:
+        monkeypatch.setattr(stardict, 'memoryview', NoCast, raising = False)
+    filename = str(tmp_path / 'lemma.bin')
+    lemma.freeze(filename)
+    frozen = stardict.LemmaDB.open_frozen(filename)
+    assert len(frozen) == len(lemma)
+    assert frozen.word_size() == lemma.word_size()
+    stems = sorted(lemma)
+    words = sorted(lemma.dump('word'))
+    for stem in stems[::37]:
+        assert stem in frozen
+        assert frozen.get(stem) == lemma.get(stem)
+    for word in words[::37]:
+        assert frozen.word_stem(word) == lemma.word_stem(word)
+    tokens = words[::101] + stems[::101] + [ 'qzxv', 'ran', 'better' ]
+    assert frozen.lemmatize_many(tokens) == lemma.lemmatize_many(tokens)
+    assert frozen.word_stem('qzxv') is None
+    again = str(tmp_path / 'again.bin')
+    frozen.freeze(again)
+    frozen.reset()
+    with open(filename, 'rb') as fp1, open(again, 'rb') as fp2:
+        assert fp1.read() == fp2.read()
+
+
+#----------------------------------------------------------------------
+# CachedDict：写入以后清除缓存，大小写折叠和 SQLite 的 NOCASE 一致
+#----------------------------------------------------------------------
+class HookedDict (object):
+
+    def __init__ (self, source):
+        self.source = source
+        self.hook = None
+
+    def __getattr__ (self, name):
+        return getattr(self.source, name)
+
+    # 查询返回之前调用一次 hook，模拟查询期间有其他线程写入
+    def query (self, key, fields = None, follow_lemma = False):
+        obj = self.source.query(key, fields, follow_lemma)
+        hook, self.hook = self.hook, None
+        if hook is not None:
+            hook()
+        return obj
+
+def test_cached_dict_invalidation(tmp_path):
+    db = stardict.StarDict(str(tmp_path / 'cache.db'))
+    db.register('hello', { 'translation': 'old', 'detail': { 'n': 1 } })
+    cache = stardict.CachedDict(db)
+    assert cache.query('hello')['translation'] == 'old'
+    assert cache.query('world') is None
+    cache.update('hello', { 'translation': 'new' })
+    assert cache.query('HELLO')['translation'] == 'new'
+    cache.register('world', { 'translation': 'w' })
+    assert cache.query('world')['translation'] == 'w'
+    assert [ w for _, w in cache.match('wor') ] == [ 'world' ]
+    cache.remove('world')
+    assert cache.query('world') is None
+    assert cache.match('wor') == []
+    record = cache.query('hello')
+    record['detail']['n'] = 2
+    assert cache.query('hello')['detail'] == { 'n': 1 }
+    assert cache.query_batch([ 'hello', 'world' ])[1] is None
+    assert cache.stats()['hits'] > 0
+    db.close()
+
+def test_cached_dict_skips_results_raced_by_writes(tmp_path):
+    db = stardict.StarDict(str(tmp_path / 'race.db'))
+    db.register('hello', { 'translation': 'old' })
+    source = HookedDict(db)
+    cache = stardict.CachedDict(source)
+    def write():
+        cache.update('hello', { 'translation': 'new' })
+    source.hook = write
+    assert cache.query('hello')['translation'] == 'old'
+    assert cache.query('hello')['translation'] == 'new'
+    db.close()
+
+@pytest.mark.parametrize('compact', [ False, True ])
+def test_cached_dict_folds_like_nocase(tmp_path, compact):
+    db = stardict.StarDict(str(tmp_path / 'fold.db'), compact = compact)
+    db.register(u'café', { 'translation': 'coffee' })
+    cache = stardict.CachedDict(db)
+    assert db.query(u'CAFÉ') is None
+    assert cache.query(u'CAFÉ') is None
+    assert cache.query(u'café')['translation'] == 'coffee'
+    assert cache.query(u'CAFÉ') is None
+    assert cache.query(u'CAFé')['word'] == u'café'
+    first = db.query(u'café')
+    hit = cache.query(u'café')
+    assert type(hit) is type(first)
+    assert hit == first
+    db.close()